@@ -0,0 +1,188 @@
+#!/usr/bin python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2021 Alan Frost, Inc. All rights reserved.
+
+HMAC signed request authentication for machine API clients
+"""
+
+from __future__ import print_function
+
+import base64
+import re
+import time
+from collections import OrderedDict
+from threading import Lock
+from cryptography.hazmat.primitives.constant_time import bytes_eq
+
+from crypto import hmac_sha256
+from utils import (get_hmac_signing_key, get_signed_request_message)
+
+AUTH_SCHEME = 'HMAC_SHA256'
+AUTH_HEADER = re.compile(r'HMAC_SHA256 Credential=([\w.\-]+), ?Signature=([0-9a-fA-F]{64})$')
+DATE_HEADER = 'X-Date'
+
+def signed_headers(client, secret, method, path, params, time_stamp=None):
+    """ Create the headers for a signed API request, for use by API clients
+    Args:
+        client: client id
+        secret: client shared secret
+        method: HTTP method
+        path: request path, e.g. '/api/recipe.post'
+        params: request body for POST/PUT/PATCH, query string for GET/DELETE
+        time_stamp: Unix time of the request, defaults to now
+    Return:
+        dict of headers
+    """
+    time_stamp = int(time_stamp or time.time())
+    key = get_hmac_signing_key(secret, str(time_stamp))
+    signature = base64.b16encode(
+        hmac_sha256(key, get_signed_request_message(method, path, params, time_stamp)))
+    return {'Authorization': '{} Credential={}, Signature={}'.format(AUTH_SCHEME, client,
+                                                                    signature.decode('ascii')),
+            DATE_HEADER: str(time_stamp)}
+
+class SignedRequestAuth(object):
+    """ Authenticate requests signed with a per client shared secret. Signatures seen within
+        the allowed clock skew are remembered so that a captured request can't be replayed. A signature is never
+        forgotten while it could still be accepted, when the cache is full of them further
+        requests are rejected until the oldest expire.
+    """
+    def __init__(self, clients, skew=450, max_rate=100):
+        """ Constructor
+        Args:
+            clients: dict of client id to shared secret
+            skew: seconds a request time stamp may differ from server time
+            max_rate: signed requests per second to remember signatures for, the cache holds
+                      max_rate * 2 * skew signatures
+        """
+        self.clients = dict((client, secret.encode('utf-8') if not isinstance(secret, bytes)
+                             else secret) for client, secret in clients.items())
+        self.skew = skew
+        self.max_nonces = max_rate * 2 * skew
+        self.nonces = OrderedDict()
+        self.lock = Lock()
+        self.counters = {'accepted': 0, 'rejected': 0, 'replayed': 0, 'overloaded': 0}
+
+    def signing_key(self, client, time_stamp):
+        """ Get the signing key for a client and time stamp. The key is derived for each request,
+            it changes every second so a cache would rarely hit.
+        Args:
+            client: client id
+            time_stamp: Unix time of the request
+        Return:
+            key or None for an unknown client
+        """
+        secret = self.clients.get(client)
+        if secret is None:
+            return None
+        return get_hmac_signing_key(secret, str(time_stamp))
+
+    def _count(self, outcome):
+        """ Increment an outcome counter
+        Args:
+            outcome: accepted, rejected, replayed or overloaded
+        """
+        with self.lock:
+            self.counters[outcome] += 1
+
+    def _first_use(self, signature, now):
+        """ Record a signature, expiring those older than the skew window
+        Args:
+            signature: request signature
+            now: current time
+        Return:
+            'accepted' if the signature has not been seen before, 'replayed' if it has, or
+            'overloaded' if the cache is full of signatures that have not expired
+        """
+        with self.lock:
+            while self.nonces:
+                oldest, seen = next(iter(self.nonces.items()))
+                if seen > now - 2 * self.skew:
+                    break
+                del self.nonces[oldest]
+            if signature in self.nonces:
+                return 'replayed'
+            if len(self.nonces) >= self.max_nonces:
+                return 'overloaded'
+            self.nonces[signature] = now
+            return 'accepted'
+
+    def authenticate(self, method, path, params, authorization, date):
+        """ Authenticate a signed request
+        Args:
+            method: HTTP method
+            path: request path
+            params: request body for POST/PUT/PATCH, query string for GET/DELETE
+            authorization: Authorization header
+            date: X-Date header, Unix time of the request
+        Return:
+            client id or None if the request is not authenticated
+        """
+        match = AUTH_HEADER.match(authorization or '')
+        try:
+            time_stamp = int(date)
+        except (TypeError, ValueError):
+            match = None
+        now = time.time()
+        if match is None or abs(now - time_stamp) > self.skew:
+            self._count('rejected')
+            return None
+        client, signature = match.group(1), match.group(2).upper()
+        key = self.signing_key(client, time_stamp)
+        if key is None:
+            self._count('rejected')
+            return None
+        expected = base64.b16encode(
+            hmac_sha256(key, get_signed_request_message(method, path, params, time_stamp)))
+        if not bytes_eq(expected, signature.encode('ascii')):
+            self._count('rejected')
+            return None
+        outcome = self._first_use(signature, now)
+        self._count(outcome)
+        return client if outcome == 'accepted' else None
+
+    def authenticate_request(self, request):
+        """ Authenticate a Flask request
+        Args:
+            request: Flask request
+        Return:
+            client id or None if the request is not authenticated
+        """
+        if request.method in ('POST', 'PUT', 'PATCH'):
+            params = request.get_data()
+        else:
+            params = request.query_string
+        return self.authenticate(request.method, request.path, params,
+                                 request.headers.get('Authorization'),
+                                 request.headers.get(DATE_HEADER))
+
+    def stats(self):
+        """ Get outcome counters and the replay cache size
+        Return:
+            dict of statistics
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats['nonces'] = len(self.nonces)
+        return stats
+
+def main():
+    """ Unit tests
+    """
+    auth = SignedRequestAuth({'importer': 'Poyj3ZIdLcSEjWagFBj3VQ9x'})
+    body = '{"recipe": "Korean Short Ribs"}'
+    headers = signed_headers('importer', 'Poyj3ZIdLcSEjWagFBj3VQ9x', 'POST', '/api/recipe.post',
+                             body)
+    print(headers)
+    print(auth.authenticate('POST', '/api/recipe.post', body, headers['Authorization'],
+                            headers[DATE_HEADER]))
+    print(auth.authenticate('POST', '/api/recipe.post', body, headers['Authorization'],
+                            headers[DATE_HEADER]))
+    print(auth.authenticate('POST', '/api/recipe.post', body + ' ', headers['Authorization'],
+                            headers[DATE_HEADER]))
+    print(auth.stats())
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,8 @@ from datetime import datetime
 import hashlib
 import hmac
 import json
+from threading import Lock
+import time
 import boto3
 from botocore.exceptions import ClientError
 import pytz
@@ -21,6 +23,60 @@ from utils import preset_password
 
 CONFIG_DNS_TTL = 60 # TTL (Time To Live) in seconds tells DNS servers how long to cache
 CONFIG_DNS_TYPE = 'A' # A record
+DYNAMODB_BATCH_LIMIT = 100 # Maximum keys per BatchGetItem request
+SES_BULK_LIMIT = 50 # Maximum destinations per SendBulkTemplatedEmail request
+
+CLIENTS = {}
+CLIENTS_LOCK = Lock()
+CALL_HOOKS = []
+
+def add_call_hook(hook):
+    """ Add a function called after every AWS API call, e.g. to measure database time
+    Args:
+        hook: function(service, operation, seconds), called in the thread making the call
+    """
+    CALL_HOOKS.append(hook)
+
+def _before_call(model, context, **kwargs):
+    """ botocore before-call handler, note the operation and start time of the call
+    """
+    context['call_start'] = (model.service_model.service_name, model.name, time.time())
+
+def _after_call(context, **kwargs):
+    """ botocore after-call and after-call-error handler, report the call to the hooks
+    """
+    start = context.pop('call_start', None)
+    if start is not None:
+        service, operation, started = start
+        for hook in CALL_HOOKS:
+            hook(service, operation, time.time() - started)
+
+def register_call_hooks(client):
+    """ Report the API calls of a boto3 client to the call hooks
+    Args:
+        client: boto3 client
+    """
+    client.meta.events.register('before-call', _before_call)
+    client.meta.events.register('after-call', _after_call)
+    client.meta.events.register('after-call-error', _after_call)
+
+def get_client(service):
+    """ Get a shared boto3 client for a service, clients are thread safe and reusing one keeps
+        its HTTPS connection pool warm
+    Args:
+        service: AWS service name, e.g. 'sns'
+    Return:
+        boto3 client
+    """
+    client = CLIENTS.get(service)
+    if client is None:
+        with CLIENTS_LOCK:
+            client = CLIENTS.get(service)
+            if client is None:
+                client = boto3.client(service)
+                register_call_hooks(client)
+                CLIENTS[service] = client
+    return client
 
 
 class DynamoDB(object):
@@ -33,6 +89,7 @@ class DynamoDB(object):
             table_name: name of the database table
         """
         self.dynamodb = boto3.resource('dynamodb')
+        register_call_hooks(self.dynamodb.meta.client)
         self.config = config
         self.table_name = table_name
         self.table = self.dynamodb.Table(table_name)
@@ -112,6 +169,39 @@ class DynamoDB(object):
         except (ClientError, KeyError) as err:
             return {'error': err.message}
 
+    def batch_get_items(self, key, values, retries=3, backoff=0.05):
+        """ Get many items from the table with batched reads. Unprocessed keys are retried
+            with exponential backoff.
+        Args:
+            key: table primary key, e.g. 'id'
+            values: list of primary key values to match
+            retries: number of times to retry unprocessed keys
+            backoff: seconds to wait before the first retry, doubled for each retry
+        Return:
+            dict of items by primary key value, missing items are left out, or error if
+            keys were still unprocessed after the retries
+        """
+        items = {}
+        values = list(set(values))
+        for start in range(0, len(values), DYNAMODB_BATCH_LIMIT):
+            request = {self.table_name: {'Keys': [{key: value} for value in
+                                                  values[start:start + DYNAMODB_BATCH_LIMIT]]}}
+            attempts = 0
+            while request:
+                if attempts > retries:
+                    return {'error': 'Unprocessed keys after {} retries'.format(retries)}
+                if attempts:
+                    time.sleep(backoff * 2 ** (attempts - 1))
+                try:
+                    response = self.dynamodb.batch_get_item(RequestItems=request)
+                except ClientError as err:
+                    return {'error': err.message}
+                for item in response['Responses'].get(self.table_name, []):
+                    items[item[key]] = item
+                request = response.get('UnprocessedKeys')
+                attempts += 1
+        return items
+
     def put_item(self, value):
         """ Create or replace an item in the table.
         Args:
@@ -151,6 +241,30 @@ class DynamoDB(object):
         except (ClientError, KeyError) as err:
             return {'error': err.message}
 
+    def conditional_update_item(self, key, kvalue, field, fvalue, expected):
+        """ Update an item field only if it still has the expected value, so that a read,
+            check and write sequence can't be interleaved with another writer
+        Args:
+            key: table primary key, e.g. 'id'
+            kvalue: primary key value to match
+            field: item field
+            fvalue: new field value
+            expected: value the field must have for the update to be made
+        Return:
+            dict, with 'conflict' set if the field no longer had the expected value
+        """
+        try:
+            self.table.update_item(Key={key: kvalue},
+                                   UpdateExpression="SET " + field + " = :f",
+                                   ConditionExpression=field + " = :e",
+                                   ExpressionAttributeValues={':f': fvalue, ':e': expected},
+                                   ReturnValues="NONE")
+            return {'message': 'Item updated'}
+        except ClientError as err:
+            if err.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                return {'error': 'Item changed', 'conflict': True}
+            return {'error': err.message}
+
     def load_table(self, infile):
         """ Load json data from a file into table.
         {
@@ -202,7 +316,7 @@ class SES(object):
         Args:
             email_address: senders email address
         """
-        self.ses = boto3.client('ses')
+        self.ses = get_client('ses')
         self.email_address = email_address
 
     def send_email(self, to_list, subject, html, text):
@@ -241,16 +355,61 @@ class SES(object):
         )
         print(response)
 
+    def put_template(self, name, subject, html, text):
+        """ Create or update an email template for bulk sending. Replacement tags use the
+            {{name}} syntax and are filled in from each destination's template data.
+        Args:
+            name: template name
+            subject: subject line
+            html: HTML formatted message
+            text: Plain text message
+        """
+        template = {'TemplateName': name, 'SubjectPart': subject,
+                    'HtmlPart': html, 'TextPart': text}
+        try:
+            self.ses.update_template(Template=template)
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'TemplateDoesNotExist':
+                raise
+            self.ses.create_template(Template=template)
+
+    def send_bulk_templated_email(self, name, destinations, default_data=None):
+        """ Send a templated email to many recipients
+        Args:
+            name: template name
+            destinations: list of {'recipient': address, 'data': dict of replacement values}
+            default_data: replacement values for destinations missing them
+        Return:
+            list of per destination status, {'Status': 'Success', 'MessageId': id} or
+            {'Status': failure, 'Error': message}, in the order of destinations
+        """
+        status = []
+        for start in range(0, len(destinations), SES_BULK_LIMIT):
+            response = self.ses.send_bulk_templated_email(
+                Source=self.email_address,
+                Template=name,
+                DefaultTemplateData=json.dumps(default_data or {}),
+                Destinations=[{
+                    'Destination': {'ToAddresses': [destination['recipient']]},
+                    'ReplacementTemplateData': json.dumps(destination.get('data', {}))
+                } for destination in destinations[start:start + SES_BULK_LIMIT]]
+            )
+            status.extend(response['Status'])
+        return status
+
 
 class SNS(object):
     """ Utility class for access to AWS SNS.
     """
-    def __init__(self, topic_name):
+    def __init__(self, topic_name=None, sender_id=None):
         """ Constructor, get AWS resource
         Args:
             topic_name: name of the topic
+            sender_id: optional SMS sender id shown on the recipient's phone
         """
         self.sns = boto3.resource('sns')
+        self.client = get_client('sns')
+        self.sender_id = sender_id
         self.topic = None
         if topic_name is not None:
             try:
@@ -285,8 +444,14 @@ class SNS(object):
             number: phone number (e.g. '+17702233322')
             message: text
         """
+        attributes = {'AWS.SNS.SMS.SMSType': {'DataType': 'String',
+                                              'StringValue': 'Transactional'}}
+        if self.sender_id:
+            attributes['AWS.SNS.SMS.SenderID'] = {'DataType': 'String',
+                                                  'StringValue': self.sender_id}
         try:
-            response = self.sns.publish(PhoneNumber=number, Message=message)
+            response = self.client.publish(PhoneNumber=number, Message=message,
+                                           MessageAttributes=attributes)
             return response
         except ClientError as err:
             return {'error': err.message}
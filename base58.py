@@ -0,0 +1,263 @@
+#!/usr/bin python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2021 Alan Frost, Inc. All rights reserved.
+
+Bitcoin compatible base58 encoding
+"""
+
+from __future__ import print_function
+
+import binascii
+import hashlib
+import os
+import struct
+import sys
+import time
+
+if sys.version_info.major == 3:
+    unicode = str
+
+ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+
+# Digits are converted CHUNK at a time, so the big integer is divided or multiplied once per
+# chunk rather than once per digit
+CHUNK = 10
+CHUNK_BASE = 58 ** CHUNK
+
+# Two digit strings for 0 - 3363, so small numbers are encoded two digits per divmod
+PAIRS = [first + second for first in ALPHABET for second in ALPHABET]
+
+# Digit values by character code, -1 for characters not in the alphabet
+DECODE_TABLE = [-1] * 256
+for _index, _char in enumerate(ALPHABET):
+    DECODE_TABLE[ord(_char)] = _index
+
+def encode_int(number, default_one=True):
+    """ Encode an integer using base58
+    Args:
+        number: non negative integer to encode
+        default_one: return '1' rather than '' for zero
+    Return:
+        base58 encoded string
+    """
+    if not number:
+        return ALPHABET[0] if default_one else ''
+    pairs = PAIRS
+    encoded = ''
+    while number >= 58:
+        number, idx = divmod(number, 3364)
+        encoded = pairs[idx] + encoded
+    if number:
+        encoded = ALPHABET[number] + encoded
+    return encoded
+
+def _encode_chunk(number):
+    """ Encode a number less than CHUNK_BASE as exactly CHUNK digits
+    Args:
+        number: integer
+    Return:
+        base58 string of CHUNK characters
+    """
+    pairs = PAIRS
+    encoded = []
+    for _ in range(CHUNK // 2):
+        number, idx = divmod(number, 3364)
+        encoded.append(pairs[idx])
+    return ''.join(reversed(encoded))
+
+def encode(source):
+    """ Encode bytes using base58, each leading zero byte is encoded as '1'
+    Args:
+        source: bytes to encode
+    Return:
+        base58 encoded string
+    """
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    elif not isinstance(source, (bytes, bytearray)):
+        raise TypeError("a bytes-like object is required, not '%s'" % type(source).__name__)
+
+    stripped = source.lstrip(b'\0')
+    pad = len(source) - len(stripped)
+    if not stripped:
+        return ALPHABET[0] * pad
+    if len(stripped) <= 8:
+        number = struct.unpack('>Q', stripped.rjust(8, b'\0'))[0]
+    else:
+        number = int(binascii.hexlify(stripped), 16)
+    if len(stripped) <= 16:
+        return ALPHABET[0] * pad + encode_int(number, default_one=False)
+    chunks = []
+    while number >= CHUNK_BASE:
+        number, chunk = divmod(number, CHUNK_BASE)
+        chunks.append(_encode_chunk(chunk))
+    chunks.append(encode_int(number, default_one=False))
+    return ALPHABET[0] * pad + ''.join(reversed(chunks))
+
+def decode_int(source):
+    """ Decode a base58 encoded string as an integer
+    Args:
+        source: string to decode
+    Return:
+        integer value
+    """
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    table = DECODE_TABLE
+    digits = bytearray(source)
+    end = len(digits) % CHUNK or CHUNK
+    start, scale = 0, 58 ** end
+    number = 0
+    while start < len(digits):
+        chunk = 0
+        for char in digits[start:end]:
+            value = table[char]
+            if value < 0:
+                raise ValueError("Invalid base58 character '%s'" % chr(char))
+            chunk = chunk * 58 + value
+        number = number * scale + chunk
+        start, end, scale = end, end + CHUNK, CHUNK_BASE
+    return number
+
+def decode(source):
+    """ Decode a base58 encoded string
+    Args:
+        source: string to decode
+    Return:
+        bytes
+    """
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    elif not isinstance(source, (bytes, bytearray)):
+        raise TypeError("a string is required, not '%s'" % type(source).__name__)
+
+    stripped = source.lstrip(ALPHABET[0].encode('ascii'))
+    pad = len(source) - len(stripped)
+    number = decode_int(stripped)
+    if not number:
+        return b'\0' * pad
+    hexed = '%x' % number
+    if len(hexed) % 2:
+        hexed = '0' + hexed
+    return b'\0' * pad + binascii.unhexlify(hexed)
+
+def encode_check(source):
+    """ Encode bytes using base58 with a 4 byte checksum
+    Args:
+        source: bytes to encode
+    Return:
+        base58 encoded string
+    """
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    digest = hashlib.sha256(hashlib.sha256(source).digest()).digest()
+    return encode(source + digest[:4])
+
+def decode_check(source):
+    """ Decode and verify the checksum of a base58 encoded string
+    Args:
+        source: string to decode
+    Return:
+        bytes
+    """
+    result = decode(source)
+    result, check = result[:-4], result[-4:]
+    digest = hashlib.sha256(hashlib.sha256(result).digest()).digest()
+    if check != digest[:4]:
+        raise ValueError("Invalid checksum")
+    return result
+
+def encode_many(sources):
+    """ Encode a list of byte strings
+    Args:
+        sources: list of bytes
+    Return:
+        list of base58 encoded strings
+    """
+    return [encode(source) for source in sources]
+
+def decode_many(sources):
+    """ Decode a list of base58 encoded strings
+    Args:
+        sources: list of strings
+    Return:
+        list of bytes
+    """
+    return [decode(source) for source in sources]
+
+def encode_ints(numbers):
+    """ Encode a list of integers
+    Args:
+        numbers: list of non negative integers
+    Return:
+        list of base58 encoded strings
+    """
+    return [encode_int(number) for number in numbers]
+
+def random_ids(count, size=8):
+    """ Generate random base58 ids from a single read of the random source
+    Args:
+        count: number of ids
+        size: length of each id
+    Return:
+        list of ids
+    """
+    data = os.urandom(count * size)
+    return [encode(data[start:start + size])[0:size] for start in range(0, count * size, size)]
+
+def legacy_encode(source):
+    """ Byte at a time encoding, the reference for the benchmark
+    """
+    stripped = source.lstrip(b'\0')
+    number = 0
+    for char in bytearray(stripped):
+        number = number * 256 + char
+    encoded = ''
+    while number:
+        number, idx = divmod(number, 58)
+        encoded = ALPHABET[idx] + encoded
+    return ALPHABET[0] * (len(source) - len(stripped)) + encoded
+
+def legacy_decode(source):
+    """ Character at a time decoding, the reference for the benchmark
+    """
+    stripped = source.lstrip(ALPHABET[0])
+    number = 0
+    for char in stripped:
+        number = number * 58 + ALPHABET.index(char)
+    result = bytearray()
+    while number:
+        number, mod = divmod(number, 256)
+        result.append(mod)
+    result.reverse()
+    return b'\0' * (len(source) - len(stripped)) + bytes(result)
+
+def main():
+    """ Unit tests and benchmark
+    """
+    for source in [b'', b'\0', b'\0\0abc', b'hello world', os.urandom(8), os.urandom(1024)]:
+        encoded = encode(source)
+        assert encoded == legacy_encode(source)
+        assert decode(encoded) == source == legacy_decode(encoded)
+    for number in [0, 1, 57, 58, 3363, 3364, 2 ** 32 - 1, 2 ** 200]:
+        assert decode_int(encode_int(number)) == number
+    assert decode_check(encode_check(b'secret code')) == b'secret code'
+    print(encode(b'hello world'), random_ids(3))
+
+    for size, count in [(8, 20000), (1024, 200)]:
+        data = [os.urandom(size) for _ in range(count)]
+        for name, encoder, decoder in [('legacy', legacy_encode, legacy_decode),
+                                       ('base58', encode, decode)]:
+            start = time.time()
+            encoded = [encoder(source) for source in data]
+            middle = time.time()
+            for text in encoded:
+                decoder(text)
+            end = time.time()
+            print('{} {} bytes: encode {:.1f} usec, decode {:.1f} usec'.format(
+                name, size, (middle - start) * 1e6 / count, (end - middle) * 1e6 / count))
+
+if __name__ == '__main__':
+    main()
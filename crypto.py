@@ -9,18 +9,30 @@ Crypto functions
 
 
 import base64
+import hashlib
+import hmac
+import multiprocessing
 import os
+import struct
+import time
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeout
 from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.ciphers import (Cipher, algorithms, modes)
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives import hashes, hmac
+from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.concatkdf import ConcatKDFHash
-from cryptography.exceptions import InvalidTag, InvalidKey, InvalidSignature
+from cryptography.exceptions import InvalidTag, InvalidKey, InvalidSignature, UnsupportedAlgorithm
 from cryptography.hazmat.backends import default_backend
 
+# Current key derivation scheme and cost for new password hashes, see set_kdf and calibrate_kdf
+KDF_SCHEME = 'pbkdf2'
+KDF_COST = {'pbkdf2': 100000, 'scrypt': 2**14}
+KDF_MINIMUM = {'pbkdf2': 100000, 'scrypt': 2**14}
+
 def derive_key(password, mcf='', bits=256):
     """ Derive key using PBKDF2 (Password-Based Key Derivation Function2, PKCS #5 v2.0)
         Accepts MCF format $pbkdf2$100000$salt$keydata for validation
@@ -37,7 +49,7 @@ def derive_key(password, mcf='', bits=256):
         password = password.encode('utf-8')
     key = ''
     salt = ''
-    iterations = 100000
+    iterations = KDF_COST['pbkdf2']
     # Derive key
     if not mcf:
         salt = os.urandom(16) # NIST SP 800-132 recommends 128-bits or longer
@@ -54,7 +66,7 @@ def derive_key(password, mcf='', bits=256):
         fields = mcf.split('$')
         if len(fields) > 4 and fields[1] == 'pbkdf2':
             if not fields[2]:
-                iterations = 100000
+                iterations = KDF_COST['pbkdf2']
             else:
                 iterations = int(fields[2])
             if not fields[3]:
@@ -80,16 +92,25 @@ def derive_key(password, mcf='', bits=256):
     return '$pbkdf2$' + str(iterations) + '$' + base64.b64encode(salt) + '$' + base64.b64encode(key)
 
 def scrypt_key(password, mcf='', bits=512):
-    """
+    """ Derive key using scrypt
         RFC 7914 recommends values of r=8 and p=1 while scaling n as appropriate for your system.
         The scrypt paper suggests a minimum value of n=2**14 for interactive logins (t < 100ms),
         or n=2**20 for more sensitive files (t < 5s).
+        Accepts MCF format $scrypt$16384$salt$keydata for validation
+        Use $scrypt$16384$salt$$ for key generation with specific cost and/or salt
+        Returns MCF for successful validation (or creation), returns '' for error
+    Args:
+        user password
+        MCF formatted value, leave off or empty to create initial
+        bits in key, when validating the length of the stored key is used
+    Return:
+        MCF formatted value
     """
     if isinstance(password, unicode):
         password = password.encode('utf-8')
+    cost = KDF_COST['scrypt']
     if not mcf:
         salt = os.urandom(16) # NIST SP 800-132 recommends 128-bits or longer
-        cost = 2**14
         kdf = Scrypt(
             salt=salt,
             length=bits/8,
@@ -103,28 +124,238 @@ def scrypt_key(password, mcf='', bits=512):
     elif mcf[0] == '$':
         fields = mcf.split('$')
         if len(fields) > 4 and fields[1] == 'scrypt':
-            if not fields[2]:
-                cost = 2**14
-            else:
+            if fields[2]:
                 cost = int(fields[2])
             if not fields[3]:
                 salt = os.urandom(16)
             else:
                 salt = base64.b64decode(fields[3])
+            value = base64.b64decode(fields[4]) if len(fields[4]) > 20 else None
             kdf = Scrypt(
                 salt=salt,
-                length=bits/8,
+                length=len(value) if value else bits/8,
                 n=cost,
                 r=8,
                 p=1,
                 backend=default_backend()
             )
-            try:
-                kdf.verify(password, base64.b64decode(fields[4]))
-            except InvalidKey:
-                return ''
+            if value:
+                try:
+                    kdf.verify(password, value)
+                except InvalidKey:
+                    return ''
+                key = value
+            else:
+                key = kdf.derive(password)
+        else:
+            return ''
+    else:
+        return ''
     return '$scrypt$' + str(cost) + '$' + base64.b64encode(salt) + '$' + base64.b64encode(key)
 
+def hash_password(password, mcf='', scheme=None, cost=None):
+    """ Derive or verify a password hash with the scheme named in the MCF value, or create one
+        with the current (or specified) scheme and cost when no MCF value is given
+    Args:
+        user password
+        MCF formatted value, leave off or empty to create initial
+        scheme: 'pbkdf2' or 'scrypt' for a new hash
+        cost: iterations for pbkdf2 or n for scrypt for a new hash
+    Return:
+        MCF formatted value, '' for error
+    """
+    if mcf:
+        if mcf.startswith('$scrypt$'):
+            return scrypt_key(password, mcf)
+        return derive_key(password, mcf)
+    scheme = scheme or KDF_SCHEME
+    cost = cost or KDF_COST[scheme]
+    if scheme == 'scrypt':
+        return scrypt_key(password, '$scrypt$' + str(cost) + '$$')
+    return derive_key(password, '$pbkdf2$' + str(cost) + '$$')
+
+def set_kdf(scheme, cost=None):
+    """ Set the scheme and cost used for new password hashes
+    Args:
+        scheme: 'pbkdf2' or 'scrypt'
+        cost: iterations for pbkdf2 or n for scrypt, never below the minimum
+    """
+    global KDF_SCHEME
+    if scheme not in KDF_COST:
+        raise ValueError('Unsupported key derivation scheme: ' + str(scheme))
+    KDF_SCHEME = scheme
+    if cost:
+        KDF_COST[scheme] = max(int(cost), KDF_MINIMUM[scheme])
+
+def calibrate_kdf(target_ms=100, scheme='pbkdf2'):
+    """ Benchmark this host and pick the cost for a target password verification time
+    Args:
+        target_ms: target time in milliseconds for one derivation
+        scheme: 'pbkdf2' or 'scrypt'
+    Return:
+        cost: iterations for pbkdf2 (multiple of 1000) or n for scrypt (power of 2), or None
+              if the scheme is not supported by the backend
+    """
+    password = os.urandom(32)
+    salt = os.urandom(16)
+    try:
+        if scheme == 'scrypt':
+            sample = 2**12
+            start = time.time()
+            Scrypt(salt=salt, length=64, n=sample, r=8, p=1,
+                   backend=default_backend()).derive(password)
+            elapsed = max(time.time() - start, 1e-6)
+            cost = sample
+            # scrypt time grows linearly with n, step up while the estimate is under target
+            while elapsed * (cost * 2) / sample * 1000 <= target_ms:
+                cost *= 2
+        else:
+            sample = 20000
+            start = time.time()
+            PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=sample,
+                       backend=default_backend()).derive(password)
+            elapsed = max(time.time() - start, 1e-6)
+            cost = int(sample * target_ms / (elapsed * 1000)) // 1000 * 1000
+    except UnsupportedAlgorithm:
+        return None
+    return max(cost, KDF_MINIMUM[scheme])
+
+def needs_rehash(mcf):
+    """ Check if a password hash uses an older scheme or a lower cost than the current one
+    Args:
+        MCF formatted value
+    Return:
+        True if the hash should be upgraded at the next successful login
+    """
+    fields = mcf.split('$') if mcf else []
+    if len(fields) < 5 or fields[1] not in KDF_COST:
+        return False
+    if fields[1] != KDF_SCHEME:
+        return True
+    try:
+        return int(fields[2]) < KDF_COST[KDF_SCHEME]
+    except ValueError:
+        return True
+
+class PasswordHasher(object):
+    """ Run password key derivation on a dedicated pool of worker processes, so that PBKDF2 does
+        not hold up request threads. Requests beyond the queue limit are rejected immediately.
+    """
+    def __init__(self, workers=None, max_pending=None):
+        """ Constructor, the process pool is created on first use so that each forked server
+            process gets its own
+        Args:
+            workers: number of processes, defaults to the number of cores, 0 to run inline
+            max_pending: maximum derivations queued or running before rejecting new ones
+        """
+        self.workers = multiprocessing.cpu_count() if workers is None else workers
+        self.max_pending = max_pending or max(self.workers, 1) * 4
+        self._executor = None
+        self._lock = Lock()
+        self._pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._total_time = 0.0
+        self._max_time = 0.0
+
+    def _get_executor(self):
+        """ Get the process pool, creating it if needed
+        Return:
+            ProcessPoolExecutor
+        """
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def _done(self, started):
+        """ Record the completion of a derivation
+        Args:
+            started: time the derivation was submitted
+        """
+        elapsed = time.time() - started
+        with self._lock:
+            self._pending -= 1
+            self._completed += 1
+            self._total_time += elapsed
+            if elapsed > self._max_time:
+                self._max_time = elapsed
+
+    def busy(self):
+        """ Check if the queue is full, to reject a request before doing any other work
+        Return:
+            True if new derivations would be rejected
+        """
+        return self._pending >= self.max_pending
+
+    def submit(self, password, mcf=''):
+        """ Submit a hash_password call to the pool, new hashes use the scheme and cost that
+            are current in this process
+        Args:
+            user password
+            MCF formatted value, leave off or empty to create initial
+        Return:
+            Future for the MCF formatted value, or None if the queue is full
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._rejected += 1
+                return None
+            self._pending += 1
+        started = time.time()
+        try:
+            future = self._get_executor().submit(hash_password, password, mcf, KDF_SCHEME,
+                                                 KDF_COST[KDF_SCHEME])
+        except RuntimeError:
+            self._done(started)
+            return None
+        future.add_done_callback(lambda future: self._done(started))
+        return future
+
+    def derive(self, password, mcf='', timeout=10):
+        """ Derive or verify a key on the pool and wait for the result
+        Args:
+            user password
+            MCF formatted value, leave off or empty to create initial
+            timeout: seconds to wait for the result
+        Return:
+            MCF formatted value, '' for a failed match, or None if busy or timed out
+        """
+        if self.workers == 0:
+            return hash_password(password, mcf)
+        future = self.submit(password, mcf)
+        if future is None:
+            return None
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            return None
+
+    def stats(self):
+        """ Get queue depth and timing
+        Return:
+            dict of statistics
+        """
+        with self._lock:
+            completed = self._completed
+            return {'workers': self.workers,
+                    'pending': self._pending,
+                    'completed': completed,
+                    'rejected': self._rejected,
+                    'avg_time': self._total_time / completed if completed else 0.0,
+                    'max_time': self._max_time}
+
+    def shutdown(self, wait=True):
+        """ Stop the worker processes
+        Args:
+            wait: True to wait for pending derivations
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
 def hkdf_key(key, info, salt=None):
     """ HKDF (HMAC-based Extract-and-Expand Key Derivation Function)
     Args:
@@ -145,6 +376,9 @@ def hkdf_key(key, info, salt=None):
     )
     return hkdf.derive(key)
 
+PUBLIC_KEYS = {}
+PUBLIC_KEYS_LIMIT = 1024
+
 def generate_ec(curve=ec.SECP256R1()):
     """ Generate an EC keypair with a default curve NIST P-256
     Args:
@@ -168,16 +402,22 @@ def get_ec_public(ec_key):
     return pem
 
 def load_ec_public(pem):
-    """ Load EC public key from PEM
+    """ Load EC public key from PEM, parsed keys are cached
     Args:
         PEM format public key
     Return:
-        EC public key
+        EC public key or None
     """
-    try:
-        ec_key = serialization.load_pem_public_key(pem, backend=default_backend())
-    except ValueError as inst:
-        print inst
+    ec_key = PUBLIC_KEYS.get(pem)
+    if ec_key is None:
+        try:
+            ec_key = serialization.load_pem_public_key(pem, backend=default_backend())
+        except ValueError as inst:
+            print inst
+            return None
+        if len(PUBLIC_KEYS) >= PUBLIC_KEYS_LIMIT:
+            PUBLIC_KEYS.clear()
+        PUBLIC_KEYS[pem] = ec_key
     return ec_key
 
 def load_ec_private(pem, password=None):
@@ -213,7 +453,7 @@ def encrypt_ecdh(ec_key, pub_pem, payload, other_info):
     Return:
         Encrypted payload
     """
-    peer_public_key = serialization.load_pem_public_key(pub_pem, backend=default_backend())
+    peer_public_key = load_ec_public(pub_pem)
     secret = compute_ecdh_secret(ec_key, peer_public_key)
     ckdf = ConcatKDFHash(
         algorithm=hashes.SHA256(), length=32, otherinfo=other_info, backend=default_backend())
@@ -232,12 +472,12 @@ def decrypt_ecdh(ec_key, pub_pem, payload, other_info):
     Return:
         Decrypted payload
     """
-    peer_public_key = serialization.load_pem_public_key(pub_pem, backend=default_backend())
+    peer_public_key = load_ec_public(pub_pem)
     secret = compute_ecdh_secret(ec_key, peer_public_key)
     ckdf = ConcatKDFHash(
         algorithm=hashes.SHA256(), length=32, otherinfo=other_info, backend=default_backend())
     key = ckdf.derive(secret)
-    plaintext = decrypt_aes_gcm(key, payload[:12], payload[12:])
+    plaintext = decrypt_aes_gcm(key, payload[:12], payload[12:], other_info)
     return plaintext
 
 def sign_ecdsa(ec_key, message):
@@ -248,10 +488,7 @@ def sign_ecdsa(ec_key, message):
     Return:
         signature
     """
-    signer = ec_key.signer(ec.ECDSA(hashes.SHA256()))
-    signer.update(message)
-    signature = signer.finalize()
-    return signature
+    return ec_key.sign(message, ec.ECDSA(hashes.SHA256()))
 
 def verify_ecdsa(ec_key, signature, message):
     """ Use ECDSA to verify signed message
@@ -263,14 +500,193 @@ def verify_ecdsa(ec_key, signature, message):
         true if verification succeeds
     """
     try:
-        verifier = ec_key.verifier(signature, ec.ECDSA(hashes.SHA256()))
-        verifier.update(message)
-        ret = verifier.verify()
-        return ret
-    except InvalidSignature as inst:
-        print inst
+        ec_key.verify(signature, message, ec.ECDSA(hashes.SHA256()))
+        return True
+    except InvalidSignature:
         return False
 
+class ECKeyring(object):
+    """ EC keyring for talking to many peers. Peer public keys are parsed once and looked up by
+        fingerprint, and ECDH derived keys are reused per peer until they expire.
+    """
+    def __init__(self, ec_key=None, ttl=300, workers=4):
+        """ Constructor
+        Args:
+            ec_key: my private key, generated if not provided
+            ttl: seconds to reuse an ECDH derived key
+            workers: threads used for batch verification
+        """
+        self.ec_key = ec_key or generate_ec()
+        self.ttl = ttl
+        self.workers = workers
+        self.keys = {}
+        self.fingerprints = {}
+        self.secrets = {}
+        self.lock = Lock()
+        self._executor = None
+
+    def add(self, pem):
+        """ Add a peer public key
+        Args:
+            pem: PEM format public key
+        Return:
+            fingerprint, hex SHA-256 of the DER public key, or None if the key is invalid
+        """
+        fingerprint = self.fingerprints.get(pem)
+        if fingerprint is None:
+            public_key = load_ec_public(pem)
+            if public_key is None:
+                return None
+            der = public_key.public_bytes(encoding=serialization.Encoding.DER,
+                                          format=serialization.PublicFormat.SubjectPublicKeyInfo)
+            fingerprint = hashlib.sha256(der).hexdigest()
+            with self.lock:
+                self.keys[fingerprint] = public_key
+                self.fingerprints[pem] = fingerprint
+        return fingerprint
+
+    def remove(self, fingerprint):
+        """ Remove a peer public key and any derived keys
+        Args:
+            fingerprint
+        """
+        with self.lock:
+            self.keys.pop(fingerprint, None)
+            for pem in [pem for pem, value in self.fingerprints.items() if value == fingerprint]:
+                del self.fingerprints[pem]
+            for key in [key for key in self.secrets if key[0] == fingerprint]:
+                del self.secrets[key]
+
+    def lookup(self, peer):
+        """ Get a peer fingerprint and public key
+        Args:
+            peer: fingerprint or PEM format public key
+        Return:
+            (fingerprint, EC public key), the key is None if the peer is unknown
+        """
+        public_key = self.keys.get(peer)
+        if public_key is not None:
+            return peer, public_key
+        pem = peer if isinstance(peer, bytes) else peer.encode('utf-8')
+        if not pem.startswith(b'-----BEGIN'):
+            return peer, None
+        fingerprint = self.add(peer)
+        return fingerprint, self.keys.get(fingerprint)
+
+    def public_key(self, peer):
+        """ Get a peer public key
+        Args:
+            peer: fingerprint or PEM format public key
+        Return:
+            EC public key or None
+        """
+        return self.lookup(peer)[1]
+
+    def shared_key(self, peer, other_info):
+        """ Get the AES key derived from the ECDH shared secret with a peer
+        Args:
+            peer: fingerprint or PEM format public key
+            other_info: application specific context information
+        Return:
+            32 byte key or None if the peer is unknown
+        """
+        fingerprint, public_key = self.lookup(peer)
+        if public_key is None:
+            return None
+        now = time.time()
+        cache_key = (fingerprint, other_info)
+        entry = self.secrets.get(cache_key)
+        if entry is None or entry[1] < now:
+            secret = compute_ecdh_secret(self.ec_key, public_key)
+            ckdf = ConcatKDFHash(algorithm=hashes.SHA256(), length=32, otherinfo=other_info,
+                                 backend=default_backend())
+            entry = (ckdf.derive(secret), now + self.ttl)
+            with self.lock:
+                expired = [key for key, value in self.secrets.items() if value[1] < now]
+                for key in expired:
+                    del self.secrets[key]
+                self.secrets[cache_key] = entry
+        return entry[0]
+
+    def encrypt(self, peer, payload, other_info):
+        """ Encrypt a payload for a peer, compatible with decrypt_ecdh
+        Args:
+            peer: fingerprint or PEM format public key
+            payload: bytes to encrypt
+            other_info: application specific context information
+        Return:
+            encrypted payload
+        Raises:
+            ValueError if the peer is unknown
+        """
+        key = self.shared_key(peer, other_info)
+        if key is None:
+            raise ValueError('Unknown peer')
+        nonce = os.urandom(12)
+        return nonce + encrypt_aes_gcm(key, nonce, payload, other_info)
+
+    def decrypt(self, peer, payload, other_info):
+        """ Decrypt a payload from a peer, compatible with encrypt_ecdh
+        Args:
+            peer: fingerprint or PEM format public key
+            payload: bytes to decrypt
+            other_info: application specific context information
+        Return:
+            decrypted payload or None, also for an unknown peer
+        """
+        key = self.shared_key(peer, other_info)
+        if key is None:
+            return None
+        return decrypt_aes_gcm(key, payload[:12], payload[12:], other_info)
+
+    def sign(self, message):
+        """ Sign a message with my private key
+        Args:
+            message
+        Return:
+            signature
+        """
+        return sign_ecdsa(self.ec_key, message)
+
+    def verify(self, peer, signature, message):
+        """ Verify a signed message from a peer
+        Args:
+            peer: fingerprint or PEM format public key
+            signature
+            message
+        Return:
+            True if the signature is valid
+        """
+        public_key = self.public_key(peer)
+        return public_key is not None and verify_ecdsa(public_key, signature, message)
+
+    def verify_batch(self, items):
+        """ Verify many signed messages, split into one slice per thread since OpenSSL runs
+            without the GIL
+        Args:
+            items: list of (peer, signature, message)
+        Return:
+            list of True or False in the same order
+        """
+        if len(items) < 2 or self.workers < 2:
+            return [self.verify(*item) for item in items]
+        if self._executor is None:
+            with self.lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        size = (len(items) + self.workers - 1) // self.workers
+        futures = [self._executor.submit(lambda part: [self.verify(*item) for item in part],
+                                         items[start:start + size])
+                   for start in range(0, len(items), size)]
+        return [result for future in futures for result in future.result()]
+
+    def shutdown(self):
+        """ Stop the verification threads
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
 def hash_sha1(message):
     """ Hash using SHA-1
     Args:
@@ -297,11 +713,32 @@ def hash_sha256(message):
     digest.update(message)
     return digest.finalize()
 
-def hmac_sha256(key, message):
+HMAC_STATES = {}
+HMAC_STATES_LIMIT = 256
+HMAC_STATES_LOCK = Lock()
+
+def hmac_state(key):
+    """ Get the HMAC-SHA256 object keyed with a long lived secret, created once per key so that
+        each HMAC only hashes the message. When the cache is full other keys are not cached.
+    Args:
+        key
+    Return:
+        hmac object to copy
+    """
+    state = HMAC_STATES.get(key)
+    if state is None:
+        state = hmac.new(key, digestmod=hashlib.sha256)
+        with HMAC_STATES_LOCK:
+            if len(HMAC_STATES) < HMAC_STATES_LIMIT:
+                HMAC_STATES[key] = state
+    return state
+
+def hmac_sha256(key, message, cache=False):
     """ HMAC using SHA-256
     Args:
         key
         message
+        cache: True for a long lived secret, to reuse its keyed state, never for per request keys
     Return:
         digest
     """
@@ -309,9 +746,11 @@ def hmac_sha256(key, message):
         key = key.encode('utf-8')
     if isinstance(message, unicode):
         message = message.encode('utf-8')
-    digest = hmac.HMAC(key, hashes.SHA256(), backend=default_backend())
+    if not cache:
+        return hmac.new(key, message, hashlib.sha256).digest()
+    digest = hmac_state(key).copy()
     digest.update(message)
-    return digest.finalize()
+    return digest.digest()
 
 def decrypt_aes_gcm(key, initial_value, cipher_text, aad=None):
     """ Decrypt using AES-GCM
@@ -323,17 +762,8 @@ def decrypt_aes_gcm(key, initial_value, cipher_text, aad=None):
     Return:
         (true, plain text)
     """
-
-    cipher = Cipher(
-        algorithms.AES(key),
-        modes.GCM(initial_value, cipher_text[-16:]),
-        backend=default_backend()
-    ).decryptor()
-    if aad:
-        cipher.authenticate_additional_data(aad)
     try:
-        plaintext = cipher.update(cipher_text[:-16]) + cipher.finalize()
-        return plaintext
+        return AESGCM(key).decrypt(initial_value, cipher_text, aad)
     except InvalidTag:
         print 'GCM decryption failed'
 
@@ -347,13 +777,139 @@ def encrypt_aes_gcm(key, initial_value, plain_text, aad=None):
     Return:
         cipher text
     """
+    return AESGCM(key).encrypt(initial_value, plain_text, aad)
 
-    cipher = Cipher(
-        algorithms.AES(key),
-        modes.GCM(initial_value),
-        backend=default_backend()
-    ).encryptor()
-    if aad:
-        cipher.authenticate_additional_data(aad)
-    ciphertext = cipher.update(plain_text) + cipher.finalize()
-    return ciphertext + cipher.tag
+# Streamed AES-GCM: a header of magic, segment size and a random 7 byte nonce prefix, then
+# segments of 4 byte length and cipher text. Each segment nonce is the prefix, a 4 byte
+# segment number and a final segment flag, so segments can't be reordered or truncated.
+STREAM_MAGIC = b'FWS1'
+STREAM_HEADER = struct.Struct('>4sI7s')
+STREAM_LENGTH = struct.Struct('>I')
+STREAM_FINAL = 0x80000000
+STREAM_SEGMENT = 64 * 1024
+
+AEAD_CACHE = {}
+AEAD_CACHE_LIMIT = 256
+
+class AEAD(object):
+    """ AES-256-GCM authenticated encryption with a key derived from a secret by HKDF
+    """
+    def __init__(self, key):
+        """ Constructor
+        Args:
+            key: 32 byte AES key
+        """
+        self.aesgcm = AESGCM(key)
+
+    def encrypt(self, plain_text, aad=None):
+        """ Encrypt with a random nonce
+        Args:
+            plain_text: bytes to encrypt
+            aad: optional additional authenticated data
+        Return:
+            nonce, cipher text and tag
+        """
+        nonce = os.urandom(12)
+        return nonce + self.aesgcm.encrypt(nonce, plain_text, aad)
+
+    def decrypt(self, cipher_text, aad=None):
+        """ Decrypt and authenticate
+        Args:
+            cipher_text: nonce, cipher text and tag
+            aad: optional additional authenticated data
+        Return:
+            plain text or None if authentication failed
+        """
+        try:
+            return self.aesgcm.decrypt(cipher_text[:12], cipher_text[12:], aad)
+        except InvalidTag:
+            print 'GCM decryption failed'
+
+    def encrypt_stream(self, source, target, segment_size=STREAM_SEGMENT, aad=None):
+        """ Encrypt a file in segments, so memory use does not depend on the file size
+        Args:
+            source: file object to read plain text from
+            target: file object to write cipher text to
+            segment_size: plain text bytes per segment
+            aad: optional additional authenticated data
+        Return:
+            number of plain text bytes encrypted
+        """
+        header = STREAM_HEADER.pack(STREAM_MAGIC, segment_size, os.urandom(7))
+        target.write(header)
+        aad = header + (aad or b'')
+        prefix = header[-7:]
+        total = 0
+        segment = 0
+        chunk = source.read(segment_size)
+        while True:
+            following = source.read(segment_size) if len(chunk) == segment_size else b''
+            final = not following
+            nonce = prefix + struct.pack('>IB', segment, final)
+            cipher_text = self.aesgcm.encrypt(nonce, chunk, aad)
+            target.write(STREAM_LENGTH.pack(len(cipher_text) | (STREAM_FINAL if final else 0)))
+            target.write(cipher_text)
+            total += len(chunk)
+            if final:
+                return total
+            chunk = following
+            segment += 1
+
+    def decrypt_stream(self, source, target, aad=None):
+        """ Decrypt a file encrypted by encrypt_stream. Plain text is written as each segment is
+            authenticated, so on failure the partial output must be discarded.
+        Args:
+            source: file object to read cipher text from
+            target: file object to write plain text to
+            aad: optional additional authenticated data
+        Return:
+            number of plain text bytes decrypted or None if the stream is invalid
+        """
+        header = source.read(STREAM_HEADER.size)
+        if len(header) != STREAM_HEADER.size:
+            return None
+        magic, segment_size, prefix = STREAM_HEADER.unpack(header)
+        if magic != STREAM_MAGIC:
+            return None
+        aad = header + (aad or b'')
+        total = 0
+        segment = 0
+        while True:
+            length = source.read(STREAM_LENGTH.size)
+            if len(length) != STREAM_LENGTH.size:
+                print 'GCM stream truncated'
+                return None
+            length = STREAM_LENGTH.unpack(length)[0]
+            final = bool(length & STREAM_FINAL)
+            length &= ~STREAM_FINAL
+            if length > segment_size + 16:
+                return None
+            nonce = prefix + struct.pack('>IB', segment, final)
+            try:
+                plain_text = self.aesgcm.decrypt(nonce, source.read(length), aad)
+            except InvalidTag:
+                print 'GCM decryption failed'
+                return None
+            target.write(plain_text)
+            total += len(plain_text)
+            if final:
+                return None if source.read(1) else total
+            segment += 1
+
+def get_aead(secret, info, salt):
+    """ Get the AEAD for a secret, the key is derived once per secret, info and salt
+    Args:
+        secret: key material
+        info: application specific context information
+        salt: HKDF salt
+    Return:
+        AEAD
+    """
+    key = (secret, info, salt)
+    aead = AEAD_CACHE.get(key)
+    if aead is None:
+        aead = AEAD(hkdf_key(secret, info, salt))
+        if len(AEAD_CACHE) >= AEAD_CACHE_LIMIT:
+            AEAD_CACHE.clear()
+        AEAD_CACHE[key] = aead
+    return aead
@@ -7,17 +7,173 @@ Copyright (c) 2017 Alan Frost, All rights reserved.
 Decorator utilities
 
 """
-from threading import Thread
+
+from __future__ import print_function
+
+import functools
+import logging
+import time
+from threading import Condition
+from concurrent.futures import ThreadPoolExecutor
+
+LOGGER = logging.getLogger("CyberFrosty")
+
+class TaskPool(object):
+    """ Bounded pool of worker threads for running functions asynchronously
+    """
+    def __init__(self, workers=4, queue_size=64, policy='block', timeout=5.0):
+        """ Constructor
+        Args:
+            workers: number of worker threads
+            queue_size: number of tasks allowed to wait for a worker
+            policy: 'block' to wait for room (backpressure) or 'drop' to discard the task
+            timeout: seconds to wait for room with the 'block' policy before dropping
+        """
+        self.workers = workers
+        self.capacity = workers + queue_size
+        self.policy = policy
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._cond = Condition()
+        self._closed = False
+        self._pending = 0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._dropped = 0
+        self._latency = 0.0
+        self._max_latency = 0.0
+
+    def _reserve(self):
+        """ Reserve a slot for a new task, waiting for room if the policy allows it
+        Return:
+            True if a slot was reserved
+        """
+        with self._cond:
+            deadline = time.time() + self.timeout
+            while self._pending >= self.capacity and not self._closed:
+                remaining = deadline - time.time()
+                if self.policy == 'drop' or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if self._closed or self._pending >= self.capacity:
+                self._dropped += 1
+                return False
+            self._pending += 1
+            self._submitted += 1
+            return True
+
+    def _release(self, queued_at, failed):
+        """ Release a task slot and record latency and failure counts
+        Args:
+            queued_at: time the task was submitted
+            failed: True if the task raised an exception
+        """
+        latency = time.time() - queued_at
+        with self._cond:
+            self._pending -= 1
+            self._completed += 1
+            if failed:
+                self._failed += 1
+            self._latency += latency
+            if latency > self._max_latency:
+                self._max_latency = latency
+            self._cond.notify()
+
+    def submit(self, func, *args, **kwargs):
+        """ Submit a function to run on a worker thread
+        Args:
+            func: function to run
+            args, kwargs: arguments for function call
+        Return:
+            Future for the result, or None if the task was dropped
+        """
+        if not self._reserve():
+            LOGGER.error('Task pool full, dropped %s', getattr(func, '__name__', func))
+            return None
+        queued_at = time.time()
+
+        def run():
+            """ Run the task and account for it whether or not it succeeds
+            """
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            except Exception as err:
+                LOGGER.error('Task %s failed: %s', getattr(func, '__name__', func), err)
+                raise
+            finally:
+                self._release(queued_at, failed)
+
+        try:
+            return self._executor.submit(run)
+        except RuntimeError:
+            # Executor was shut down between the reservation and the submit
+            self._release(queued_at, True)
+            return None
+
+    def stats(self):
+        """ Get task counts and latency
+        Return:
+            dict of statistics
+        """
+        with self._cond:
+            completed = self._completed
+            return {'workers': self.workers,
+                    'capacity': self.capacity,
+                    'pending': self._pending,
+                    'submitted': self._submitted,
+                    'completed': completed,
+                    'failed': self._failed,
+                    'dropped': self._dropped,
+                    'avg_latency': self._latency / completed if completed else 0.0,
+                    'max_latency': self._max_latency}
+
+    def shutdown(self, wait=True):
+        """ Stop accepting tasks and optionally wait for queued tasks to finish
+        Args:
+            wait: True to drain queued tasks before returning
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._executor.shutdown(wait=wait)
+
+TASK_POOL = TaskPool()
+
+def configure_pool(workers=4, queue_size=64, policy='block', timeout=5.0):
+    """ Replace the shared task pool, normally called once at startup
+    Args:
+        workers: number of worker threads
+        queue_size: number of tasks allowed to wait for a worker
+        policy: 'block' or 'drop' when the queue is full
+        timeout: seconds to wait for room with the 'block' policy
+    """
+    global TASK_POOL
+    old_pool = TASK_POOL
+    TASK_POOL = TaskPool(workers, queue_size, policy, timeout)
+    old_pool.shutdown(wait=False)
+
+def shutdown_pool(wait=True):
+    """ Drain and stop the shared task pool
+    Args:
+        wait: True to wait for queued tasks to finish
+    """
+    TASK_POOL.shutdown(wait)
 
 def async(func):
-    """ Decorator to run function aysychronously
+    """ Decorator to run function asynchronously on the shared task pool
     Args:
         func: function to run
         kwargs: argument for function call
+    Return:
+        Future for the result, or None if the task was dropped
     """
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        """ Wrap function in thread
+        """ Submit function to the task pool
         """
-        thr = Thread(target=func, args=args, kwargs=kwargs)
-        thr.start()
+        return TASK_POOL.submit(func, *args, **kwargs)
     return wrapper
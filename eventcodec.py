@@ -0,0 +1,492 @@
+#!/usr/bin python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2021 Alan Frost, Inc. All rights reserved.
+
+Compact binary encoding of events, and readers for binary and JSON lines event files
+"""
+
+from __future__ import print_function
+
+import json
+import struct
+import sys
+import time
+
+if sys.version_info.major == 3:
+    unicode = str
+    long = int
+
+# Block header: magic, payload length, event count, earliest and latest event time stamps.
+# Blocks with events that have no time stamp are given the full range, so none are skipped.
+BLOCK_MAGIC = b'EVB1'
+BLOCK_HEADER = struct.Struct('>4sIIII')
+UNTIMED_LAST = 0xFFFFFFFF
+
+# Strings every block starts with, action names from events.ACTIONS then common keys. This
+# list is append only, the index of each string is stored in encoded files.
+STATIC_STRINGS = (
+    u'server.info', u'login', u'logout', u'recipes', u'upload', u'confirm', u'verify',
+    u'change', u'resend', u'invite', u'reset', u'register', u'forgot', u'message.post',
+    u'message.get', u'reply', u'type', u'uid', u'ts', u'eid', u'ip', u'from', u'error',
+    u'recipe', u'category', u'status', u'count', u'user', u'email', u'group', u'account',
+)
+STATIC_INDEX = dict((string, index) for index, string in enumerate(STATIC_STRINGS))
+
+# Longest string that is added to the block string table, and the size of the table
+MAX_INTERN = 64
+MAX_STRINGS = 65536
+
+# Value tags, bytes 0x00 - 0x7f are small non negative integers
+TAG_NONE = 0xc0
+TAG_FALSE = 0xc2
+TAG_TRUE = 0xc3
+TAG_FLOAT = 0xcb
+TAG_INT = 0xd0
+TAG_TS = 0xd1
+TAG_STR = 0xd9
+TAG_NEW = 0xda
+TAG_REF = 0xdb
+TAG_LIST = 0xdc
+TAG_MAP = 0xde
+
+DOUBLE = struct.Struct('>d')
+
+def _put_varint(out, number):
+    """ Append an unsigned LEB128 integer
+    Args:
+        out: bytearray
+        number: non negative integer
+    """
+    while number > 0x7f:
+        out.append((number & 0x7f) | 0x80)
+        number >>= 7
+    out.append(number)
+
+def _get_varint(data, pos):
+    """ Read an unsigned LEB128 integer
+    Args:
+        data: bytearray
+        pos: offset
+    Return:
+        (number, offset after it)
+    """
+    number = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, pos
+        shift += 7
+
+class BlockEncoder(object):
+    """ Encode a batch of events as one block. Strings are interned in a table that starts
+        with STATIC_STRINGS and grows as the block is written, so repeated keys, actions and
+        uids take two or three bytes, and time stamps are stored as deltas. Each block is self
+        contained, so blocks appended by different worker processes can be read independently.
+    """
+    def __init__(self):
+        """ Constructor
+        """
+        self.strings = dict(STATIC_INDEX)
+        self.out = bytearray()
+        self.count = 0
+        self.first = None
+        self.last = 0
+        self.untimed = False
+        self.prev_ts = 0
+
+    def __len__(self):
+        return len(self.out)
+
+    def _string(self, value):
+        """ Encode a string, interned when short enough
+        Args:
+            value: str or unicode
+        """
+        out = self.out
+        index = self.strings.get(value)
+        if index is not None:
+            out.append(TAG_REF)
+            _put_varint(out, index)
+            return
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        encoded = value.encode('utf-8')
+        if len(encoded) <= MAX_INTERN and len(self.strings) < MAX_STRINGS:
+            self.strings[value] = len(self.strings)
+            out.append(TAG_NEW)
+        else:
+            out.append(TAG_STR)
+        _put_varint(out, len(encoded))
+        out.extend(encoded)
+
+    def _value(self, value):
+        """ Encode a value
+        Args:
+            value: JSON compatible value
+        """
+        out = self.out
+        if isinstance(value, (bytes, unicode)):
+            self._string(value)
+        elif value is None:
+            out.append(TAG_NONE)
+        elif value is True:
+            out.append(TAG_TRUE)
+        elif value is False:
+            out.append(TAG_FALSE)
+        elif isinstance(value, (int, long)):
+            if 0 <= value < 0x80:
+                out.append(value)
+            else:
+                out.append(TAG_INT)
+                _put_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+        elif isinstance(value, float):
+            out.append(TAG_FLOAT)
+            out.extend(DOUBLE.pack(value))
+        elif isinstance(value, dict):
+            out.append(TAG_MAP)
+            _put_varint(out, len(value))
+            for key, item in value.items():
+                self._string(key)
+                self._value(item)
+        elif isinstance(value, (list, tuple)):
+            out.append(TAG_LIST)
+            _put_varint(out, len(value))
+            for item in value:
+                self._value(item)
+        else:
+            self._string(unicode(value))
+
+    def add(self, event):
+        """ Add an event to the block
+        Args:
+            event: dict
+        """
+        out = self.out
+        strings = self.strings
+        timed = False
+        _put_varint(out, len(event))
+        for key, value in event.items():
+            index = strings.get(key)
+            if index is not None and index < 0x80:
+                out.append(TAG_REF)
+                out.append(index)
+            else:
+                self._string(key)
+            if key == 'ts' and isinstance(value, (int, long)) and value >= 0:
+                delta = value - self.prev_ts
+                out.append(TAG_TS)
+                _put_varint(out, delta * 2 if delta >= 0 else -delta * 2 - 1)
+                self.prev_ts = value
+                self.first = value if self.first is None else min(self.first, value)
+                self.last = max(self.last, value)
+                timed = True
+            elif isinstance(value, (bytes, unicode)):
+                self._string(value)
+            else:
+                self._value(value)
+        if not timed:
+            self.untimed = True
+        self.count += 1
+
+    def finish(self):
+        """ Get the encoded block
+        Return:
+            bytes of the header and payload
+        """
+        if self.untimed:
+            first, last = 0, UNTIMED_LAST
+        else:
+            first, last = self.first or 0, self.last
+        return BLOCK_HEADER.pack(BLOCK_MAGIC, len(self.out), self.count, first,
+                                 last) + bytes(self.out)
+
+def encode_events(events):
+    """ Encode events as a single block
+    Args:
+        events: list of dicts
+    Return:
+        bytes
+    """
+    encoder = BlockEncoder()
+    for event in events:
+        encoder.add(event)
+    return encoder.finish()
+
+def _decode_value(data, pos, strings, state):
+    """ Decode a value
+    Args:
+        data: bytearray of the block payload
+        pos: offset of the value
+        strings: string table, extended by new strings
+        state: list holding the previous time stamp
+    Return:
+        (value, offset after it)
+    """
+    tag = data[pos]
+    pos += 1
+    if tag < 0x80:
+        return tag, pos
+    if tag == TAG_REF:
+        index, pos = _get_varint(data, pos)
+        return strings[index], pos
+    if tag == TAG_NEW or tag == TAG_STR:
+        length, pos = _get_varint(data, pos)
+        value = bytes(data[pos:pos + length]).decode('utf-8')
+        if tag == TAG_NEW:
+            strings.append(value)
+        return value, pos + length
+    if tag == TAG_INT or tag == TAG_TS:
+        number, pos = _get_varint(data, pos)
+        number = number >> 1 if not number & 1 else -((number + 1) >> 1)
+        if tag == TAG_TS:
+            number += state[0]
+            state[0] = number
+        return number, pos
+    if tag == TAG_NONE:
+        return None, pos
+    if tag == TAG_TRUE:
+        return True, pos
+    if tag == TAG_FALSE:
+        return False, pos
+    if tag == TAG_FLOAT:
+        return DOUBLE.unpack_from(bytes(data[pos:pos + 8]))[0], pos + 8
+    if tag == TAG_MAP:
+        count, pos = _get_varint(data, pos)
+        value = {}
+        for _ in range(count):
+            key, pos = _decode_value(data, pos, strings, state)
+            value[key], pos = _decode_value(data, pos, strings, state)
+        return value, pos
+    if tag == TAG_LIST:
+        count, pos = _get_varint(data, pos)
+        value = []
+        for _ in range(count):
+            item, pos = _decode_value(data, pos, strings, state)
+            value.append(item)
+        return value, pos
+    raise ValueError('Invalid event tag 0x%02x' % tag)
+
+def decode_block(payload):
+    """ Decode the events in a block payload
+    Args:
+        payload: bytes following the block header
+    Return:
+        list of dicts
+    """
+    data = bytearray(payload)
+    strings = list(STATIC_STRINGS)
+    state = [0]
+    events = []
+    pos = 0
+    end = len(data)
+    while pos < end:
+        fields, pos = _get_varint(data, pos)
+        event = {}
+        for _ in range(fields):
+            if data[pos] == TAG_REF and data[pos + 1] < 0x80:
+                key = strings[data[pos + 1]]
+                pos += 2
+            else:
+                key, pos = _decode_value(data, pos, strings, state)
+            tag = data[pos]
+            if tag == TAG_REF and data[pos + 1] < 0x80:
+                event[key] = strings[data[pos + 1]]
+                pos += 2
+            elif tag < 0x80:
+                event[key] = tag
+                pos += 1
+            else:
+                event[key], pos = _decode_value(data, pos, strings, state)
+        events.append(event)
+    return events
+
+def _in_range(event, after, before):
+    """ Check if an event time stamp is within a range
+    Args:
+        event: dict
+        after: optional earliest time stamp
+        before: optional latest time stamp
+    Return:
+        True if within the range
+    """
+    stamp = event.get('ts')
+    if stamp is None:
+        return True
+    return not (after and stamp < after) and not (before and stamp > before)
+
+def read_events(infile, after=None, before=None, chunk_size=1024 * 1024):
+    """ Stream the events in a file of binary blocks, JSON lines or a mix of both. Binary
+        blocks outside the time range are skipped without decoding.
+    Args:
+        infile: file like object opened for reading bytes
+        after: optional earliest time stamp
+        before: optional latest time stamp
+        chunk_size: bytes read at a time
+    Return:
+        generator of event dicts
+    """
+    buf = b''
+    pos = 0
+    eof = False
+    while True:
+        need = 0
+        if buf.startswith(BLOCK_MAGIC, pos):
+            if len(buf) - pos >= BLOCK_HEADER.size:
+                _, length, _, first, last = BLOCK_HEADER.unpack_from(buf, pos)
+                end = pos + BLOCK_HEADER.size + length
+                if end <= len(buf):
+                    if not (after and last < after) and not (before and first > before):
+                        for event in decode_block(buf[pos + BLOCK_HEADER.size:end]):
+                            if _in_range(event, after, before):
+                                yield event
+                    pos = end
+                    continue
+                need = end - pos
+        elif pos < len(buf) and len(buf) - pos >= len(BLOCK_MAGIC):
+            end = buf.find(b'\n', pos)
+            if end >= 0 or eof:
+                end = len(buf) if end < 0 else end
+                line = buf[pos:end]
+                pos = end + 1
+                if line.strip():
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue
+                    if _in_range(event, after, before):
+                        yield event
+                continue
+        if eof:
+            if pos < len(buf) and not buf.startswith(BLOCK_MAGIC, pos):
+                line = buf[pos:]
+                pos = len(buf)
+                try:
+                    event = json.loads(line)
+                    if _in_range(event, after, before):
+                        yield event
+                except ValueError:
+                    pass
+                continue
+            return
+        data = infile.read(max(chunk_size, need))
+        eof = not data
+        buf = buf[pos:] + data
+        pos = 0
+
+def block_time_range(infile):
+    """ Get the earliest and latest time stamps of a file of binary blocks from the block
+        headers, blocks with untimed events are decoded to find the range of their other events
+    Args:
+        infile: file like object opened for reading bytes, positioned at a block
+    Return:
+        (first, last) time stamps, None if unknown
+    """
+    first = last = None
+    while True:
+        header = infile.read(BLOCK_HEADER.size)
+        if len(header) < BLOCK_HEADER.size or not header.startswith(BLOCK_MAGIC):
+            break
+        _, length, count, block_first, block_last = BLOCK_HEADER.unpack(header)
+        if block_last == UNTIMED_LAST:
+            stamps = [event['ts'] for event in decode_block(infile.read(length))
+                      if isinstance(event.get('ts'), (int, long))]
+            if not stamps:
+                continue
+            block_first, block_last = min(stamps), max(stamps)
+        else:
+            infile.seek(length, 1)
+        if count:
+            first = block_first if first is None else min(first, block_first)
+            last = max(last or 0, block_last)
+    return first, last
+
+def write_events(events, outfile, binary=True, block_size=65536):
+    """ Write events as binary blocks or JSON lines
+    Args:
+        events: iterable of dicts
+        outfile: file like object opened for writing bytes
+        binary: True for binary blocks, False for JSON lines
+        block_size: approximate bytes per block or write
+    Return:
+        number of events written
+    """
+    count = 0
+    if binary:
+        encoder = BlockEncoder()
+        for event in events:
+            encoder.add(event)
+            count += 1
+            if len(encoder) >= block_size:
+                outfile.write(encoder.finish())
+                encoder = BlockEncoder()
+        if encoder.count:
+            outfile.write(encoder.finish())
+    else:
+        lines = []
+        size = 0
+        for event in events:
+            line = json.dumps(event) + '\n'
+            lines.append(line)
+            size += len(line)
+            count += 1
+            if size >= block_size:
+                outfile.write(''.join(lines).encode('utf-8'))
+                lines = []
+                size = 0
+        outfile.write(''.join(lines).encode('utf-8'))
+    return count
+
+def convert_events(source, target, binary=True):
+    """ Convert an events file or segment between JSON lines and binary blocks
+    Args:
+        source: file name, .gz and .zst segments are decompressed
+        target: file name to write
+        binary: True to write binary blocks, False to write JSON lines
+    Return:
+        number of events converted
+    """
+    from eventlog import open_segment
+    with open_segment(source) as infile, open(target, 'wb') as outfile:
+        return write_events(read_events(infile), outfile, binary)
+
+def main():
+    """ Unit tests and benchmark
+    """
+    import io
+    now = int(time.time())
+    events = []
+    for count in range(20000):
+        events.append({'type': 'recipes', 'uid': 'SZO2HM6ZPDCL4VJZ' + str(count % 50),
+                       'ts': now + count // 10, 'ip': '203.0.113.' + str(count % 20),
+                       'recipe': 'Korean Meatballs', 'count': count})
+    events.append({'type': 'login', 'uid': None, 'error': u'Unable to validate é',
+                   'ts': now, 'ratio': 0.5, 'tags': ['a', 1, -300], 'more': {'ok': True}})
+    text = io.BytesIO()
+    binary = io.BytesIO()
+    start = time.time()
+    write_events(events, text, binary=False)
+    middle = time.time()
+    write_events(events, binary)
+    end = time.time()
+    print('json {} bytes {:.1f} usec/event, binary {} bytes {:.1f} usec/event, {:.1f}x'.format(
+        len(text.getvalue()), (middle - start) * 1e6 / len(events), len(binary.getvalue()),
+        (end - middle) * 1e6 / len(events), float(len(text.getvalue())) / len(binary.getvalue())))
+    for name, stream in [('json', text), ('binary', binary)]:
+        stream.seek(0)
+        start = time.time()
+        decoded = list(read_events(stream))
+        print('read {} {:.1f} usec/event'.format(name, (time.time() - start) * 1e6 / len(events)))
+        assert decoded == json.loads(json.dumps(events))
+    block = BLOCK_HEADER.size + BLOCK_HEADER.unpack_from(binary.getvalue())[1]
+    mixed = io.BytesIO(binary.getvalue()[:block] + text.getvalue())
+    expected = [event for event in events if event['ts'] >= now + 1000]
+    assert list(read_events(mixed, after=now + 1000)) == json.loads(json.dumps(expected))
+    binary.seek(0)
+    print(block_time_range(binary), (now, now + 1999))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,409 @@
+#!/usr/bin python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2021 Alan Frost, Inc. All rights reserved.
+
+Events log files, rotated by size and UTC day into compressed segments with a time index
+"""
+
+from __future__ import print_function
+
+import errno
+import fcntl
+import gzip
+import json
+import logging
+import os
+import time
+from threading import Lock, Thread
+
+from eventcodec import BLOCK_MAGIC, block_time_range
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOGGER = logging.getLogger("CyberFrosty")
+
+def segment_time(timestamp):
+    """ Get the suffix for a segment rotated at a time
+    Args:
+        timestamp: Unix time
+    Return:
+        UTC time as YYYYmmdd-HHMMSS
+    """
+    return time.strftime('%Y%m%d-%H%M%S', time.gmtime(timestamp))
+
+def open_segment(path):
+    """ Open an events file or compressed segment for reading lines
+    Args:
+        path: file name, .gz and .zst segments are decompressed
+    Return:
+        file like object
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise IOError('zstandard is required to read ' + path)
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    return open(path, 'rb')
+
+def read_time_range(path):
+    """ Get the time stamps of the first and last events in an uncompressed file, of JSON
+        lines or binary blocks
+    Args:
+        path: events file
+    Return:
+        (first, last) time stamps, None if unknown
+    """
+    first = last = None
+    with open(path, 'rb') as infile:
+        if infile.read(len(BLOCK_MAGIC)) == BLOCK_MAGIC:
+            infile.seek(0)
+            return block_time_range(infile)
+        infile.seek(0)
+        line = infile.readline()
+        try:
+            first = json.loads(line).get('ts')
+        except ValueError:
+            pass
+        infile.seek(0, os.SEEK_END)
+        infile.seek(max(0, infile.tell() - 8192))
+        lines = infile.read().splitlines()
+        for line in reversed(lines):
+            try:
+                last = json.loads(line).get('ts')
+                break
+            except ValueError:
+                continue
+    return first, last
+
+def process_exists(pid):
+    """ Check if a process is running, for temporary files named by process id
+    Args:
+        pid: process id string
+    Return:
+        True if running or unknown
+    """
+    if not pid.isdigit():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+def find_segments(path, after=None, before=None):
+    """ Get the files holding events within a time range from the segment index, oldest first
+    Args:
+        path: events file name
+        after: optional Unix time of the earliest event wanted
+        before: optional Unix time of the latest event wanted
+    Return:
+        list of file paths, including the current events file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        with open(path + '.index') as infile:
+            index = json.load(infile)
+    except (IOError, ValueError):
+        index = []
+    paths = []
+    for item in index:
+        if after and item.get('end') is not None and item['end'] < after:
+            continue
+        if before and item.get('start') is not None and item['start'] > before:
+            continue
+        paths.append(os.path.join(directory, item['segment']))
+    if os.path.exists(path):
+        paths.append(path)
+    return paths
+
+class EventLog(object):
+    """ Append only events file, rotated when it reaches max_size or the UTC day changes.
+        Rotated segments are compressed in the background, listed with their time ranges in
+        an index file, and removed after the retention period.
+    """
+    def __init__(self, path, max_size=64 * 1024 * 1024, retention_days=30, compress='gzip'):
+        """ Constructor, open the events file
+        Args:
+            path: events file name
+            max_size: bytes at which the file is rotated
+            retention_days: days to keep rotated segments, 0 to keep forever
+            compress: 'gzip', 'zstd' or None
+        """
+        self.path = path
+        self.index_path = path + '.index'
+        self.lock_path = path + '.lock'
+        self.max_size = max_size
+        self.retention = retention_days * 86400
+        if compress == 'zstd' and zstandard is None:
+            LOGGER.error('zstandard is not installed, compressing events with gzip')
+            compress = 'gzip'
+        self.compress = compress
+        self.lock = Lock()
+        self.lock_fd = None
+        self.fd = None
+        self.pid = None
+        self.size = 0
+        self.day = None
+        self._reopen()
+        self.recover()
+
+    def _reopen(self):
+        """ Open the lock and events files for this process. flock locks belong to the open
+            file, so a forked worker must not use the files opened by its parent.
+        """
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+        self.lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.pid = os.getpid()
+        self._open()
+
+    def _open(self):
+        """ Open or create the events file and note its size and day
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.size = os.fstat(self.fd).st_size
+        first = read_time_range(self.path)[0] if self.size else None
+        self.day = int((first or time.time()) // 86400)
+
+    def _rotated_elsewhere(self):
+        """ Check if another process has rotated the events file
+        Return:
+            True if the path no longer refers to the open file
+        """
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self.fd).st_ino
+        except OSError:
+            return True
+
+    def write(self, data):
+        """ Append complete lines, rotating first if needed. Writes hold a shared lock on the
+            lock file and rotation an exclusive one, so no process writes to a file after it
+            is renamed, and a file rotated by another process is reopened before writing.
+        Args:
+            data: bytes of one or more complete lines
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self._reopen()
+            while True:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_SH)
+                try:
+                    if self._rotated_elsewhere():
+                        self._open()
+                    size = os.fstat(self.fd).st_size
+                    if not size or (size + len(data) <= self.max_size and
+                                    int(time.time() // 86400) == self.day):
+                        while data:
+                            written = os.write(self.fd, data)
+                            data = data[written:]
+                        self.size = os.fstat(self.fd).st_size
+                        return
+                finally:
+                    fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+                self.rotate()
+
+    def rotate(self):
+        """ Rename the events file to a segment, add it to the index and start a new file. A
+            lock file serializes rotation between worker processes, a process that finds the
+            file already rotated just reopens it.
+        """
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        try:
+            segment = None
+            if not self._rotated_elsewhere() and os.fstat(self.fd).st_size:
+                segment = self.path + '.' + segment_time(time.time())
+                sequence = 0
+                while any(os.path.exists(segment + suffix) for suffix in ('', '.gz', '.zst')):
+                    sequence += 1
+                    segment = '{}.{}-{}'.format(self.path, segment_time(time.time()), sequence)
+                os.rename(self.path, segment)
+                self._update_index(self._entry(segment))
+            self._open()
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+        if segment and self.compress:
+            self._archive_later([segment])
+
+    def _archive_later(self, segments):
+        """ Compress segments in a background thread
+        Args:
+            segments: list of rotated file names
+        """
+        worker = Thread(target=lambda: [self.archive(segment) for segment in segments],
+                        name='events-archive')
+        worker.daemon = True
+        worker.start()
+
+    @staticmethod
+    def _entry(segment):
+        """ Get the index entry for a segment
+        Args:
+            segment: segment file name
+        Return:
+            dict of segment base name, first and last time stamps and size
+        """
+        first, last = read_time_range(segment)
+        return {'segment': os.path.basename(segment), 'start': first, 'end': last,
+                'size': os.path.getsize(segment)}
+
+    def recover(self):
+        """ Index segments left unindexed and compress segments left uncompressed by a process
+            that exited or failed while archiving
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        prefix = os.path.basename(self.path) + '.'
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        try:
+            index = self.read_index()
+            indexed = set(item['segment'] for item in index)
+            for name in sorted(os.listdir(directory)):
+                if name.startswith(prefix) and name[len(prefix):][:1].isdigit() and \
+                   not name.endswith(('.gz', '.zst', '.tmp')):
+                    if name + '.gz' in indexed or name + '.zst' in indexed:
+                        os.remove(os.path.join(directory, name))
+                    elif name not in indexed:
+                        self._update_index(self._entry(os.path.join(directory, name)))
+                        indexed.add(name)
+                elif name.startswith(prefix) and name.endswith('.tmp') and \
+                     not process_exists(name.split('.')[-2]):
+                    os.remove(os.path.join(directory, name))
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+        if self.compress:
+            pending = [os.path.join(directory, name) for name in sorted(indexed)
+                       if not name.endswith(('.gz', '.zst'))]
+            if pending:
+                self._archive_later(pending)
+
+    def archive(self, segment):
+        """ Compress an indexed segment, replace it in the index and apply the retention
+            policy. The compressed file is written under a temporary name and renamed, so a
+            failed or repeated archive leaves the uncompressed segment indexed and readable.
+        Args:
+            segment: rotated file name
+        """
+        suffix = '.zst' if self.compress == 'zstd' else '.gz'
+        target = segment + suffix
+        temp = '{}.{}.tmp'.format(target, os.getpid())
+        if not os.path.exists(segment):
+            return
+        try:
+            if suffix == '.gz':
+                with open(segment, 'rb') as infile, gzip.open(temp, 'wb') as outfile:
+                    for chunk in iter(lambda: infile.read(1024 * 1024), b''):
+                        outfile.write(chunk)
+            else:
+                with open(segment, 'rb') as infile, open(temp, 'wb') as outfile:
+                    zstandard.ZstdCompressor().copy_stream(infile, outfile)
+            os.rename(temp, target)
+            self.update_index({'segment': os.path.basename(target),
+                               'size': os.path.getsize(target)},
+                              replaces=os.path.basename(segment))
+        except (IOError, OSError) as err:
+            LOGGER.error('Archive of %s failed: %s', segment, err)
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def read_index(self):
+        """ Read the segment index
+        Return:
+            list of {'segment', 'start', 'end', 'size'} in time order
+        """
+        try:
+            with open(self.index_path) as infile:
+                return json.load(infile)
+        except (IOError, ValueError):
+            return []
+
+    def update_index(self, entry=None, replaces=None):
+        """ Add or replace a segment in the index and remove segments past the retention period.
+            The lock file is opened for each update, so that the lock is not shared with the
+            writing thread.
+        Args:
+            entry: new segment, or None to only apply retention
+            replaces: name of the segment that entry replaces, keeping its time range, which
+                      is removed once the index no longer refers to it
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._update_index(entry, replaces)
+            if replaces:
+                try:
+                    os.remove(os.path.join(directory, replaces))
+                except OSError:
+                    pass
+
+    def _update_index(self, entry=None, replaces=None):
+        """ Update the index, with the lock file held
+        Args:
+            entry: new segment, or None to only apply retention
+            replaces: name of the segment that entry replaces, keeping its time range
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        index = self.read_index()
+        if replaces:
+            for item in index:
+                if item['segment'] == replaces:
+                    item.update(entry)
+                    break
+            else:
+                if not any(item['segment'] == entry['segment'] for item in index):
+                    LOGGER.error('Archived segment %s is not indexed', replaces)
+        elif entry:
+            index.append(entry)
+        if self.retention:
+            cutoff = time.time() - self.retention
+            for expired in [item for item in index
+                            if (item.get('end') or item.get('start') or cutoff) < cutoff]:
+                try:
+                    os.remove(os.path.join(directory, expired['segment']))
+                except OSError:
+                    pass
+                index.remove(expired)
+        index.sort(key=lambda item: item.get('start') or 0)
+        temp = '{}.{}.tmp'.format(self.index_path, os.getpid())
+        with open(temp, 'w') as outfile:
+            json.dump(index, outfile, indent=1)
+        os.rename(temp, self.index_path)
+
+    def segments(self, after=None, before=None):
+        """ Get the files holding events within a time range, oldest first
+        Args:
+            after: optional Unix time of the earliest event wanted
+            before: optional Unix time of the latest event wanted
+        Return:
+            list of file paths, including the current events file
+        """
+        return find_segments(self.path, after, before)
+
+    def close(self):
+        """ Close the events file
+        """
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                os.close(self.lock_fd)
+                self.fd = self.lock_fd = None
+
+def main():
+    """ Unit tests
+    """
+    log = EventLog('/tmp/eventlog.log', max_size=4096, retention_days=1)
+    for count in range(200):
+        log.write((json.dumps({'type': 'recipes', 'ts': int(time.time()), 'count': count}) +
+                   '\n').encode('utf-8'))
+    time.sleep(1)
+    print(json.dumps(log.read_index(), indent=1))
+    print(log.segments(after=time.time() - 60))
+
+if __name__ == '__main__':
+    main()
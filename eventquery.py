@@ -0,0 +1,295 @@
+#!/usr/bin python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2021 Alan Frost, Inc. All rights reserved.
+
+Streaming queries over the events log: filters, group by counts, top k and distinct counts,
+computed in a single pass with bounded memory
+"""
+
+from __future__ import print_function
+
+import calendar
+import hashlib
+import heapq
+import math
+import re
+import struct
+import time
+
+from eventcodec import read_events
+from eventlog import find_segments, open_segment
+
+BUCKETS = {'minute': 60, 'hour': 3600, 'day': 86400}
+RELATIVE_TIME = re.compile(r'^(\d+)([smhd])$')
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_time(value, now=None):
+    """ Parse a query time
+    Args:
+        value: Unix time, 'today', an age such as 30m, 24h or 7d, or a UTC date
+               YYYY-mm-dd or YYYY-mm-ddTHH:MM
+        now: current time, for testing
+    Return:
+        Unix time or None
+    """
+    if not value:
+        return None
+    now = now or time.time()
+    if value.isdigit():
+        return int(value)
+    if value == 'today':
+        return int(now // 86400 * 86400)
+    match = RELATIVE_TIME.match(value)
+    if match:
+        return int(now - int(match.group(1)) * UNITS[match.group(2)])
+    for layout in ('%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(value, layout))
+        except ValueError:
+            pass
+    raise ValueError('Invalid time: ' + value)
+
+def scan(path, after=None, before=None):
+    """ Stream the events within a time range from the events file and its rotated segments
+    Args:
+        path: events file name
+        after: optional earliest time stamp
+        before: optional latest time stamp
+    Return:
+        generator of event dicts
+    """
+    for segment in find_segments(path, after, before):
+        with open_segment(segment) as infile:
+            for event in read_events(infile, after, before):
+                yield event
+
+def select(events, types=None, uids=None):
+    """ Filter events by type and uid
+    Args:
+        events: iterable of event dicts
+        types: optional set of event types
+        uids: optional set of uids
+    Return:
+        generator of event dicts
+    """
+    for event in events:
+        if types and event.get('type') not in types:
+            continue
+        if uids and event.get('uid') not in uids:
+            continue
+        yield event
+
+class HyperLogLog(object):
+    """ HyperLogLog distinct count estimate, with a standard error of 1.04 / sqrt(2^precision)
+        in 2^precision bytes
+    """
+    def __init__(self, precision=12):
+        """ Constructor
+        Args:
+            precision: bits of the hash used to pick a register, 4 - 16
+        """
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+        self.alpha = 0.7213 / (1 + 1.079 / self.size)
+
+    def add(self, value):
+        """ Add a value
+        Args:
+            value: string or number
+        """
+        if not isinstance(value, bytes):
+            value = (value if isinstance(value, type(u'')) else str(value)).encode('utf-8')
+        hashed = struct.unpack('>Q', hashlib.sha1(value).digest()[:8])[0]
+        index = hashed >> (64 - self.precision)
+        rest = (hashed << self.precision) & 0xffffffffffffffff
+        rank = 1
+        while rank <= 64 - self.precision and not rest & 0x8000000000000000:
+            rank += 1
+            rest <<= 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        """ Estimate the number of distinct values added
+        Return:
+            integer estimate
+        """
+        estimate = self.alpha * self.size * self.size / sum(2.0 ** -rank
+                                                             for rank in self.registers)
+        zeros = self.registers.count(b'\0')
+        if estimate <= 2.5 * self.size and zeros:
+            estimate = self.size * math.log(float(self.size) / zeros)
+        return int(round(estimate))
+
+class GroupCounter(object):
+    """ Counts per group, bounded to max_groups. When full the least frequent tenth of the
+        groups is dropped, so counts for groups first seen after that may be low by at most
+        the error reported.
+    """
+    def __init__(self, max_groups=10000):
+        """ Constructor
+        Args:
+            max_groups: maximum number of groups held
+        """
+        self.max_groups = max_groups
+        self.groups = {}
+        self.error = 0
+
+    def get(self, key):
+        """ Get the counters for a group, adding it if needed
+        Args:
+            key: group key
+        Return:
+            list of [count, matched, HyperLogLog or None]
+        """
+        entry = self.groups.get(key)
+        if entry is None:
+            if len(self.groups) >= self.max_groups:
+                dropped = heapq.nsmallest(max(1, self.max_groups // 10), self.groups.items(),
+                                          key=lambda item: item[1][0])
+                for name, counters in dropped:
+                    self.error = max(self.error, counters[0])
+                    del self.groups[name]
+            entry = [0, 0, None]
+            self.groups[key] = entry
+        return entry
+
+    def top(self, count=None):
+        """ Get the groups with the highest counts
+        Args:
+            count: number of groups, all if None
+        Return:
+            list of (key, counters) in descending count order
+        """
+        if count is None:
+            return sorted(self.groups.items(), key=lambda item: item[1][0], reverse=True)
+        return heapq.nlargest(count, self.groups.items(), key=lambda item: item[1][0])
+
+class EventQuery(object):
+    """ Aggregate a stream of events by time bucket and field value
+    """
+    def __init__(self, group_by=None, bucket=None, distinct=None, rate=None, max_groups=10000):
+        """ Constructor
+        Args:
+            group_by: optional event field to group by, e.g. recipe or ip
+            bucket: optional time bucket, minute, hour or day
+            distinct: optional field to count distinct values of per group, e.g. uid
+            rate: optional field, report the fraction of events per group that have it,
+                  e.g. error for a failure rate
+            max_groups: maximum number of groups held
+        """
+        self.group_by = group_by
+        self.bucket = BUCKETS[bucket] if bucket else None
+        self.distinct = distinct
+        self.rate = rate
+        self.precision = 12 if not group_by else 10
+        self.counter = GroupCounter(max_groups)
+        self.events = 0
+
+    def consume(self, events):
+        """ Add a stream of events
+        Args:
+            events: iterable of event dicts
+        Return:
+            self
+        """
+        group_by, bucket, distinct, rate = self.group_by, self.bucket, self.distinct, self.rate
+        get = self.counter.get
+        for event in events:
+            self.events += 1
+            key = (event.get('ts', 0) // bucket * bucket if bucket else None,
+                   event.get(group_by) if group_by else None)
+            entry = get(key)
+            entry[0] += 1
+            if rate and event.get(rate):
+                entry[1] += 1
+            if distinct:
+                value = event.get(distinct)
+                if value is not None:
+                    if entry[2] is None:
+                        entry[2] = HyperLogLog(self.precision)
+                    entry[2].add(value)
+        return self
+
+    def results(self, top=None):
+        """ Get the aggregated rows, by time bucket then descending count
+        Args:
+            top: optional number of groups per time bucket
+        Return:
+            list of dicts
+        """
+        if top:
+            buckets = {}
+            for key, entry in self.counter.groups.items():
+                buckets.setdefault(key[0], []).append((key, entry))
+            groups = []
+            for start in sorted(buckets, key=lambda start: start or 0):
+                groups.extend(heapq.nlargest(top, buckets[start], key=lambda item: item[1][0]))
+        else:
+            groups = sorted(self.counter.top(), key=lambda item: item[0][0] or 0)
+        rows = []
+        for (start, group), (count, matched, distinct) in groups:
+            row = {'count': count}
+            if self.bucket:
+                row['time'] = time.strftime('%Y-%m-%dT%H:%M', time.gmtime(start))
+            if self.group_by:
+                row[self.group_by] = group
+            if self.rate:
+                row[self.rate + '_rate'] = round(float(matched) / count, 4)
+            if self.distinct:
+                row['distinct_' + self.distinct] = distinct.count() if distinct else 0
+            rows.append(row)
+        return rows
+
+def run_query(path, after=None, before=None, types=None, uids=None, **kwargs):
+    """ Query the events log in one pass
+    Args:
+        path: events file name
+        after, before: optional time range, see parse_time
+        types: optional list of event types
+        uids: optional list of uids
+        kwargs: group_by, bucket, distinct, rate, max_groups and top
+    Return:
+        dict of matched event count, aggregated rows and the group count error bound
+    """
+    top = kwargs.pop('top', None)
+    query = EventQuery(**kwargs)
+    events = scan(path, parse_time(after), parse_time(before))
+    query.consume(select(events, set(types or []), set(uids or [])))
+    return {'events': query.events, 'rows': query.results(top), 'error': query.counter.error}
+
+def main():
+    """ Unit tests and benchmark
+    """
+    import io
+    from eventcodec import write_events
+    now = 1600000000
+    log = io.BytesIO()
+    write_events(({'type': 'recipes' if count % 4 else 'login', 'ts': now + count,
+                   'uid': 'user%d' % (count % 1000), 'recipe': 'recipe%d' % (count % 37),
+                   'ip': '203.0.113.%d' % (count % 5), 'error': 'bad' if count % 3 else None}
+                  for count in range(200000)), log, binary=False)
+    log.seek(0)
+    start = time.time()
+    query = EventQuery(group_by='recipe', distinct='uid')
+    query.consume(select(read_events(log), set(['recipes'])))
+    print('{} events {:.1f} usec/event'.format(query.events, (time.time() - start) * 1e6 /
+                                               query.events))
+    print(query.results(3))
+    log.seek(0)
+    query = EventQuery(group_by='ip', rate='error').consume(select(read_events(log),
+                                                                   set(['login'])))
+    print(query.results())
+    log.seek(0)
+    print(EventQuery(bucket='day', distinct='uid').consume(read_events(log)).results())
+    hll = HyperLogLog()
+    for count in range(100000):
+        hll.add(count)
+    print('HyperLogLog 100000 ->', hll.count())
+    print(parse_time('2021-03-01'), parse_time('24h', now), parse_time('today', now))
+
+if __name__ == '__main__':
+    main()
@@ -9,10 +9,20 @@ Utility methods
 
 from __future__ import print_function
 
-from time import time
+import heapq
 import json
+import logging
+import os
+from collections import deque
+from threading import Event, Lock, Thread
+from time import time
+
+from base58 import encode_int
+from eventcodec import BlockEncoder
+from eventlog import EventLog
+from utils import generate_random_int
 
-from utils import (base58encode_int, generate_random_int)
+LOGGER = logging.getLogger("CyberFrosty")
 
 ACTIONS = {
     'server.info': 'GET',
@@ -45,38 +55,222 @@ def event_nonce():
     Return:
         nonce: base58 string
     """
-    return base58encode_int(generate_random_int())
+    return encode_int(generate_random_int())
+
+class EventStats(object):
+    """ Live per minute event counters in a ring buffer of the last minutes, with counts by
+        event type, errors and views per recipe. Each minute holds at most max_keys types and
+        max_recipes recipes, so memory is bounded however much traffic there is.
+    """
+    def __init__(self, minutes=60, max_recipes=1000, max_keys=64):
+        """ Constructor
+        Args:
+            minutes: number of minutes kept
+            max_recipes: recipes counted per minute, others are counted as '*'
+            max_keys: counters per minute
+        """
+        self.minutes = minutes
+        self.max_recipes = max_recipes
+        self.max_keys = max_keys
+        self.ring = [(None, None, None)] * minutes
+        self.lock = Lock()
+
+    def _slot(self, minute):
+        """ Get the counters for a minute, resetting a slot left from an earlier minute
+        Args:
+            minute: Unix time // 60
+        Return:
+            (counts, recipes) dicts
+        """
+        index = minute % self.minutes
+        slot_minute, counts, recipes = self.ring[index]
+        if slot_minute != minute:
+            counts, recipes = {}, {}
+            self.ring[index] = (minute, counts, recipes)
+        return counts, recipes
+
+    def record(self, event):
+        """ Count an event
+        Args:
+            event: json dictionary with type and ts, and error or recipe if applicable
+        """
+        action = event.get('type')
+        error = 'error' in event
+        recipe = event.get('recipe') if action == 'recipes' else None
+        with self.lock:
+            counts, recipes = self._slot(int(event.get('ts') or time()) // 60)
+            key = action + '.error' if error else action
+            if key in counts or len(counts) < self.max_keys:
+                counts[key] = counts.get(key, 0) + 1
+            if error:
+                counts['errors'] = counts.get('errors', 0) + 1
+            if recipe:
+                if recipe not in recipes and len(recipes) >= self.max_recipes:
+                    recipe = '*'
+                recipes[recipe] = recipes.get(recipe, 0) + 1
+
+    def snapshot(self, windows=(1, 5, 15, 60), top=10, series=('recipes', 'login', 'login.error',
+                                                                 'errors')):
+        """ Get the counts and top recipes over sliding windows, and per minute series
+        Args:
+            windows: window sizes in minutes, up to the number of minutes kept
+            top: number of recipes per window
+            series: counters to report minute by minute
+        Return:
+            dict of {'windows': {'5m': {'counts': {}, 'recipes': [[name, views]]}},
+                     'series': {'recipes': [oldest ... newest]}}
+        """
+        now = int(time()) // 60
+        with self.lock:
+            minutes = [(minute, dict(counts), dict(recipes))
+                       for minute, counts, recipes in self.ring
+                       if minute is not None and now - minute < self.minutes]
+        result = {'minute': now * 60, 'windows': {}, 'series': {}}
+        for window in windows:
+            counts, recipes = {}, {}
+            for minute, minute_counts, minute_recipes in minutes:
+                if now - minute < window:
+                    for key, value in minute_counts.items():
+                        counts[key] = counts.get(key, 0) + value
+                    for key, value in minute_recipes.items():
+                        recipes[key] = recipes.get(key, 0) + value
+            result['windows']['{}m'.format(window)] = {
+                'counts': counts,
+                'recipes': heapq.nlargest(top, recipes.items(), key=lambda item: item[1])}
+        by_minute = dict((minute, counts) for minute, counts, _ in minutes)
+        for key in series:
+            result['series'][key] = [by_minute.get(minute, {}).get(key, 0)
+                                     for minute in range(now - self.minutes + 1, now + 1)]
+        return result
 
 class EventManager(object):
-    """ Event manager class
+    """ Event manager class. Events are queued by request threads and written by a background
+        thread in batches, each batch with a single append so lines are never interleaved.
     """
     def __init__(self, config):
-        """ Constructor, get AWS resource and table.
+        """ Constructor, open the event file
         Args:
             config: dict of config info
         """
         self.event_file = None
+        self.flush_interval = config.get('events_flush_interval', 1.0)
+        self.flush_size = config.get('events_flush_size', 65536)
+        self.flush_count = config.get('events_flush_count', 256)
+        self.binary = config.get('events_format', 'json') == 'binary'
+        self.stats = EventStats(config.get('events_stats_minutes', 60),
+                                config.get('events_stats_recipes', 1000))
+        self.max_pending = config.get('events_queue', 100000)
+        self.pending = deque()
+        self.dropped = 0
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._stopped = Event()
+        self._thread = None
+        self._pid = None
         if config.get('events', None):
             try:
-                self.event_file = open(config.get('events'), 'a')
+                self.event_file = EventLog(config.get('events'),
+                                           config.get('events_max_bytes', 64 * 1024 * 1024),
+                                           config.get('events_retention_days', 30),
+                                           config.get('events_compress', 'gzip'))
                 print('Logging events to', config.get('events'))
-            except (IOError) as err:
-                print('Open of events file failed:', err.message)
+            except (IOError, OSError) as err:
+                print('Open of events file failed:', err)
+
+    def _write(self, data):
+        """ Append serialized events to the event file, which rotates by size and UTC day
+        Args:
+            data: complete lines to write
+        """
+        self.event_file.write(data)
+
+    def _batch(self):
+        """ Serialize queued events, as JSON lines or a binary block of the events_format
+        Return:
+            (bytes of up to about flush_size, number of events)
+        """
+        if self.binary:
+            encoder = BlockEncoder()
+            while self.pending and len(encoder) < self.flush_size:
+                encoder.add(self.pending.popleft())
+            return encoder.finish(), encoder.count
+        lines = []
+        size = 0
+        while self.pending and size < self.flush_size:
+            line = json.dumps(self.pending.popleft()) + '\n'
+            lines.append(line)
+            size += len(line)
+        return ''.join(lines).encode('utf-8'), len(lines)
+
+    def _drain(self):
+        """ Serialize and write queued events, in batches of up to flush_size bytes
+        Return:
+            number of events written
+        """
+        count = 0
+        with self._lock:
+            while self.pending:
+                data, batch = self._batch()
+                try:
+                    self._write(data)
+                except (IOError, OSError) as err:
+                    LOGGER.error('Write of events failed: %s', err)
+                count += batch
+        return count
+
+    def _run(self):
+        """ Writer thread, drain the queue every flush_interval or when enough events arrive
+        """
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._drain()
+
+    def _start(self):
+        """ Start the writer thread, in each forked worker process
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._stopped.clear()
+                self._thread = Thread(target=self._run, name='events')
+                self._thread.daemon = True
+                self._thread.start()
+                self._pid = os.getpid()
 
     def flush_events(self):
-        """ Flush any unwritten events to the event file
+        """ Write any queued events to the event file
         """
         if self.event_file:
-            self.event_file.flush()
+            self._drain()
+
+    def stop(self, timeout=5):
+        """ Stop the writer thread and write any queued events, e.g. on SIGTERM
+        Args:
+            timeout: seconds to wait for the writer thread
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+        self.flush_events()
 
     def log_event(self, event):
-        """ Log an event
+        """ Log an event, the event is counted in the live stats, then queued and written by
+            the writer thread
         Args:
             event: json dictionary
         """
+        event['ts'] = get_timestamp()
+        self.stats.record(event)
         if self.event_file:
-            event['ts'] = get_timestamp()
-            self.event_file.write(json.dumps(event) + '\n')
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            self.pending.append(event)
+            if self._pid != os.getpid():
+                self._start()
+            elif len(self.pending) >= self.flush_count:
+                self._wakeup.set()
 
     def web_event(self, action, uid, **kwargs):
         """ Make and log a web event
@@ -149,11 +343,12 @@ class EventManager(object):
         self.log_event(event)
 
     def make_rest(self, url, event, **kwargs):
-        """ Make an REST URL call for an event
+        """ Make an REST URL call for an event, API actions such as message.get are called at
+            /api/<action> and page actions such as recipes at /<action>
         Args:
             url: Base url for api call
             event: JSON event {"eid": "n6uQRCGv", "type": "file.upload", "ts": 1472597386,
-                               "uid": "me", "group": "mygroup"}
+                               "uid": "me", "group": "mygroup"}, as a string or dict
             kwargs: group=groupname
                     after=timestamp
                     before=timestamp
@@ -168,15 +363,17 @@ class EventManager(object):
         if before:
             before = int(before)
         try:
-            jevent = json.loads(event)
+            jevent = dict(event) if isinstance(event, dict) else json.loads(event)
             if jevent and jevent.get('type') in ACTIONS:
-                rest['url'] = url + '/api/' + jevent['type']
-                rest['method'] = ACTIONS[jevent['type']]
-                if 'eid' in jevent:
-                    del jevent['eid']
-                del jevent['type']
-                del jevent['ts']
-                del jevent['account']
+                action = jevent.pop('type')
+                if '.' in action:
+                    rest['url'] = url + '/api/' + action
+                else:
+                    rest['url'] = url + '/' + action
+                rest['method'] = ACTIONS[action]
+                jevent.pop('eid', None)
+                jevent.pop('ts', None)
+                jevent.pop('account', None)
                 rest['params'] = jevent
         except (KeyError, ValueError):
             pass
@@ -185,6 +382,14 @@ class EventManager(object):
 def main():
     """ Unit tests
     """
+    manager = EventManager({'events': '/tmp/events.log'})
+    start = time()
+    for count in range(10000):
+        manager.web_event('recipes', 'SZO2HM6', recipe='Korean Meatballs', count=count)
+    print('{:.1f} usec per event'.format((time() - start) * 100))
+    manager.stop()
+    manager.error_event('login', 'SZO2HM6', 'Unable to validate')
+    print(json.dumps(manager.stats.snapshot(windows=(1, 5), top=3)['windows']))
 
 if __name__ == '__main__':
     main()
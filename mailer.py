@@ -0,0 +1,143 @@
+#!/usr/bin python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2021 Alan Frost, Inc. All rights reserved.
+
+Email template rendering
+"""
+
+from __future__ import print_function
+
+import hashlib
+import os
+import re
+import time
+import jinja2
+
+EMAIL_ACTIONS = ['confirm', 'invite', 'recipe', 'resend', 'reset']
+REPLACEMENT_TAG = re.compile(r'{{(\w+)}}')
+
+def personalize(content, data):
+    """ Fill in {{name}} replacement tags left by EmailRenderer.render_bulk, the same
+        substitution SES applies to templated email
+    Args:
+        content: rendered text or HTML
+        data: dict of replacement values
+    Return:
+        personalized content
+    """
+    return REPLACEMENT_TAG.sub(lambda match: u'{}'.format(data.get(match.group(1), '')), content)
+
+def template_name(subject, text, html):
+    """ Generate a stable name for a bulk email template from its content
+    Args:
+        subject, text, html: rendered template parts
+    Return:
+        template name
+    """
+    digest = hashlib.sha256()
+    for part in (subject, text, html):
+        digest.update(part.encode('utf-8') if not isinstance(part, bytes) else part)
+    return 'bulk-' + digest.hexdigest()[:32]
+
+def create_email_environment(template_dir='templates', cache_dir=None, compiled_dir=None):
+    """ Create a Jinja environment for email templates. Precompiled template modules are used
+        when available, with bytecode caching for templates loaded from source.
+    Args:
+        template_dir: directory containing the email/ templates
+        cache_dir: optional directory for the bytecode cache
+        compiled_dir: optional directory of templates precompiled by EmailRenderer.compile
+    Return:
+        jinja2 Environment
+    """
+    loader = jinja2.FileSystemLoader(template_dir)
+    if compiled_dir and os.path.isdir(compiled_dir):
+        loader = jinja2.ChoiceLoader([jinja2.ModuleLoader(compiled_dir), loader])
+    bytecode_cache = None
+    if cache_dir:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+    return jinja2.Environment(loader=loader, bytecode_cache=bytecode_cache,
+                              cache_size=-1, auto_reload=False)
+
+class EmailRenderer(object):
+    """ Email renderer class, templates for every action are loaded once at startup so that
+        rendering from the outbox dispatcher or worker threads never touches the file system
+    """
+    def __init__(self, config):
+        """ Constructor, create the environment and preload the templates
+        Args:
+            config: dict of config info
+        """
+        self.env = create_email_environment(config.get('email_templates', 'templates'),
+                                            config.get('email_cache'),
+                                            config.get('email_compiled'))
+        self.templates = {}
+        for action in EMAIL_ACTIONS:
+            self.load(action)
+
+    def load(self, action):
+        """ Load the text and HTML templates for an action
+        Args:
+            action: email template name, e.g. confirm
+        Return:
+            (text template, html template)
+        """
+        templates = (self.env.get_template('email/' + action + '.txt'),
+                     self.env.get_template('email/' + action + '.html'))
+        self.templates[action] = templates
+        return templates
+
+    def render(self, subject, action, **kwargs):
+        """ Render an email
+        Args:
+            subject: email subject line, used as the HTML title
+            action: email template name
+            kwargs: arguments for templating
+        Return:
+            (text, html)
+        """
+        templates = self.templates.get(action) or self.load(action)
+        text = templates[0].render(**kwargs)
+        html = templates[1].render(title=subject, **kwargs)
+        return text, html
+
+    def render_bulk(self, subject, action, fields, **kwargs):
+        """ Render an email once for many recipients, leaving {{name}} replacement tags for
+            the per recipient fields to be filled in by personalize or SES
+        Args:
+            subject: email subject line
+            action: email template name
+            fields: list of per recipient template arguments, e.g. ['user']
+            kwargs: arguments shared by all recipients
+        Return:
+            (text, html)
+        """
+        for field in fields:
+            kwargs[field] = '{{' + field + '}}'
+        return self.render(subject, action, **kwargs)
+
+    def compile(self, target):
+        """ Precompile the email templates into Python modules
+        Args:
+            target: directory to write the compiled templates to, use as 'email_compiled'
+        """
+        self.env.compile_templates(target, zip=None,
+                                   filter_func=lambda name: name.startswith('email/'))
+
+def main():
+    """ Unit tests
+    """
+    renderer = EmailRenderer({})
+    start = time.time()
+    for _ in range(1000):
+        text, html = renderer.render('Reset Password', 'reset', user='yuki', email='yuki@gmail.com',
+                                     intro='You have requested a password reset.',
+                                     link='https://cyberfrosty.com/reset', password='abc123')
+    print('{:.1f} usec per email'.format((time.time() - start) * 1000))
+    print(text)
+
+if __name__ == '__main__':
+    main()
@@ -16,8 +16,15 @@ import subprocess
 import json
 import requests
 from awsutils import DynamoDB
-from crypto import derive_key, encrypt_aes_gcm
+from crypto import derive_key, encrypt_aes_gcm, calibrate_kdf, get_aead
+from eventcodec import convert_events
+from eventquery import parse_time, run_query, scan, select
+from events import EventManager
+from recipe import RecipeManager
+from recommend import build_neighbors
+from replay import EventReplayer
 from utils import load_config, read_csv, write_csv
+from mailer import EmailRenderer
 
 def get_pid(port):
     """ Get pid of running server
@@ -85,6 +92,112 @@ def import_vault(csv_filename, password):
         for item in items:
             print(json.dumps(item))
 
+def compile_emails(config, target):
+    """ Precompile email templates, set 'email_compiled' in config.json to use them
+    Args:
+        config dictionary
+        target directory for compiled templates
+    """
+    target = target or config.get('email_compiled') or 'compiled'
+    EmailRenderer(config).compile(target)
+    print('Compiled email templates to', target)
+
+def calibrate(config):
+    """ Benchmark password hashing on this host and print the cost for kdf_cost in config.json
+    Args:
+        config dictionary
+    """
+    target = config.get('kdf_target_ms', 100)
+    for scheme in ['pbkdf2', 'scrypt']:
+        cost = calibrate_kdf(target, scheme)
+        if cost:
+            print(json.dumps({'kdf': scheme, 'kdf_cost': cost, 'kdf_target_ms': target}))
+        else:
+            print(scheme, 'is not supported')
+
+def crypt_file(config, filename, decrypt=False):
+    """ Encrypt a file to filename.enc, or decrypt filename.enc, with a key derived from the
+        encryption_secret in config.json. Files are streamed in segments, so any size of file
+        can be processed in constant memory.
+    Args:
+        config dictionary
+        filename to encrypt or decrypt
+        decrypt: True to decrypt
+    """
+    aead = get_aead(config.get('encryption_secret'), b'frosty.file', b'')
+    if decrypt:
+        target = filename[:-4] if filename.endswith('.enc') else filename + '.dec'
+    else:
+        target = filename + '.enc'
+    with open(filename, 'rb') as infile, open(target, 'wb') as outfile:
+        if decrypt:
+            size = aead.decrypt_stream(infile, outfile)
+        else:
+            size = aead.encrypt_stream(infile, outfile)
+    if size is None:
+        os.remove(target)
+        print('Decryption of', filename, 'failed')
+    else:
+        print('Wrote', target, size, 'bytes')
+
+def convert_file(filename, output_format):
+    """ Convert an events file or segment between JSON lines and binary blocks
+    Args:
+        filename of the events file, .gz and .zst segments are decompressed
+        output_format: json or binary
+    """
+    binary = output_format == 'binary'
+    base = filename.rsplit('.', 1)[0] if filename.endswith(('.gz', '.zst')) else filename
+    target = base + ('.evb' if binary else '.json')
+    count = convert_events(filename, target, binary)
+    print('Wrote', target, count, 'events', os.path.getsize(target), 'bytes')
+
+def query_events(config, options):
+    """ Query the events log and its rotated segments in one streaming pass, e.g.
+          top recipes today: query --after today --type recipes --group-by recipe --top 10
+          login failures by IP: query --type login --group-by ip --rate error
+          active users per hour: query --after 24h --bucket hour --distinct uid
+    Args:
+        config dictionary
+        options: parsed command line options
+    """
+    result = run_query(options.file or config.get('events'), options.after, options.before,
+                       options.type.split(',') if options.type else None,
+                       options.uid.split(',') if options.uid else None,
+                       group_by=options.group_by, bucket=options.bucket,
+                       distinct=options.distinct, rate=options.rate, top=options.top)
+    for row in result['rows']:
+        print(json.dumps(row))
+    print(json.dumps({'events': result['events'], 'error': result['error']}))
+
+def replay_events(config, options):
+    """ Replay the events log against a server as a load test and report latencies
+    Args:
+        config dictionary
+        options: parsed command line options
+    """
+    events = scan(options.file or config.get('events'), parse_time(options.after),
+                  parse_time(options.before))
+    events = select(events, set(options.type.split(',')) if options.type else None,
+                    set(options.uid.split(',')) if options.uid else None)
+    replayer = EventReplayer(EventManager({}), options.site, options.speedup, options.concurrency,
+                             options.methods.split(','))
+    print(json.dumps(replayer.run(events, options.top), indent=1))
+
+def recommend(config, options):
+    """ Build the recommended recipes table from the recipe views in the events log
+    Args:
+        config dictionary
+        options: parsed command line options
+    """
+    manager = RecipeManager(config)
+    manager.load_recipes('recipes.json')
+    events = select(scan(options.file or config.get('events'), parse_time(options.after or '90d'),
+                         parse_time(options.before)), set(['recipes']))
+    target = config.get('neighbors', 'neighbors.json')
+    model = build_neighbors(manager.recipes, events, target, options.top or 4)
+    print('Wrote', target, 'from', model.sessions, 'sessions of', len(model.views), 'recipes')
+
 def stop_server(service, port):
     """ Stop server listening on port
     Args:
@@ -128,7 +241,28 @@ def parse_options():
     parser.add_argument('-f', '--file', action="store")
     parser.add_argument('-s', '--site', action="store", default='https://cyberfrosty.com')
     parser.add_argument('--config', action='store', default='config.json', help='config.json')
-    parser.add_argument('command', action='store', help='check, init, start, stop, restart')
+    parser.add_argument('--format', action='store', default='binary', choices=['binary', 'json'],
+                        help='events format to convert to')
+    group = parser.add_argument_group('query')
+    group.add_argument('--after', action='store', help='Unix time, today, 24h or YYYY-mm-dd')
+    group.add_argument('--before', action='store', help='Unix time, today, 24h or YYYY-mm-dd')
+    group.add_argument('--type', action='store', help='comma separated event types')
+    group.add_argument('--uid', action='store', help='comma separated uids')
+    group.add_argument('--group-by', action='store', help='event field to count by')
+    group.add_argument('--bucket', action='store', choices=['minute', 'hour', 'day'])
+    group.add_argument('--distinct', action='store', help='event field to count distinct values')
+    group.add_argument('--rate', action='store', help='event field to report the rate of')
+    group.add_argument('--top', action='store', type=int,
+                       help='groups per time bucket, requests to replay or recipe neighbors')
+    group = parser.add_argument_group('replay')
+    group.add_argument('--speedup', action='store', type=float, default=1.0,
+                       help='replay rate relative to the recorded rate, 0 for unthrottled')
+    group.add_argument('--concurrency', action='store', type=int, default=8)
+    group.add_argument('--methods', action='store', default='GET',
+                       help='comma separated HTTP methods to replay')
+    parser.add_argument('command', action='store',
+                        help='calibrate, check, compile, convert, decrypt, encrypt, init, import, '
+                             'query, recommend, replay, start, stop, restart')
     return parser.parse_args()
 
 def start_servers(config):
@@ -179,6 +313,22 @@ def main():
         import_vault(options.file, options.password)
     elif options.command == 'init':
         init_env(config)
+    elif options.command == 'compile':
+        compile_emails(config, options.file)
+    elif options.command == 'calibrate':
+        calibrate(config)
+    elif options.command == 'encrypt':
+        crypt_file(config, options.file)
+    elif options.command == 'decrypt':
+        crypt_file(config, options.file, decrypt=True)
+    elif options.command == 'convert':
+        convert_file(options.file, options.format)
+    elif options.command == 'query':
+        query_events(config, options)
+    elif options.command == 'replay':
+        replay_events(config, options)
+    elif options.command == 'recommend':
+        recommend(config, options)
 
 if __name__ == '__main__':
     main()
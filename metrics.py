@@ -0,0 +1,215 @@
+#!/usr/bin python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2021 Alan Frost, Inc. All rights reserved.
+
+Request timing with HDR style histograms per endpoint
+"""
+
+from __future__ import print_function
+
+import threading
+import time
+
+# Values below LINEAR are counted exactly, above that each power of two is split into
+# SUB_BUCKETS buckets, so a recorded value is within 1/16 of its true value
+SUB_BITS = 4
+SUB_BUCKETS = 1 << SUB_BITS
+LINEAR = 2 * SUB_BUCKETS
+
+class Histogram(object):
+    """ Log linear histogram of non negative integers, with a fixed number of buckets and
+        constant time recording
+    """
+    def __init__(self, max_value=3600 * 1000000):
+        """ Constructor
+        Args:
+            max_value: largest value tracked, larger values are counted as max_value
+        """
+        self.max_value = max_value
+        self.counts = [0] * (self._index(max_value) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def _index(value):
+        """ Get the bucket for a value
+        Args:
+            value: non negative integer
+        Return:
+            bucket index
+        """
+        if value < LINEAR:
+            return value
+        shift = value.bit_length() - SUB_BITS - 1
+        return LINEAR + (shift - 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+    @staticmethod
+    def _value(index):
+        """ Get the middle value of a bucket
+        Args:
+            index: bucket index
+        Return:
+            value
+        """
+        if index < LINEAR:
+            return index
+        shift = (index - LINEAR) // SUB_BUCKETS + 1
+        low = ((index - LINEAR) % SUB_BUCKETS + SUB_BUCKETS) << shift
+        return low + (1 << shift) // 2
+
+    def record(self, value):
+        """ Record a value
+        Args:
+            value: non negative number, rounded down to an integer
+        """
+        value = min(int(value), self.max_value)
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """ Get a percentile
+        Args:
+            fraction: 0.0 - 1.0
+        Return:
+            value or 0 if nothing was recorded
+        """
+        if not self.count:
+            return 0
+        target = max(1, int(round(fraction * self.count)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self._value(index), self.max)
+        return self.max
+
+    def snapshot(self, scale=1.0):
+        """ Get the summary statistics
+        Args:
+            scale: divisor for the values, e.g. 1000.0 to report microseconds as milliseconds
+        Return:
+            dict of count, mean, p50, p90, p99 and max
+        """
+        summary = {'count': self.count}
+        if self.count:
+            summary['mean'] = round(self.total / scale / self.count, 3)
+            for name, fraction in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99)]:
+                summary[name] = round(self.percentile(fraction) / scale, 3)
+            summary['max'] = round(self.max / scale, 3)
+        return summary
+
+class RequestTimer(object):
+    """ Per endpoint histograms of request wall time, database calls and time, template render
+        time and response size. Measurements for the current request are held per thread, and
+        database calls outside a request are ignored.
+    """
+    METRICS = ('wall_ms', 'db_calls', 'db_ms', 'render_ms', 'bytes')
+
+    def __init__(self, db_services=('dynamodb',)):
+        """ Constructor
+        Args:
+            db_services: AWS services whose calls count as database calls
+        """
+        self.db_services = set(db_services)
+        self.endpoints = {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def start(self):
+        """ Start timing a request, call from before_request
+        """
+        local = self.local
+        local.start = time.time()
+        local.db_calls = 0
+        local.db_time = 0.0
+        local.render_time = 0.0
+
+    def db_call(self, service, operation, seconds):
+        """ Count an AWS call, for awsutils.add_call_hook
+        Args:
+            service: AWS service name
+            operation: API operation
+            seconds: call duration
+        """
+        if service in self.db_services and getattr(self.local, 'start', None) is not None:
+            self.local.db_calls += 1
+            self.local.db_time += seconds
+
+    def render(self, function, *args, **kwargs):
+        """ Call a render function and add its time to the current request
+        Args:
+            function: e.g. flask.render_template
+            args, kwargs: arguments for the function
+        Return:
+            result of the function
+        """
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if getattr(self.local, 'start', None) is not None:
+                self.local.render_time += time.time() - start
+
+    def finish(self, endpoint, size):
+        """ Record the measurements of the current request, call from after_request
+        Args:
+            endpoint: Flask endpoint name, None for unmatched URLs
+            size: response size in bytes
+        Return:
+            dict of the measurements, or None if the request was not started
+        """
+        local = self.local
+        start = getattr(local, 'start', None)
+        if start is None:
+            return None
+        local.start = None
+        values = {'wall_ms': (time.time() - start) * 1000.0, 'db_calls': local.db_calls,
+                  'db_ms': local.db_time * 1000.0, 'render_ms': local.render_time * 1000.0,
+                  'bytes': size or 0}
+        endpoint = endpoint or 'unmatched'
+        with self.lock:
+            histograms = self.endpoints.get(endpoint)
+            if histograms is None:
+                histograms = dict((name, Histogram()) for name in self.METRICS)
+                self.endpoints[endpoint] = histograms
+            for name, value in values.items():
+                # Times are recorded in microseconds for resolution
+                histograms[name].record(value * 1000 if name.endswith('_ms') else value)
+        return dict((name, round(value, 3)) for name, value in values.items())
+
+    def snapshot(self):
+        """ Get the summary of every endpoint
+        Return:
+            dict of endpoint to dict of metric to summary statistics
+        """
+        with self.lock:
+            return dict((endpoint, dict((name, histogram.snapshot(1000.0 if name.endswith('_ms')
+                                                                      else 1.0))
+                                        for name, histogram in histograms.items()))
+                        for endpoint, histograms in self.endpoints.items())
+
+def main():
+    """ Unit tests and benchmark
+    """
+    histogram = Histogram()
+    for value in range(1, 100001):
+        histogram.record(value)
+    print(histogram.snapshot(), len(histogram.counts), 'buckets')
+    timer = RequestTimer()
+    start = time.time()
+    for _ in range(10000):
+        timer.start()
+        timer.db_call('dynamodb', 'GetItem', 0.004)
+        timer.render(lambda: None)
+        timer.finish('recipes', 12000)
+    print('{:.1f} usec per request'.format((time.time() - start) * 100))
+    print(timer.snapshot())
+
+if __name__ == '__main__':
+    main()
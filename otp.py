@@ -0,0 +1,183 @@
+#!/usr/bin python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2021 Alan Frost, Inc. All rights reserved.
+
+One time password service for Google authenticator compatible HOTP and TOTP codes
+"""
+
+from __future__ import print_function
+
+import base64
+import sys
+import time
+from collections import OrderedDict
+from threading import Lock
+from cryptography.hazmat.primitives.twofactor.hotp import HOTP
+from cryptography.hazmat.primitives.twofactor.totp import TOTP
+from cryptography.hazmat.primitives.hashes import SHA1
+from cryptography.hazmat.primitives.constant_time import bytes_eq
+from cryptography.hazmat.backends import default_backend
+
+if sys.version_info.major == 3:
+    unicode = str
+
+class OTPService(object):
+    """ OTP service class. HOTP and TOTP instances are cached per secret, and the codes for
+        the lookahead window are computed once when a code is sent so that verification is
+        only a constant time comparison against the window.
+    """
+    def __init__(self, config=None):
+        """ Constructor
+        Args:
+            config: dict of config info
+        """
+        config = config or {}
+        self.window = config.get('otp_window', 3)
+        self.skew = config.get('otp_skew', 1)
+        self.max_entries = config.get('otp_cache', 1024)
+        self.generators = OrderedDict()
+        self.windows = OrderedDict()
+        self.lock = Lock()
+
+    def _cache(self, cache, key, value):
+        """ Add an entry to a bounded cache, evicting the oldest
+        Args:
+            cache: OrderedDict
+            key, value: cache entry
+        """
+        with self.lock:
+            cache[key] = value
+            while len(cache) > self.max_entries:
+                cache.popitem(last=False)
+
+    def _generator(self, kind, secret):
+        """ Get the cached HOTP or TOTP instance for a secret
+        Args:
+            kind: 'hotp' or 'totp'
+            secret: 16 character base32 secret
+        Return:
+            HOTP or TOTP instance
+        """
+        generator = self.generators.get((kind, secret))
+        if generator is None:
+            key = base64.b32decode(secret)
+            if kind == 'hotp':
+                generator = HOTP(key, 6, SHA1(), backend=default_backend(),
+                                 enforce_key_length=False)
+            else:
+                generator = TOTP(key, 8, SHA1(), 30, backend=default_backend(),
+                                 enforce_key_length=False)
+            self._cache(self.generators, (kind, secret), generator)
+        return generator
+
+    def hotp_window(self, secret, counter):
+        """ Get the HOTP codes for counter through counter + window - 1
+        Args:
+            secret: 16 character base32 secret
+            counter: first counter value
+        Return:
+            list of codes
+        """
+        codes = self.windows.get((secret, counter))
+        if codes is None:
+            hotp = self._generator('hotp', secret)
+            codes = [hotp.generate(count) for count in range(counter, counter + self.window)]
+            self._cache(self.windows, (secret, counter), codes)
+        return codes
+
+    def send_hotp(self, secret, counter):
+        """ Generate the HOTP code to send and precompute its verification window
+        Args:
+            secret: 16 character base32 secret
+            counter: counter value for the code
+        Return:
+            6 digit code, or None if the secret is invalid
+        """
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        try:
+            return self.hotp_window(secret, counter)[0]
+        except (ValueError, TypeError):
+            return None
+
+    def verify_hotp(self, secret, code, counter):
+        """ Verify an HOTP code against the window starting at counter, every code in the
+            window is compared so the time taken does not depend on which one matches
+        Args:
+            secret: 16 character base32 secret
+            code: 6 digit code
+            counter: counter value of the oldest code that is still valid
+        Return:
+            matching counter value or None
+        """
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        if isinstance(code, unicode):
+            code = code.encode('utf-8')
+        try:
+            codes = self.hotp_window(secret, counter)
+        except (ValueError, TypeError):
+            return None
+        matched = None
+        for offset, expected in enumerate(codes):
+            if bytes_eq(expected, code) and matched is None:
+                matched = counter + offset
+        return matched
+
+    def generate_totp(self, secret):
+        """ Generate the current TOTP code
+        Args:
+            secret: 16 character base32 secret
+        Return:
+            8 digit code, or None if the secret is invalid
+        """
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        try:
+            return self._generator('totp', secret).generate(int(time.time()))
+        except (ValueError, TypeError):
+            return None
+
+    def verify_totp(self, secret, code, skew=None):
+        """ Verify a TOTP code, allowing for clock skew of a number of 30 second steps
+        Args:
+            secret: 16 character base32 secret
+            code: 8 digit code
+            skew: steps before or after the current one to accept, default otp_skew
+        Return:
+            True if validation successful
+        """
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        if isinstance(code, unicode):
+            code = code.encode('utf-8')
+        skew = self.skew if skew is None else skew
+        try:
+            totp = self._generator('totp', secret)
+        except (ValueError, TypeError):
+            return None
+        now = int(time.time())
+        matched = False
+        for step in range(-skew, skew + 1):
+            if bytes_eq(totp.generate(now + step * 30), code):
+                matched = True
+        return matched or None
+
+def main():
+    """ Unit tests
+    """
+    service = OTPService()
+    secret = 'CKEI7YXSRQHEWAAX'
+    code = service.send_hotp(secret, 666)
+    print('HOTP', code, service.verify_hotp(secret, code, 665), service.verify_hotp(secret, code, 667))
+    code = service.generate_totp(secret)
+    print('TOTP', code, service.verify_totp(secret, code))
+    start = time.time()
+    for _ in range(10000):
+        service.verify_hotp(secret, '123456', 666)
+    print('{:.1f} usec per HOTP verify'.format((time.time() - start) * 100))
+
+if __name__ == '__main__':
+    main()
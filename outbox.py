@@ -0,0 +1,252 @@
+#!/usr/bin python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2021 Alan Frost, Inc. All rights reserved.
+
+Durable outbound message queue for email and text messages
+"""
+
+from __future__ import print_function
+
+import json
+import logging
+import sqlite3
+import time
+from threading import Event, Lock, Thread, local
+
+from ratelimit import TokenBucket
+
+LOGGER = logging.getLogger("CyberFrosty")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_try REAL NOT NULL,
+    claimed_at REAL,
+    created REAL NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_ready ON outbox (status, next_try);
+"""
+
+class Outbox(object):
+    """ Outbox class, messages are stored in SQLite and delivered by a background dispatcher
+    """
+    def __init__(self, config):
+        """ Constructor, open or create the queue database
+        Args:
+            config: dict of config info
+        """
+        self.path = config.get('outbox', 'outbox.db')
+        self.batch_size = config.get('outbox_batch', 25)
+        self.max_attempts = config.get('outbox_attempts', 5)
+        self.retry_delay = config.get('outbox_retry', 30)
+        self.lease = config.get('outbox_lease', 300)
+        self.poll = config.get('outbox_poll', 5)
+        self.handlers = {}
+        self.limiters = {}
+        self.groups = {}
+        self.counters = {}
+        self._local = local()
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._stopped = Event()
+        self._thread = None
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        """ Get the SQLite connection for the calling thread
+        Return:
+            sqlite3 connection
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _count(self, kind, counter, amount=1):
+        """ Increment a delivery counter
+        Args:
+            kind: message kind
+            counter: queued, sent, retried, failed
+        """
+        with self._lock:
+            counts = self.counters.setdefault(kind, {})
+            counts[counter] = counts.get(counter, 0) + amount
+
+    def register(self, kind, handler, rate=None, cost=None, group=None):
+        """ Register a delivery handler for a kind of message
+        Args:
+            kind: message kind, e.g. 'email' or 'sms'
+            handler: function called with the message payload, raises an exception on failure.
+                     The payload is saved for the retry, so a handler can remove the parts
+                     that were delivered before raising.
+            rate: optional maximum deliveries per second
+            cost: optional function of the payload giving the deliveries it makes, default 1
+            group: optional name of a rate limit shared with other kinds that are delivered
+                   by the same service, the rate of the first kind registered applies
+        """
+        self.handlers[kind] = handler
+        if rate:
+            bucket = self.groups.get(group) if group else None
+            if bucket is None:
+                bucket = TokenBucket(rate)
+                if group:
+                    self.groups[group] = bucket
+            self.limiters[kind] = (bucket, cost)
+
+    def put(self, kind, payload):
+        """ Append a message to the queue
+        Args:
+            kind: message kind
+            payload: JSON serializable message content
+        Return:
+            message id
+        """
+        now = time.time()
+        cursor = self._connect().execute(
+            'INSERT INTO outbox (kind, payload, next_try, created) VALUES (?, ?, ?, ?)',
+            (kind, json.dumps(payload), now, now))
+        self._count(kind, 'queued')
+        self.start()
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    def claim(self):
+        """ Claim the next batch of messages that are ready for delivery. Messages claimed by a
+            dispatcher that died are reclaimed once their lease expires.
+        Return:
+            list of (id, kind, payload, attempts)
+        """
+        now = time.time()
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute("UPDATE outbox SET status = 'pending' "
+                         "WHERE status = 'sending' AND claimed_at < ?", (now - self.lease,))
+            rows = conn.execute("SELECT id, kind, payload, attempts FROM outbox "
+                                "WHERE status = 'pending' AND next_try <= ? "
+                                "ORDER BY id LIMIT ?", (now, self.batch_size)).fetchall()
+            conn.executemany("UPDATE outbox SET status = 'sending', claimed_at = ? WHERE id = ?",
+                             [(now, row[0]) for row in rows])
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+        return [(row[0], row[1], json.loads(row[2]), row[3]) for row in rows]
+
+    def deliver(self, batch):
+        """ Deliver a batch of claimed messages, then record the results in one transaction
+        Args:
+            batch: list of (id, kind, payload, attempts)
+        """
+        sent = []
+        retry = []
+        failed = []
+        for msgid, kind, payload, attempts in batch:
+            handler = self.handlers.get(kind)
+            if handler is None:
+                failed.append(('No handler for ' + kind, msgid))
+                self._count(kind, 'failed')
+                continue
+            limiter, cost = self.limiters.get(kind, (None, None))
+            if limiter:
+                limiter.wait(cost(payload) if cost else 1)
+            try:
+                handler(payload)
+                sent.append((msgid,))
+                self._count(kind, 'sent')
+            except Exception as err:
+                attempts += 1
+                LOGGER.error('Delivery of %s %d failed: %s', kind, msgid, err)
+                if attempts >= self.max_attempts:
+                    failed.append((str(err), msgid))
+                    self._count(kind, 'failed')
+                else:
+                    next_try = time.time() + self.retry_delay * 2 ** (attempts - 1)
+                    retry.append((attempts, next_try, str(err), json.dumps(payload), msgid))
+                    self._count(kind, 'retried')
+
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('DELETE FROM outbox WHERE id = ?', sent)
+            conn.executemany("UPDATE outbox SET status = 'pending', attempts = ?, next_try = ?, "
+                             "error = ?, payload = ? WHERE id = ?", retry)
+            conn.executemany("UPDATE outbox SET status = 'failed', error = ? WHERE id = ?",
+                             failed)
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+
+    def dispatch(self):
+        """ Dispatcher loop, drain the queue in batches until stopped
+        """
+        while not self._stopped.is_set():
+            try:
+                batch = self.claim()
+                if batch:
+                    self.deliver(batch)
+                    continue
+            except sqlite3.Error as err:
+                LOGGER.error('Outbox dispatch failed: %s', err)
+            self._wakeup.wait(self.poll)
+            self._wakeup.clear()
+
+    def start(self):
+        """ Start the dispatcher thread if it is not running. This is done lazily so that each
+            forked worker process starts its own dispatcher.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._stopped.clear()
+                    self._thread = Thread(target=self.dispatch, name='outbox')
+                    self._thread.daemon = True
+                    self._thread.start()
+
+    def stop(self, timeout=10):
+        """ Stop the dispatcher after the current batch, queued messages remain on disk
+        Args:
+            timeout: seconds to wait for the dispatcher to finish
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        """ Get queue depth and delivery counters
+        Return:
+            dict of statistics
+        """
+        rows = self._connect().execute(
+            'SELECT kind, status, COUNT(*) FROM outbox GROUP BY kind, status').fetchall()
+        depth = {}
+        for kind, status, count in rows:
+            depth.setdefault(kind, {})[status] = count
+        with self._lock:
+            counters = dict((kind, dict(counts)) for kind, counts in self.counters.items())
+        return {'depth': depth, 'counters': counters}
+
+def main():
+    """ Unit tests
+    """
+    outbox = Outbox({'outbox': '/tmp/outbox.db', 'outbox_poll': 1})
+    outbox.register('email', print, 5)
+    outbox.put('email', {'recipient': 'yuki@gmail.com', 'subject': 'Howdy'})
+    time.sleep(2)
+    print(json.dumps(outbox.stats()))
+    outbox.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+#!/usr/bin python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2021 Alan Frost, Inc. All rights reserved.
+
+Runtime profiling of a live worker, by sampling thread stacks or with cProfile per request
+"""
+
+from __future__ import print_function
+
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+
+class SamplingProfiler(object):
+    """ Sample the stacks of every other thread at a fixed interval and count them in the
+        collapsed format used by flamegraph.pl and speedscope
+    """
+    def __init__(self, interval=0.005, max_stacks=100000):
+        """ Constructor
+        Args:
+            interval: seconds between samples
+            max_stacks: distinct stacks counted, further new stacks are counted as '(other)'
+        """
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.stacks = {}
+        self.labels = {}
+        self.samples = 0
+
+    def _label(self, code):
+        """ Get the frame label for a code object
+        Args:
+            code: code object
+        Return:
+            'file:function'
+        """
+        label = self.labels.get(code)
+        if label is None:
+            label = '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+            self.labels[code] = label
+        return label
+
+    def sample(self, skip):
+        """ Count the current stack of each thread
+        Args:
+            skip: thread id not to sample, i.e. the sampling thread
+        """
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == skip:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack = ';'.join(reversed(labels))
+            if stack not in self.stacks and len(self.stacks) >= self.max_stacks:
+                stack = '(other)'
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def run(self, seconds, stopped):
+        """ Sample until the time is up or stopped is set
+        Args:
+            seconds: duration
+            stopped: threading.Event
+        """
+        own = threading.current_thread().ident
+        deadline = time.time() + seconds
+        while time.time() < deadline and not stopped.is_set():
+            self.sample(own)
+            stopped.wait(self.interval)
+
+    def write(self, path):
+        """ Write the collapsed stacks, one 'frame;frame;frame count' line per stack
+        Args:
+            path: file name
+        """
+        with open(path, 'w') as outfile:
+            for stack, count in sorted(self.stacks.items()):
+                outfile.write('{} {}\n'.format(stack, count))
+
+class Profiler(object):
+    """ Profile a live worker on demand. A sampling session profiles every thread for a number
+        of seconds from a background thread. A cProfile session profiles the next requests, each
+        in its own profile that is merged when the request ends. Nothing runs between sessions,
+        the request hooks only test requests_left.
+    """
+    def __init__(self, directory, interval=0.005, max_seconds=300, max_requests=1000):
+        """ Constructor
+        Args:
+            directory: where profiles are written
+            interval: seconds between stack samples
+            max_seconds: longest session allowed
+            max_requests: most requests profiled in a session
+        """
+        self.directory = directory
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.max_requests = max_requests
+        self.requests_left = 0
+        self.session = None
+        self.stats = None
+        self.timer = None
+        self.local = threading.local()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.last = None
+
+    def _path(self, mode):
+        """ Get the file name for a profile
+        Args:
+            mode: sample or cprofile
+        Return:
+            path in the profile directory, named by worker pid and time
+        """
+        suffix = 'collapsed' if mode == 'sample' else 'pstats'
+        return os.path.join(self.directory, 'profile-{}-{}.{}'.format(
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S', time.gmtime()), suffix))
+
+    def start(self, mode='sample', seconds=30, requests=None):
+        """ Start a profiling session
+        Args:
+            mode: 'sample' for stack sampling or 'cprofile' for request profiling
+            seconds: session length
+            requests: number of requests to profile in cprofile mode, default max_requests
+        Return:
+            dict of session status, or error if a session is running or the mode is unknown
+        """
+        if mode not in ('sample', 'cprofile'):
+            return {'error': 'Unknown profile mode: ' + str(mode)}
+        seconds = min(float(seconds), self.max_seconds)
+        with self.lock:
+            if self.session is not None:
+                return {'error': 'Profiling in progress', 'session': self.session}
+            self.session = {'mode': mode, 'seconds': seconds, 'started': int(time.time()),
+                            'path': self._path(mode), 'pid': os.getpid()}
+            self.stopped.clear()
+            if mode == 'sample':
+                worker = threading.Thread(target=self._sample, args=(seconds,), name='profiler')
+            else:
+                self.stats = None
+                self.requests_left = min(int(requests or self.max_requests), self.max_requests)
+                self.session['requests'] = self.requests_left
+                worker = threading.Timer(seconds, self.stop, args=(self.session,))
+                self.timer = worker
+            worker.daemon = True
+            worker.start()
+            return dict(self.session)
+
+    def _sample(self, seconds):
+        """ Sampling session thread
+        Args:
+            seconds: session length
+        """
+        profiler = SamplingProfiler(self.interval)
+        profiler.run(seconds, self.stopped)
+        with self.lock:
+            session = self.session
+            session['samples'] = profiler.samples
+            try:
+                profiler.write(session['path'])
+            except (IOError, OSError) as err:
+                session['error'] = str(err)
+            self.last = session
+            self.session = None
+
+    def begin_request(self):
+        """ Start profiling the current request if a cProfile session wants more requests
+        """
+        if self.requests_left > 0:
+            profile = cProfile.Profile()
+            self.local.profile = profile
+            profile.enable()
+
+    def end_request(self):
+        """ Stop profiling the current request and merge its profile into the session
+        """
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            return
+        profile.disable()
+        self.local.profile = None
+        with self.lock:
+            if self.session is None or self.session['mode'] != 'cprofile':
+                return
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.requests_left -= 1
+            done = self.requests_left <= 0
+        if done:
+            self.stop()
+
+    def stop(self, expected=None):
+        """ End the current session early, or at the end of a cProfile session's time
+        Args:
+            expected: only stop this session, for the timer of a session that may have ended
+        """
+        with self.lock:
+            session = self.session
+            if session is None or (expected is not None and session is not expected):
+                return
+            self.stopped.set()
+            if session['mode'] != 'cprofile':
+                return
+            session['profiled'] = session['requests'] - max(0, self.requests_left)
+            self.requests_left = 0
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.stats is not None:
+                try:
+                    self.stats.dump_stats(session['path'])
+                except (IOError, OSError) as err:
+                    session['error'] = str(err)
+            else:
+                session['error'] = 'No requests profiled'
+            self.stats = None
+            self.last = session
+            self.session = None
+
+    def status(self):
+        """ Get the running session and the last completed one
+        Return:
+            dict
+        """
+        with self.lock:
+            return {'running': dict(self.session) if self.session else None,
+                    'last': self.last}
+
+def main():
+    """ Unit tests
+    """
+    profiler = Profiler('/tmp')
+    print(profiler.start('sample', 1))
+    print(profiler.start('sample', 1))
+    total = 0
+    deadline = time.time() + 1.2
+    while time.time() < deadline:
+        total += sum(range(1000))
+    print(profiler.status())
+    print(profiler.start('cprofile', 10, requests=2))
+    for _ in range(3):
+        profiler.begin_request()
+        sorted(range(10000), reverse=True)
+        profiler.end_request()
+    print(profiler.status())
+
+if __name__ == '__main__':
+    main()
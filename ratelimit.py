@@ -0,0 +1,454 @@
+#!/usr/bin python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2021 Alan Frost, Inc. All rights reserved.
+
+Rate limiting utilities
+"""
+
+from __future__ import print_function
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import time
+from collections import OrderedDict, deque
+from threading import Lock
+
+# Shared counter slot: key hash, window number, count in window, count in previous window
+SLOT = struct.Struct('<QIII')
+# Key hashes are odd, so these even values mark never used and deleted slots
+EMPTY = 0
+DELETED = 2
+
+class TokenBucket(object):
+    """ Token bucket rate limiter, safe to share between threads
+    """
+    def __init__(self, rate, burst=None):
+        """ Constructor
+        Args:
+            rate: tokens added per second
+            burst: maximum tokens held, defaults to one second worth
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = Lock()
+
+    def _refill(self, now):
+        """ Add tokens for the time elapsed since the last update
+        Args:
+            now: current time
+        """
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def consume(self, tokens=1):
+        """ Take tokens if available without waiting
+        Args:
+            tokens: number of tokens to take
+        Return:
+            True if the tokens were taken
+        """
+        with self.lock:
+            self._refill(time.time())
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def wait(self, tokens=1):
+        """ Take tokens, sleeping until they are available. Requests larger than the burst
+            size wait for a full bucket and leave it in debt, so the average rate still holds.
+        Args:
+            tokens: number of tokens to take
+        Return:
+            seconds spent waiting
+        """
+        needed = min(tokens, self.burst)
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill(time.time())
+                if self.tokens >= needed:
+                    self.tokens -= tokens
+                    return waited
+                delay = (needed - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+class SlidingWindowLimiter(object):
+    """ Keyed sliding window rate limiter, allows at most limit hits per key within the window.
+        The least recently used keys are evicted beyond max_keys to bound memory.
+    """
+    def __init__(self, limit, window, max_keys=10000):
+        """ Constructor
+        Args:
+            limit: hits allowed per key within the window
+            window: window size in seconds
+            max_keys: maximum number of keys tracked
+        """
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self.hits = OrderedDict()
+        self.lock = Lock()
+
+    def _recent(self, key, now):
+        """ Get the hit times for a key with expired entries removed
+        Args:
+            key: limiter key
+            now: current time
+        Return:
+            deque of hit times, or None if the key has no hits
+        """
+        times = self.hits.get(key)
+        if times is not None:
+            while times and times[0] <= now - self.window:
+                times.popleft()
+            if not times:
+                del self.hits[key]
+                times = None
+        return times
+
+    def count(self, key):
+        """ Get the number of hits for a key within the window
+        Args:
+            key: limiter key
+        Return:
+            hit count
+        """
+        with self.lock:
+            times = self._recent(key, time.time())
+            return len(times) if times else 0
+
+    def hit(self, key):
+        """ Record a hit for a key if it is under the limit
+        Args:
+            key: limiter key
+        Return:
+            True if allowed, False if the key is over the limit
+        """
+        now = time.time()
+        with self.lock:
+            times = self._recent(key, now)
+            if times is None:
+                times = deque()
+            elif len(times) >= self.limit:
+                return False
+            else:
+                del self.hits[key]
+            times.append(now)
+            self.hits[key] = times
+            while len(self.hits) > self.max_keys:
+                self.hits.popitem(last=False)
+            return True
+
+    def release(self, key):
+        """ Remove the most recent hit for a key, to undo a hit for an action that failed
+        Args:
+            key: limiter key
+        """
+        with self.lock:
+            times = self.hits.get(key)
+            if times:
+                times.pop()
+                if not times:
+                    del self.hits[key]
+
+class TextThrottle(object):
+    """ Policy for outbound text messages: a per phone duplicate window plus per user and
+        global rate limits, with counters for each outcome
+    """
+    def __init__(self, config):
+        """ Constructor
+        Args:
+            config: dict of config info
+        """
+        self.duplicates = SlidingWindowLimiter(1, config.get('sms_dedup_window', 60))
+        self.per_user = SlidingWindowLimiter(config.get('sms_user_limit', 5),
+                                             config.get('sms_user_window', 3600))
+        self.overall = SlidingWindowLimiter(config.get('sms_global_limit', 60),
+                                            config.get('sms_global_window', 60))
+        self.counters = {'sent': 0, 'duplicate': 0, 'limited': 0, 'failed': 0}
+        self.lock = Lock()
+
+    def _count(self, outcome):
+        """ Increment an outcome counter
+        Args:
+            outcome: sent, duplicate or limited
+        Return:
+            outcome
+        """
+        with self.lock:
+            self.counters[outcome] += 1
+        return outcome
+
+    def check(self, phone, userid):
+        """ Check whether a text message may be sent, recording it if so. The phone's duplicate
+            window is claimed first in a single call, so concurrent requests for the same phone
+            can not both be allowed, and the claim is undone if a rate limit is reached.
+        Args:
+            phone: destination phone number
+            userid: User account identifier
+        Return:
+            'sent' if allowed, 'duplicate' if one was sent to the phone within the window,
+            'limited' if the user or global rate limit was reached
+        """
+        if not self.duplicates.hit(phone):
+            return self._count('duplicate')
+        if not self.per_user.hit(userid):
+            self.duplicates.release(phone)
+            return self._count('limited')
+        if not self.overall.hit('*'):
+            self.per_user.release(userid)
+            self.duplicates.release(phone)
+            return self._count('limited')
+        return self._count('sent')
+
+    def release(self, phone, userid):
+        """ Undo an allowed check when the message could not be sent, so a retry is not
+            reported as a duplicate of a message that was never sent
+        Args:
+            phone: destination phone number
+            userid: User account identifier
+        """
+        self.overall.release('*')
+        self.per_user.release(userid)
+        self.duplicates.release(phone)
+        with self.lock:
+            self.counters['sent'] -= 1
+            self.counters['failed'] += 1
+
+    def stats(self):
+        """ Get outcome counters
+        Return:
+            dict of counters
+        """
+        with self.lock:
+            return dict(self.counters)
+
+class SharedWindowCounter(object):
+    """ Sliding window counters in a fixed size hash table that lives in a memory mapped file,
+        so that every worker process mapping the same file sees the same counts. The sliding
+        window is approximated from the current and previous fixed windows. Without a path the
+        table is in anonymous memory, private to this process.
+    """
+    def __init__(self, window, path=None, slots=4096, probes=8):
+        """ Constructor, create or map the counter file
+        Args:
+            window: window size in seconds
+            path: counter file shared between processes, or None
+            slots: number of counters in the table
+            probes: number of slots to search for a key
+        """
+        self.window = window
+        self.slots = slots
+        self.probes = probes
+        self.lock = Lock()
+        self.fd = None
+        size = slots * SLOT.size
+        if path:
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.fstat(self.fd).st_size != size:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(self.fd).st_size != size:
+                        os.ftruncate(self.fd, size)
+                finally:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+            self.table = mmap.mmap(self.fd, size)
+        else:
+            self.table = mmap.mmap(-1, size)
+
+    def _acquire(self):
+        """ Lock the table against other threads and processes
+        """
+        self.lock.acquire()
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def _release(self):
+        """ Unlock the table
+        """
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.lock.release()
+
+    def _find(self, key_hash, current, create):
+        """ Find the slot for a key, or the best slot to take over for it. The search continues
+            past deleted and expired slots until the key or a never used slot is found, so keys
+            stored further along are not missed.
+        Args:
+            key_hash: 64 bit hash of the key, odd so it is never EMPTY or DELETED
+            current: current window number
+            create: pick a slot for a key that is not in the table
+        Return:
+            (offset, (hash, window, count, previous)) with a zeroed entry for a new key, or
+            None if the key is not in the table and create is False
+        """
+        start = key_hash % self.slots
+        free = None
+        victim = None
+        for probe in range(self.probes):
+            offset = ((start + probe) % self.slots) * SLOT.size
+            entry = SLOT.unpack_from(self.table, offset)
+            if entry[0] == key_hash:
+                return offset, entry
+            if entry[0] == EMPTY:
+                if free is None:
+                    free = offset
+                break
+            if entry[0] == DELETED or entry[1] < current - 1:
+                if free is None:
+                    free = offset
+            elif victim is None or (entry[1], entry[2] + entry[3]) < \
+                 (victim[1][1], victim[1][2] + victim[1][3]):
+                victim = (offset, entry)
+        if not create:
+            return None
+        return (free if free is not None else victim[0]), (key_hash, current, 0, 0)
+
+    def _update(self, key, amount):
+        """ Add to a key's count and get the sliding window estimate
+        Args:
+            key: counter key
+            amount: amount to add, 0 to only read, None to reset
+        Return:
+            estimated count within the sliding window
+        """
+        now = time.time()
+        current = int(now // self.window)
+        key_hash = struct.unpack('<Q', hashlib.sha1(key.encode('utf-8')
+                                                    if not isinstance(key, bytes)
+                                                    else key).digest()[:8])[0] | 1
+        self._acquire()
+        try:
+            found = self._find(key_hash, current, bool(amount))
+            if found is None:
+                return 0.0
+            offset, (_, window, count, previous) = found
+            if window == current - 1:
+                window, count, previous = current, 0, count
+            elif window != current:
+                window, count, previous = current, 0, 0
+            if amount is None:
+                count = previous = 0
+                SLOT.pack_into(self.table, offset, DELETED, 0, 0, 0)
+            elif amount:
+                count += amount
+                SLOT.pack_into(self.table, offset, key_hash, window, count, previous)
+        finally:
+            self._release()
+        elapsed = (now % self.window) / self.window
+        return previous * (1.0 - elapsed) + count
+
+    def count(self, key):
+        """ Get the estimated count for a key within the sliding window
+        Args:
+            key: counter key
+        Return:
+            estimated count
+        """
+        return self._update(key, 0)
+
+    def add(self, key, amount=1):
+        """ Add to the count for a key
+        Args:
+            key: counter key
+            amount: amount to add
+        Return:
+            estimated count including this addition
+        """
+        return self._update(key, amount)
+
+    def reset(self, key):
+        """ Clear the count for a key
+        Args:
+            key: counter key
+        """
+        self._update(key, None)
+
+class LoginLimiter(object):
+    """ Failed login limiter by account and by client IP address, checked before any database
+        access or password hashing so that abusive traffic is rejected cheaply. Accounts and
+        addresses are counted in separate tables, so failures spread over many addresses can
+        not evict an account's count.
+    """
+    def __init__(self, config):
+        """ Constructor
+        Args:
+            config: dict of config info
+        """
+        self.user_limit = config.get('login_user_limit', 10)
+        self.ip_limit = config.get('login_ip_limit', 50)
+        window = config.get('login_window', 900)
+        path = config.get('login_limits')
+        slots = config.get('login_slots', 4096)
+        self.users = SharedWindowCounter(window, path + '.users' if path else None, slots)
+        self.addresses = SharedWindowCounter(window, path + '.ips' if path else None, slots)
+        self.rejected = 0
+        self.lock = Lock()
+
+    def blocked(self, userid, ip_address):
+        """ Check if login attempts for the account or from the address are over the limit
+        Args:
+            userid: User account identifier
+            ip_address: client IP address
+        Return:
+            True if the attempt should be rejected
+        """
+        if self.users.count(userid) >= self.user_limit or \
+           self.addresses.count(ip_address) >= self.ip_limit:
+            with self.lock:
+                self.rejected += 1
+            return True
+        return False
+
+    def failed(self, userid, ip_address):
+        """ Record a failed login attempt
+        Args:
+            userid: User account identifier
+            ip_address: client IP address
+        """
+        self.users.add(userid)
+        self.addresses.add(ip_address)
+
+    def succeeded(self, userid):
+        """ Clear the failed attempts for an account after a successful login
+        Args:
+            userid: User account identifier
+        """
+        self.users.reset(userid)
+
+def main():
+    """ Unit tests
+    """
+    bucket = TokenBucket(10, 2)
+    print(bucket.consume(), bucket.consume(), bucket.consume())
+    print('waited {:.3f}'.format(bucket.wait()))
+    throttle = TextThrottle({'sms_user_limit': 2})
+    for phone in ['+17202233322', '+17202233322', '+17202233323', '+17202233324']:
+        print(phone, throttle.check(phone, 'yuki'))
+    throttle.release('+17202233323', 'yuki')
+    print('+17202233323', throttle.check('+17202233323', 'yuki'))
+    print(throttle.stats())
+    limiter = LoginLimiter({'login_user_limit': 3, 'login_limits': '/tmp/login.limits'})
+    for attempt in range(4):
+        print('blocked' if limiter.blocked('yuki', '203.0.113.195') else 'allowed')
+        limiter.failed('yuki', '203.0.113.195')
+    limiter.succeeded('yuki')
+    print('blocked' if limiter.blocked('yuki', '203.0.113.195') else 'allowed')
+    start = time.time()
+    for _ in range(10000):
+        limiter.blocked('yuki', '203.0.113.195')
+    print('{:.1f} usec per check'.format((time.time() - start) * 100))
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,9 @@ Implementation of Recipe manager
 """
 
 from __future__ import print_function
+from collections import OrderedDict
 from datetime import datetime
+from threading import Lock
 import re
 import os
 import json
@@ -284,12 +286,49 @@ class RecipeManager(object):
     """ Recipe Manager
     """
 
-    def __init__(self, config):
+    def __init__(self, config, cache_size=256):
         self.config = config
         self.recipes = {}
         self.ingredients = {}
         self.references = {}
+        self.neighbors = {}
         self.database = DynamoDB(config, 'Recipes')
+        self.rendered = OrderedDict()
+        self.rendered_limit = cache_size
+        self.rendered_lock = Lock()
+
+    def _cached(self, key):
+        """ Get rendered HTML from the cache
+        Args:
+            key: cache key
+        Returns:
+            HTML or None
+        """
+        with self.rendered_lock:
+            html = self.rendered.pop(key, None)
+            if html is not None:
+                self.rendered[key] = html
+            return html
+
+    def _cache(self, key, html):
+        """ Add rendered HTML to the cache, evicting the least recently used
+        Args:
+            key: cache key
+            html: rendered HTML
+        Returns:
+            html
+        """
+        with self.rendered_lock:
+            self.rendered[key] = html
+            while len(self.rendered) > self.rendered_limit:
+                self.rendered.popitem(last=False)
+        return html
+
+    def clear_cache(self):
+        """ Clear rendered HTML, after recipes are loaded or changed
+        """
+        with self.rendered_lock:
+            self.rendered.clear()
 
     def load_recipes(self, infile):
         """ Load json data for recipes
@@ -339,6 +378,7 @@ class RecipeManager(object):
                         self.recipes[recipe_id] = recipe
         except (IOError, ValueError) as err:
             print('Load of recipe file failed:', err.message)
+        self.clear_cache()
 
     def load_references(self, infile):
         """ Load json data for sauces, spice mixtures and other referenced items
@@ -358,6 +398,21 @@ class RecipeManager(object):
             print('Load of reference file failed:', err.message)
 
 
+    def load_neighbors(self, infile):
+        """ Load the recommended recipes for each recipe, written by recommend.py
+            { "Korean Meatballs": ["Vietnamese Meatballs", "Korean Meatball Marinara"] }
+        Args:
+            file: json file to load
+        """
+        if not os.path.exists(infile):
+            return
+        try:
+            with open(infile) as json_file:
+                self.neighbors = json.load(json_file)
+            self.clear_cache()
+        except (IOError, ValueError) as err:
+            print('Load of neighbors file failed:', err)
+
     def load_nutrition(self, csvfile='nutrition.csv'):
         """ Load the CSV file with nutrition information
         """
@@ -614,10 +669,11 @@ class RecipeManager(object):
 
         html += '</div><!--/col-sm-6-->\n'
         html += '</div><!--/row-->\n'
-        if 'similar' in recipe:
+        related = self.neighbors.get(recipe['title']) or recipe.get('similar')
+        if related:
             html += '<hr />\n<h5>Some Related Recipes</h5>\n'
             html += '<div class="gal">\n'
-            for item in recipe['similar']:
+            for item in related:
                 similar = self.get_recipe(item)
                 title = similar['title']
                 html += '<table><tr><td>\n'
@@ -631,6 +687,18 @@ class RecipeManager(object):
             html += '</div>\n'
         return html
 
+    @staticmethod
+    def get_recipe_id(recipe_id):
+        """ Get the Database 'id' for a recipe
+        Args:
+            recipe_id: Database 'id' or title
+        Returns:
+            48 character id
+        """
+        if len(recipe_id) != 48 or not contains_only(recipe_id, r'[^2-7A-Z.]'):
+            recipe_id = generate_id(recipe_id)
+        return recipe_id
+
     def get_recipe(self, recipe_id):
         """ Load recipe from Database
         Args:
@@ -638,8 +706,7 @@ class RecipeManager(object):
         Returns:
             dictionary
         """
-        if len(recipe_id) != 48 or not contains_only(recipe_id, r'[^2-7A-Z.]'):
-            recipe_id = generate_id(recipe_id)
+        recipe_id = self.get_recipe_id(recipe_id)
         if recipe_id in self.recipes:
             recipe = self.recipes[recipe_id]
         else:
@@ -656,23 +723,31 @@ class RecipeManager(object):
         if 'title' in recipe:
             recipe_id = generate_id(recipe['title'])
             recipe['id'] = recipe_id
+            with self.rendered_lock:
+                self.rendered.pop(('recipe', recipe_id), None)
             return self.database.put_item(recipe)
         return dict(error='Missing recipe title')
 
     def get_rendered_recipe(self, recipe_id):
-        """ Get HTML rendered recipe
+        """ Get HTML rendered recipe. Only loaded recipes are cached, those read from the
+            Database are rendered for each request so edits are shown.
         Args:
             recipe id or title
         Returns:
             HTML for recipe
         """
-
+        key = ('recipe', self.get_recipe_id(recipe_id))
+        html = self._cached(key)
+        if html is not None:
+            return html
         recipe = self.get_recipe(recipe_id)
         if recipe is None:
             return {'error': 'recipe not found: ' + recipe_id}
         if 'error' in recipe:
             return recipe
-        return self.render_recipe(recipe)
+        if key[1] not in self.recipes:
+            return self.render_recipe(recipe)
+        return self._cache(key, self.render_recipe(recipe))
 
     def get_recipe_list(self, matches):
         """ Get HTML rendered recipe summaries for search match
@@ -816,6 +891,10 @@ class RecipeManager(object):
         Returns:
             HTML container with image gallery
         """
+        key = ('gallery', frozenset(matches or ()))
+        html = self._cached(key)
+        if html is not None:
+            return html
         if matches:
             html = self.get_recipe_list(matches)
         else:
@@ -832,7 +911,33 @@ class RecipeManager(object):
                 html += '</figure>\n'
                 html += '</td></tr></table>\n'
             html += '</div>\n'
-        return html
+        return self._cache(key, html)
+
+    def warm_cache(self, titles, categories=10):
+        """ Render the most popular recipes and the galleries of their categories ahead of
+            requests, e.g. at worker start. Only loaded recipes are rendered, titles from the
+            events log that are unknown are skipped rather than looked up in the database.
+        Args:
+            titles: recipe titles, most viewed first
+            categories: number of gallery categories to render
+        Returns:
+            number of pages rendered
+        """
+        ranked = {}
+        count = 0
+        for rank, title in enumerate(titles):
+            recipe = self.recipes.get(generate_id(title))
+            if recipe is None:
+                continue
+            self.get_rendered_recipe(title)
+            count += 1
+            for category in recipe.get('category', []):
+                ranked[category] = ranked.get(category, 0) + len(titles) - rank
+        self.get_rendered_gallery()
+        for category in sorted(ranked, key=ranked.get, reverse=True)[:categories]:
+            self.get_rendered_gallery(self.match_recipe_by_category(re.escape(category)))
+            count += 1
+        return count + 1
 
 def main():
     """ Unit tests
@@ -0,0 +1,208 @@
+#!/usr/bin python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2021 Alan Frost, Inc. All rights reserved.
+
+Offline recipe recommendations from co-viewed recipes, blended with category and ingredient
+overlap, written as a table of neighbors for each recipe
+"""
+
+from __future__ import print_function
+
+import heapq
+import json
+import math
+import re
+from collections import OrderedDict
+
+WORD = re.compile(r'[a-z]{3,}')
+
+def ingredient_words(ingredients):
+    """ Get the words of the ingredient names in a recipe, including sections
+    Args:
+        ingredients: recipe ingredients dictionary
+    Return:
+        set of lower case words
+    """
+    words = set()
+    for key, value in ingredients.items():
+        if isinstance(value, dict):
+            words.update(ingredient_words(value))
+        elif key == 'ingredient' and value:
+            words.update(WORD.findall(value.lower()))
+    return words
+
+def session_views(events, session_gap=1800, max_users=100000, max_session=50):
+    """ Group recipe views into sessions, the recipes a uid viewed without a gap longer than
+        session_gap. Open sessions are held for at most max_users uids, the least recently
+        active is closed early beyond that, so memory is bounded for any size of log.
+    Args:
+        events: iterable of 'recipes' events in time order
+        session_gap: seconds of inactivity that end a session
+        max_users: maximum open sessions
+        max_session: maximum distinct recipes kept per session
+    Return:
+        generator of sets of recipe titles viewed in a session
+    """
+    sessions = OrderedDict()
+    for event in events:
+        title = event.get('recipe')
+        uid = event.get('uid')
+        if not title or not uid:
+            continue
+        stamp = event.get('ts', 0)
+        session = sessions.pop(uid, None)
+        if session is not None and stamp - session[0] > session_gap:
+            if len(session[1]) > 1:
+                yield session[1]
+            session = None
+        if session is None:
+            session = [stamp, set()]
+        session[0] = stamp
+        if len(session[1]) < max_session:
+            session[1].add(title)
+        sessions[uid] = session
+        while len(sessions) > max_users:
+            _, oldest = sessions.popitem(last=False)
+            if len(oldest[1]) > 1:
+                yield oldest[1]
+    for _, session in sessions.items():
+        if len(session[1]) > 1:
+            yield session[1]
+
+class CoViewModel(object):
+    """ Item to item similarity from co-viewed recipes, held as a sparse dict of dicts of pair
+        counts, blended with the overlap of categories and ingredients
+    """
+    def __init__(self, recipes, coview_weight=0.7, shrink=5.0, common=0.25):
+        """ Constructor
+        Args:
+            recipes: dict of recipe id to recipe
+            coview_weight: weight of co-view similarity with enough support, 0.0 - 1.0
+            shrink: co-view count at which the co-view weight is half of coview_weight
+            common: ingredient words in more than this fraction of recipes are ignored
+        """
+        self.recipes = dict((recipe['title'], recipe) for recipe in recipes.values())
+        self.coview_weight = coview_weight
+        self.shrink = shrink
+        self.views = {}
+        self.pairs = {}
+        self.sessions = 0
+        counts = {}
+        words = {}
+        for title, recipe in self.recipes.items():
+            words[title] = ingredient_words(recipe.get('ingredients', {}))
+            for word in words[title]:
+                counts[word] = counts.get(word, 0) + 1
+        limit = max(2, common * len(self.recipes))
+        self.words = dict((title, set(word for word in found if counts[word] <= limit))
+                          for title, found in words.items())
+        self.categories = dict((title, set(recipe.get('category') or []))
+                               for title, recipe in self.recipes.items())
+
+    def add_sessions(self, sessions):
+        """ Count the views and co-views of recipes in sessions
+        Args:
+            sessions: iterable of sets of recipe titles
+        Return:
+            self
+        """
+        for titles in sessions:
+            titles = [title for title in titles if title in self.recipes]
+            if len(titles) < 2:
+                continue
+            self.sessions += 1
+            for title in titles:
+                self.views[title] = self.views.get(title, 0) + 1
+                row = self.pairs.setdefault(title, {})
+                for other in titles:
+                    if other != title:
+                        row[other] = row.get(other, 0) + 1
+        return self
+
+    def content_similarity(self, title, other):
+        """ Get the category and ingredient overlap of two recipes
+        Args:
+            title, other: recipe titles
+        Return:
+            average of the Jaccard indexes, 0.0 - 1.0
+        """
+        similarity = 0.0
+        for sets in (self.categories, self.words):
+            first, second = sets[title], sets[other]
+            if first and second:
+                similarity += float(len(first & second)) / len(first | second)
+        return similarity / 2
+
+    def similarity(self, title, other):
+        """ Get the blended similarity of two recipes, the co-view cosine similarity weighted
+            by how many sessions support it
+        Args:
+            title, other: recipe titles
+        Return:
+            similarity 0.0 - 1.0
+        """
+        together = self.pairs.get(title, {}).get(other, 0)
+        content = self.content_similarity(title, other)
+        if not together:
+            return (1.0 - self.coview_weight) * content
+        cosine = together / math.sqrt(self.views[title] * self.views[other])
+        weight = self.coview_weight * together / (together + self.shrink)
+        return weight * cosine + (1.0 - weight) * content
+
+    def neighbors(self, count=4):
+        """ Get the most similar recipes for every recipe
+        Args:
+            count: neighbors per recipe
+        Return:
+            dict of title to list of titles, most similar first
+        """
+        table = {}
+        titles = sorted(self.recipes)
+        for title in titles:
+            scores = ((self.similarity(title, other), other) for other in titles
+                      if other != title)
+            table[title] = [other for score, other in heapq.nlargest(count, scores) if score > 0]
+        return table
+
+def build_neighbors(recipes, events, outfile, count=4, **kwargs):
+    """ Build the neighbors table from recipe view events and write it as JSON
+    Args:
+        recipes: dict of recipe id to recipe
+        events: iterable of 'recipes' events in time order
+        outfile: file name to write
+        count: neighbors per recipe
+        kwargs: CoViewModel options
+    Return:
+        CoViewModel
+    """
+    model = CoViewModel(recipes, **kwargs).add_sessions(session_views(events))
+    with open(outfile, 'w') as output:
+        json.dump(model.neighbors(count), output, separators=(',', ':'), sort_keys=True)
+    return model
+
+def main():
+    """ Unit tests
+    """
+    recipes = {
+        'a': {'title': 'Korean Meatballs', 'category': ['Asian', 'Meat'],
+              'ingredients': {'item1': {'ingredient': 'lean ground turkey'},
+                              'item2': {'ingredient': 'ginger'}}},
+        'b': {'title': 'Vietnamese Meatballs', 'category': ['Asian', 'Meat'],
+              'ingredients': {'item1': {'ingredient': 'lean ground pork'},
+                              'item2': {'ingredient': 'ginger'}}},
+        'c': {'title': 'Apricot Scones', 'category': ['Breakfast'],
+              'ingredients': {'section1': {'item1': {'ingredient': 'apricot jam'}}}},
+        'd': {'title': 'Orange Chicken', 'category': ['Asian'],
+              'ingredients': {'item1': {'ingredient': 'chicken thighs'}}},
+    }
+    events = []
+    for user in range(20):
+        events.append({'uid': str(user), 'ts': user, 'recipe': 'Korean Meatballs'})
+        events.append({'uid': str(user), 'ts': user + 60, 'recipe': 'Apricot Scones'})
+    model = CoViewModel(recipes).add_sessions(session_views(events))
+    print(model.sessions, model.neighbors(2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin python
+# -*- coding: utf-8 -*-
+
+"""
+Copyright (c) 2021 Alan Frost, Inc. All rights reserved.
+
+Replay recorded events against a server as a load test
+"""
+
+from __future__ import print_function
+
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+def percentile(ordered, fraction):
+    """ Get a percentile by the nearest rank method
+    Args:
+        ordered: sorted list of values
+        fraction: 0.0 - 1.0
+    Return:
+        value or None for an empty list
+    """
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class LatencyRecorder(object):
+    """ Request latencies and outcomes per action, each action keeps a uniform random sample of
+        at most max_samples latencies so that memory is bounded for long replays
+    """
+    def __init__(self, max_samples=10000):
+        """ Constructor
+        Args:
+            max_samples: latencies kept per action
+        """
+        self.max_samples = max_samples
+        self.actions = {}
+        self.lock = threading.Lock()
+
+    def record(self, action, latency, status):
+        """ Record a request
+        Args:
+            action: event type
+            latency: seconds
+            status: HTTP status code, or None if the request failed
+        """
+        with self.lock:
+            entry = self.actions.get(action)
+            if entry is None:
+                entry = {'count': 0, 'errors': 0, 'samples': []}
+                self.actions[action] = entry
+            entry['count'] += 1
+            if status is None or status >= 500:
+                entry['errors'] += 1
+            samples = entry['samples']
+            if len(samples) < self.max_samples:
+                samples.append(latency)
+            else:
+                index = random.randint(0, entry['count'] - 1)
+                if index < self.max_samples:
+                    samples[index] = latency
+
+    def report(self):
+        """ Get the latency percentiles per action
+        Return:
+            dict of action to count, errors and p50, p90, p99 and max in milliseconds
+        """
+        report = {}
+        with self.lock:
+            for action, entry in self.actions.items():
+                ordered = sorted(entry['samples'])
+                report[action] = {'count': entry['count'], 'errors': entry['errors']}
+                for name, fraction in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)]:
+                    report[action][name] = round(percentile(ordered, fraction) * 1000, 1)
+        return report
+
+class EventReplayer(object):
+    """ Replay events against a server, preserving the recorded spacing between events divided
+        by the speedup. Requests are sent from a pool of worker threads, and the scheduler
+        waits when all workers are busy so the backlog and memory stay bounded.
+    """
+    def __init__(self, manager, url, speedup=1.0, concurrency=8, methods=('GET',), timeout=10):
+        """ Constructor
+        Args:
+            manager: EventManager, for make_rest
+            url: base url of the target server
+            speedup: replay rate relative to the recorded rate, 0 for as fast as possible
+            concurrency: maximum requests in flight
+            methods: HTTP methods to replay, by default only GET so state is not changed
+            timeout: request timeout in seconds
+        """
+        self.manager = manager
+        self.url = url.rstrip('/')
+        self.speedup = speedup
+        self.concurrency = concurrency
+        self.methods = set(methods)
+        self.timeout = timeout
+        self.recorder = LatencyRecorder()
+        self.skipped = 0
+        self.late = 0
+        self.local = threading.local()
+        self.slots = threading.BoundedSemaphore(concurrency)
+
+    def _session(self):
+        """ Get the HTTP session for this worker thread, so connections are reused
+        Return:
+            requests.Session
+        """
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            self.local.session = session
+        return session
+
+    def _send(self, action, rest):
+        """ Send a request and record its latency
+        Args:
+            action: event type
+            rest: dict of url, method and params from make_rest
+        """
+        start = time.time()
+        status = None
+        try:
+            if rest['method'] in ('GET', 'DELETE'):
+                response = self._session().request(rest['method'], rest['url'],
+                                                   params=rest['params'], timeout=self.timeout,
+                                                   allow_redirects=False)
+            else:
+                response = self._session().request(rest['method'], rest['url'],
+                                                   json=rest['params'], timeout=self.timeout,
+                                                   allow_redirects=False)
+            status = response.status_code
+        except requests.RequestException:
+            pass
+        finally:
+            self.recorder.record(action, time.time() - start, status)
+            self.slots.release()
+
+    def run(self, events, limit=None):
+        """ Replay a stream of events
+        Args:
+            events: iterable of event dicts in time order
+            limit: optional maximum number of requests
+        Return:
+            dict of elapsed time, requests sent, skipped events and latencies per action
+        """
+        sent = 0
+        first = None
+        start = time.time()
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            for event in events:
+                rest = self.manager.make_rest(self.url, event)
+                if not rest or rest['method'] not in self.methods:
+                    self.skipped += 1
+                    continue
+                stamp = event.get('ts', 0)
+                if first is None:
+                    first = stamp
+                if self.speedup:
+                    delay = start + (stamp - first) / float(self.speedup) - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                    elif delay < -1:
+                        self.late += 1
+                self.slots.acquire()
+                executor.submit(self._send, event['type'], rest)
+                sent += 1
+                if limit and sent >= limit:
+                    break
+        return {'elapsed': round(time.time() - start, 3), 'sent': sent, 'skipped': self.skipped,
+                'late': self.late, 'actions': self.recorder.report()}
+
+def main():
+    """ Unit tests, replay against a local server
+    """
+    import json
+    from events import EventManager
+    now = int(time.time())
+    events = [{'type': 'recipes', 'ts': now + count // 20, 'uid': 'SZO2HM6',
+               'recipe': 'Korean Meatballs'} for count in range(100)]
+    events.append({'type': 'login', 'ts': now + 5, 'uid': 'SZO2HM6'})
+    replayer = EventReplayer(EventManager({}), 'http://localhost:8080', speedup=10)
+    print(json.dumps(replayer.run(events), indent=1))
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
 import base64
+import io
 import os
 from crypto import derive_key, scrypt_key, hkdf_key, encrypt_aes_gcm, decrypt_aes_gcm, hmac_sha256
+from crypto import PasswordHasher, hash_password, needs_rehash, calibrate_kdf, set_kdf
+from crypto import get_aead, ECKeyring, generate_ec, get_ec_public, encrypt_ecdh, decrypt_ecdh
 
 def test_encryption():
     mcf = derive_key ('Password1*')
@@ -36,5 +39,91 @@ def test_encryption():
     key = hmac_sha256(salt, base64.b64decode('6EVdXfSkSX+I15ZXGCRRH4TnpBnt17ivih5Nd7DxkPQ='))
     print base64.b64encode(key)
 
+def test_password_hasher():
+    hasher = PasswordHasher(2, 4)
+    mcf = hasher.derive('Password1*')
+    assert (hasher.derive('Password1*', mcf) == mcf)
+    assert (hasher.derive('Password2*', mcf) == '')
+    hasher.shutdown()
+    stats = hasher.stats()
+    assert (stats['completed'] == 3 and stats['pending'] == 0)
+
+    # A verification at a high iteration count keeps the only worker busy
+    fields = mcf.split('$')
+    slow_mcf = '$'.join(fields[:2] + ['2000000'] + fields[3:])
+    hasher = PasswordHasher(1, 1)
+    future = hasher.submit('Password1*', slow_mcf)
+    assert (hasher.submit('Password1*', mcf) is None)
+    assert (future.result() == '')
+    hasher.shutdown()
+    stats = hasher.stats()
+    assert (stats['rejected'] == 1 and stats['completed'] == 1 and stats['pending'] == 0)
+
+def test_kdf_rehash():
+    mcf = hash_password('Password1*')
+    assert (mcf.startswith('$pbkdf2$100000$'))
+    assert (hash_password('Password1*', mcf) == mcf)
+    assert (not needs_rehash(mcf))
+    cost = calibrate_kdf(1)
+    assert (cost == 100000)
+
+    set_kdf('pbkdf2', 120000)
+    assert (needs_rehash(mcf))
+    set_kdf('scrypt')
+    newmcf = hash_password('Password1*')
+    assert (newmcf.startswith('$scrypt$16384$'))
+    assert (hash_password('Password1*', newmcf) == newmcf)
+    assert (hash_password('Password2*', newmcf) == '')
+    assert (not needs_rehash(newmcf))
+    assert (needs_rehash(mcf))
+    set_kdf('pbkdf2', 100000)
+
+def test_aead_stream():
+    aead = get_aead(b'secret', b'info', b'salt')
+    assert (get_aead(b'secret', b'info', b'salt') is aead)
+    assert (aead.decrypt(aead.encrypt(b'Hi there', b'aad'), b'aad') == b'Hi there')
+    assert (aead.decrypt(aead.encrypt(b'Hi there', b'aad')) is None)
+
+    for size in [0, 1000, 4096, 10000]:
+        message = os.urandom(size)
+        cipher_text = io.BytesIO()
+        assert (aead.encrypt_stream(io.BytesIO(message), cipher_text, 1024) == size)
+        plain_text = io.BytesIO()
+        assert (aead.decrypt_stream(io.BytesIO(cipher_text.getvalue()), plain_text) == size)
+        assert (plain_text.getvalue() == message)
+
+    stream = cipher_text.getvalue()
+    truncated = stream[:-(len(stream) - 15 - 4 - 1040)]
+    assert (aead.decrypt_stream(io.BytesIO(truncated), io.BytesIO()) is None)
+    tampered = stream[:100] + chr(ord(stream[100]) ^ 1) + stream[101:]
+    assert (aead.decrypt_stream(io.BytesIO(tampered), io.BytesIO()) is None)
+
+def test_ec_keyring():
+    peer_key = generate_ec()
+    peer_pem = get_ec_public(peer_key)
+    keyring = ECKeyring(workers=2)
+    fingerprint = keyring.add(peer_pem)
+    assert (keyring.add(peer_pem) == fingerprint)
+    assert (len(fingerprint) == 64)
+
+    my_pem = get_ec_public(keyring.ec_key)
+    payload = keyring.encrypt(fingerprint, b'Hi there', b'info')
+    assert (decrypt_ecdh(peer_key, my_pem, payload, b'info') == b'Hi there')
+    payload = encrypt_ecdh(peer_key, my_pem, b'Hi back', b'info')
+    assert (keyring.decrypt(peer_pem, payload, b'info') == b'Hi back')
+
+    messages = [b'message %d' % count for count in range(8)]
+    peer_ring = ECKeyring(peer_key)
+    items = [(fingerprint, peer_ring.sign(message), message) for message in messages]
+    items.append((fingerprint, items[0][1], b'forged'))
+    assert (keyring.verify_batch(items) == [True] * 8 + [False])
+    keyring.remove(fingerprint)
+    assert (keyring.public_key(fingerprint) is None)
+    keyring.shutdown()
+
 if __name__ == '__main__':
     test_encryption()
+    test_password_hasher()
+    test_kdf_rehash()
+    test_aead_stream()
+    test_ec_keyring()
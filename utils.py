@@ -20,13 +20,16 @@ import time
 import uuid
 import re
 import json
-from itsdangerous import URLSafeSerializer, URLSafeTimedSerializer
+from collections import OrderedDict
+from threading import Lock
+from itsdangerous import Signer, TimestampSigner, URLSafeSerializer, URLSafeTimedSerializer
 from cryptography.hazmat.primitives.twofactor.hotp import HOTP
 from cryptography.hazmat.primitives.twofactor.totp import TOTP
 from cryptography.hazmat.primitives.hashes import SHA1
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.twofactor import InvalidToken
-from crypto import derive_key, hkdf_key, encrypt_aes_gcm, decrypt_aes_gcm, hash_sha256, hmac_sha256
+import base58
+from crypto import derive_key, get_aead, hash_sha256, hmac_sha256
 
 if sys.version_info.major == 3:
     unicode = str
@@ -38,8 +41,14 @@ HKDF_SALT = base64.b64decode('MTIzNDU2Nzg5MGFiY2RlZmdoaWprbG1ub3BxcnN0dXY=')
 HDKF_INFO = b'frosty.alan'
 HMAC_INFO = b'FrostyWeb'
 
+SERIALIZERS = {}
+SERIALIZERS_LIMIT = 256
+USER_IDS = OrderedDict()
+USER_IDS_LIMIT = 4096
+USER_IDS_LOCK = Lock()
+
 # Bitcoin compatible base58 encoding
-B58ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+B58ALPHABET = base58.ALPHABET
 
 
 def generate_uuid():
@@ -102,14 +111,7 @@ def base58encode_int(number, default_one=True):
     Return:
         base58 encoded string
     """
-    if not number and default_one:
-        return B58ALPHABET[0]
-    encoded = ""
-    while number:
-        number, idx = divmod(number, 58)
-        encoded = B58ALPHABET[idx] + encoded
-    return encoded
-
+    return base58.encode_int(number, default_one)
 
 def base58encode(source):
     """Encode a string using base58
@@ -118,27 +120,7 @@ def base58encode(source):
     Return:
         base58 encoded string
     """
-    if isinstance(source, unicode):
-        source = source.encode('utf-8')
-    elif not isinstance(source, bytes):
-        raise TypeError("a bytes-like object is required, not '%s'" %
-                        type(string).__name__)
-
-    pad = len(source)
-    source = source.lstrip(b'\0')
-    pad -= len(source)
-
-    # Python 2.7 or 3 require different way to construct integer array
-    iseq = lambda s: [ord(ordinal) for ordinal in s] if bytes == str else lambda s: s
-
-    pos, acc = 1, 0
-    for char in source:
-        acc += pos * char
-        pos = pos << 8
-
-    result = base58encode_int(acc, default_one=False)
-
-    return B58ALPHABET[0] * pad + result
+    return base58.encode(source)
 
 def base58decode_int(source):
     """ Decode a base58 encoded string as an integer
@@ -147,15 +129,7 @@ def base58decode_int(source):
     Return:
         integer value
     """
-
-    if not isinstance(source, str):
-        source = source.decode('utf-8')
-
-    decimal = 0
-    for char in source:
-        decimal = decimal * 58 + B58ALPHABET.index(char)
-    return decimal
-
+    return base58.decode_int(source)
 
 def base58decode(source):
     """ Decode a base58 encoded string
@@ -164,30 +138,7 @@ def base58decode(source):
     Return:
         string value
     """
-
-    if not isinstance(source, str):
-        source = source.decode('utf-8')
-
-    if not isinstance(source, str):
-        raise TypeError("a source-like object is required (also bytes), not '%s'" %
-                        type(source).__name__)
-
-    origlen = len(source)
-    source = source.lstrip(B58ALPHABET[0])
-    newlen = len(source)
-
-    acc = base58decode_int(source)
-
-    result = []
-    while acc > 0:
-        acc, mod = divmod(acc, 256)
-        result.append(mod)
-
-    # Python 2.7 or 3 require different way to construct byte array
-    bseq = lambda s: ''.join([chr(char) for char in s]) if bytes == str else bytes
-
-    return b'\0' * (origlen - newlen) + bseq(reversed(result))
-
+    return base58.decode(source)
 
 def base58encode_check(source):
     """ Encode a string using Base58 with a 4 character checksum
@@ -196,9 +147,7 @@ def base58encode_check(source):
     Return:
         base58 encoded string
     """
-
-    digest = hash_sha256(hash_sha256(source))
-    return base58encode(source + digest[:4])
+    return base58.encode_check(source)
 
 def base58decode_check(source):
     """ Decode and verify the checksum of a base58 encoded string
@@ -207,15 +156,7 @@ def base58decode_check(source):
     Return:
         string value
     """
-
-    result = base58decode(source)
-    result, check = result[:-4], result[-4:]
-    digest = hash_sha256(hash_sha256(result))
-
-    if check != digest[:4]:
-        raise ValueError("Invalid checksum")
-
-    return result
+    return base58.decode_check(source)
 
 def check_password(password):
     """ Simple password validator for at least 8 characters with a lower, upper and digit
@@ -311,6 +252,18 @@ def preset_password(username, password):
     hashword = base64.b16encode(hmac_sha256(username, password)).lower()
     return derive_key(hashword)
 
+def get_signed_request_message(method, path, params, time_stamp):
+    """ Get the string to sign for an HTTP request
+    Args:
+        HTTP method (GET, PUT...)
+        path - HTTP request path with leading slash, e.g., '/api/camera.update'
+        params - JSON for POST/PUT/PATCH, query string for GET/DELETE
+        time stamp of request as Unix timestamp (integer seconds since Jan 1, 1970 UTC)
+    """
+    algorithm = 'HMAC_SHA256'
+    param_hash = base64.b16encode(hash_sha256(params)).decode('ascii')
+    return algorithm + '\n' + str(time_stamp) + '\n' + method + '\n' + path + '\n' + param_hash
+
 def create_signed_request(secret, method, path, params, time_stamp):
     """ Create a signed HTTP request
     Args:
@@ -320,10 +273,8 @@ def create_signed_request(secret, method, path, params, time_stamp):
         params - JSON for POST/PUT/PATCH, query string for GET/DELETE
         time stamp of request as Unix timestamp (integer seconds since Jan 1, 1970 UTC)
     """
-    algorithm = 'HMAC_SHA256'
     key = get_hmac_signing_key(secret, str(time_stamp))
-    param_hash = base64.b16encode(hash_sha256(params)).decode('ascii')
-    msg = algorithm + '\n' + str(time_stamp) + '\n' + method + '\n' + path + '\n' + param_hash
+    msg = get_signed_request_message(method, path, params, time_stamp)
     signature = base64.b16encode(hmac_sha256(key, msg)).decode('ascii')
     return signature
     #authorization_header = algorithm + ' ' + 'SignedHeaders=' + signed_headers + ', ' + 'Signature=' + signature
@@ -349,10 +300,8 @@ def validate_signed_request(secret, method, path, params, time_stamp, signature)
     time_diff = int(time.time()) - time_stamp
     if time_diff > 450 or time_diff < -450:
         return False
-    algorithm = 'HMAC_SHA256'
     key = get_hmac_signing_key(secret, str(time_stamp))
-    param_hash = base64.b16encode(hash_sha256(params)).decode('ascii')
-    msg = algorithm + '\n' + str(time_stamp) + '\n' + method + '\n' + path + '\n' + param_hash
+    msg = get_signed_request_message(method, path, params, time_stamp)
     signed = base64.b16encode(hmac_sha256(key, msg))
     return signed == signature
 
@@ -369,7 +318,7 @@ def get_hmac_signing_key(secret, time_stamp):
         secret = secret.encode('utf-8')
     if isinstance(time_stamp, unicode):
         time_stamp = time_stamp.encode('utf-8')
-    return hmac_sha256(HMAC_INFO + secret, time_stamp)
+    return hmac_sha256(HMAC_INFO + secret, time_stamp, cache=True)
 
 def encrypt_pii(secret, params):
     """ Encrypt PII parameters
@@ -381,10 +330,7 @@ def encrypt_pii(secret, params):
     """
     if isinstance(secret, unicode):
         secret = secret.encode('utf-8')
-    iv = os.urandom(12)
-    key = hkdf_key(secret, HDKF_INFO, HKDF_SALT)
-    cipher_text = iv + encrypt_aes_gcm(key, iv, json.dumps(params))
-    return cipher_text
+    return get_aead(secret, HDKF_INFO, HKDF_SALT).encrypt(json.dumps(params))
 
 def decrypt_pii(secret, cipher_text):
     """ Decrypt PII parameters
@@ -396,8 +342,7 @@ def decrypt_pii(secret, cipher_text):
     """
     if isinstance(secret, unicode):
         secret = secret.encode('utf-8')
-    key = hkdf_key(secret, HDKF_INFO, HKDF_SALT)
-    plain_text = decrypt_aes_gcm(key, cipher_text[:12], cipher_text[12:])
+    plain_text = get_aead(secret, HDKF_INFO, HKDF_SALT).decrypt(cipher_text)
     try:
         params = json.loads(plain_text)
         return params
@@ -677,6 +622,67 @@ def merge_dicts_remove(dict1, dict2):
             dict1[key] = dict2[key]
     return True
 
+class DerivedKeyMixin(object):
+    """ Signer mixin that derives the signing key from the secret and salt only once
+    """
+    def derive_key(self):
+        key = self.__dict__.get('_derived_key')
+        if key is None:
+            key = super(DerivedKeyMixin, self).derive_key()
+            self._derived_key = key
+        return key
+
+class CachedSigner(DerivedKeyMixin, Signer):
+    """ Signer with a cached derived key
+    """
+
+class CachedTimestampSigner(DerivedKeyMixin, TimestampSigner):
+    """ Timestamp signer with a cached derived key
+    """
+
+class SignerCacheMixin(object):
+    """ Serializer mixin that reuses one signer for its own salt
+    """
+    def make_signer(self, salt=None):
+        if salt is not None and salt != self.salt:
+            return super(SignerCacheMixin, self).make_signer(salt)
+        signer = self.__dict__.get('_signer')
+        if signer is None:
+            signer = super(SignerCacheMixin, self).make_signer(salt)
+            self._signer = signer
+        return signer
+
+class CachedSerializer(SignerCacheMixin, URLSafeSerializer):
+    """ URL safe serializer with a cached signer
+    """
+    default_signer = CachedSigner
+
+class CachedTimedSerializer(SignerCacheMixin, URLSafeTimedSerializer):
+    """ URL safe timed serializer with a cached signer
+    """
+    default_signer = CachedTimestampSigner
+
+def get_serializer(secret, salt, timed=False):
+    """ Get a shared serializer for a secret and salt, so the signing key is only derived once
+    Args:
+        secret: secret key to use for signing
+        salt: namespace or other known value
+        timed: True for a serializer that adds a time stamp
+    Return:
+        serializer
+    """
+    key = (secret, salt, timed)
+    serializer = SERIALIZERS.get(key)
+    if serializer is None:
+        if timed:
+            serializer = CachedTimedSerializer(secret, salt=salt)
+        else:
+            serializer = CachedSerializer(secret, salt=salt)
+        if len(SERIALIZERS) >= SERIALIZERS_LIMIT:
+            SERIALIZERS.clear()
+        SERIALIZERS[key] = serializer
+    return serializer
+
 def generate_token(value, secret, salt):
     """ Generate a URL safe signature
         Args:
@@ -686,8 +692,7 @@ def generate_token(value, secret, salt):
         Return:
             signature as string
     """
-    serializer = URLSafeSerializer(secret)
-    return serializer.dumps(value, salt=salt)
+    return get_serializer(secret, salt).dumps(value)
 
 def validate_token(token, secret, salt):
     """ Validate a URL safe signature
@@ -697,9 +702,8 @@ def validate_token(token, secret, salt):
         Return:
             (validated, value): if validated == True, then value has the to be signed data
     """
-    serializer = URLSafeSerializer(secret)
     try:
-        return serializer.loads_unsafe(token, salt=salt)
+        return get_serializer(secret, salt).loads_unsafe(token)
     except:
         return (False, None)
 
@@ -712,8 +716,7 @@ def generate_timed_token(value, secret, salt):
         Return:
             signature as string
     """
-    serializer = URLSafeTimedSerializer(secret)
-    return serializer.dumps(value, salt=salt)
+    return get_serializer(secret, salt, True).dumps(value)
 
 def validate_timed_token(token, secret, salt, expiration=86400):
     """ Validate a URL safe signature that expires in one day
@@ -725,12 +728,41 @@ def validate_timed_token(token, secret, salt, expiration=86400):
     Return:
         (validated, value): if validated == True, then value has the to be signed data
     """
-    serializer = URLSafeTimedSerializer(secret)
     try:
-        return serializer.loads_unsafe(token, salt=salt, max_age=expiration)
+        return get_serializer(secret, salt, True).loads_unsafe(token, max_age=expiration)
     except:
         return (False, None)
 
+def generate_session_token(secret, claims):
+    """ Generate an encrypted session token, so that session state can be kept in a cookie
+        without exposing the user's email
+    Args:
+        secret: secret to derive the encryption key from
+        claims: dictionary of session values, e.g. email, user, exp
+    Return:
+        URL safe token
+    """
+    return base64.urlsafe_b64encode(encrypt_pii(secret, claims)).rstrip('=')
+
+def validate_session_token(secret, token):
+    """ Decrypt and authenticate a session token
+    Args:
+        secret: secret to derive the encryption key from
+        token: session token from generate_session_token
+    Return:
+        dictionary of session values, or None if the token is invalid
+    """
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
+    try:
+        cipher_text = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        if len(cipher_text) <= 28:
+            return None
+        claims = decrypt_pii(secret, cipher_text)
+    except (TypeError, ValueError):
+        return None
+    return claims if isinstance(claims, dict) else None
+
 def generate_address_code(secret, identifier):
     """ Generate a random address for account, with partial HMAC, base32 encoded
     Args:
@@ -779,6 +811,11 @@ def generate_random58_id(size=8):
     """
     return base58encode(os.urandom(size))[0:size]
 
+def generate_random58_ids(count, size=8):
+    """ Generate a list of random ids encoded as base58
+    """
+    return base58.random_ids(count, size)
+
 def generate_random58_valid(size=8):
     """ Generate a random id encoded as base58 with 4 byte checksum
     """
@@ -804,10 +841,21 @@ def generate_user_id(key, user):
         HMAC key
         user name
     Returns:
-        Generated 48 character base32 user id
+        Generated 48 character base32 user id, recently used ids are cached
     """
-    digest = hmac_sha256(key, user)
-    return base64.b32encode(digest[0:30])
+    cache_key = (key, user)
+    with USER_IDS_LOCK:
+        userid = USER_IDS.pop(cache_key, None)
+        if userid is not None:
+            USER_IDS[cache_key] = userid
+            return userid
+    digest = hmac_sha256(key, user, cache=True)
+    userid = base64.b32encode(digest[0:30])
+    with USER_IDS_LOCK:
+        USER_IDS[cache_key] = userid
+        while len(USER_IDS) > USER_IDS_LIMIT:
+            USER_IDS.popitem(last=False)
+    return userid
 
 def contains_only(input_chars, valid_chars):
     """ Check a string to see if it contains only the specified character set
@@ -873,6 +921,32 @@ def main():
     validated, value = validate_token(confirm_tok, secret, 'confirm')
     if validated:
         print('Error, this is a timed token')
+
+    session_tok = generate_session_token(secret, {'email': 'yuki@gmail.com', 'user': 'Yuki',
+                                                  'locked': False, 'exp': 1700000000})
+    print(session_tok, validate_session_token(secret, session_tok))
+    if validate_session_token(secret, session_tok[:-2] + 'AA') is not None:
+        print('Error, tampered session token accepted')
+
+    # Token and user id microbenchmark, cached helpers against constructing per call
+    start = time.time()
+    for _ in range(10000):
+        token = URLSafeTimedSerializer(secret).dumps('yuki@gmail.com', salt='confirm')
+        URLSafeTimedSerializer(secret).loads_unsafe(token, salt='confirm', max_age=86400)
+    print('{:.1f} usec per uncached timed token'.format((time.time() - start) * 100))
+    start = time.time()
+    for _ in range(10000):
+        token = generate_timed_token('yuki@gmail.com', secret, 'confirm')
+        validate_timed_token(token, secret, 'confirm')
+    print('{:.1f} usec per cached timed token'.format((time.time() - start) * 100))
+    start = time.time()
+    for _ in range(10000):
+        base64.b32encode(hmac_sha256(secret, 'yuki@gmail.com')[0:30])
+    print('{:.1f} usec per user id hmac'.format((time.time() - start) * 100))
+    start = time.time()
+    for _ in range(10000):
+        generate_user_id(secret, 'yuki@gmail.com')
+    print('{:.1f} usec per cached user id'.format((time.time() - start) * 100))
     validated, value = validate_timed_token(confirm_tok, secret, 'reset')
     if validated:
         print('Error, not a reset token')
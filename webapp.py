@@ -13,46 +13,75 @@ from __future__ import print_function
 import logging
 import signal
 import socket
+import sqlite3
 from datetime import datetime
 import time
+from threading import Thread
 from urlparse import urlparse, urljoin
 import json
 from werkzeug.utils import secure_filename
 from flask_wtf.csrf import CSRFProtect
-import jinja2
 
 from botocore.exceptions import EndpointConnectionError, ClientError
-from flask import (Flask, make_response, request, render_template, redirect, jsonify,
-                   abort, flash, url_for)
+from flask import (Flask, make_response, request, redirect, jsonify, abort, flash, url_for, g,
+                   render_template as flask_render_template, session as cookie_session)
 from flask_login import (LoginManager, current_user, login_required, login_user, logout_user,
                          fresh_login_required)
 import pytz
-from decorators import async
+from decorators import async, configure_pool, shutdown_pool
 from forms import (AcceptForm, ChangePasswordForm, ConfirmForm, ForgotPasswordForm,
                    InviteForm, LoginForm, RegistrationForm, VerifyForm, ResetPasswordForm,
                    ResendForm, UploadForm)
-from crypto import derive_key
+from crypto import PasswordHasher, needs_rehash, set_kdf
 from utils import (load_config, generate_timed_token, validate_timed_token, generate_user_id,
                    generate_random58_id, generate_random_int, preset_password,
-                   generate_otp_secret, generate_hotp_code, verify_hotp_code, get_ip_address,
-                   check_code, check_phone, sanitize_name, get_user_agent)
-from awsutils import DynamoDB, SNS, SES, S3
+                   generate_otp_secret, get_ip_address,
+                   check_code, check_phone, sanitize_name, get_user_agent,
+                   generate_session_token, validate_session_token)
+from apiauth import SignedRequestAuth
+from awsutils import DynamoDB, SNS, SES, S3, SES_BULK_LIMIT, add_call_hook
 from recipe import RecipeManager
 from vault import VaultManager
 from events import EventManager
+from eventquery import EventQuery, scan, select
+from otp import OTPService
+from outbox import Outbox
+from mailer import EmailRenderer, personalize, template_name
+from metrics import RequestTimer
+from profiler import Profiler
+from ratelimit import LoginLimiter, TextThrottle
 
 CONFIG = load_config('config.json')
+REQUEST_TIMER = RequestTimer()
+add_call_hook(REQUEST_TIMER.db_call)
+PROFILER = Profiler(CONFIG.get('profile_dir')) if CONFIG.get('profile_dir') else None
+configure_pool(CONFIG.get('async_workers', 4), CONFIG.get('async_queue', 64),
+               CONFIG.get('async_policy', 'block'))
 
 USERS = DynamoDB(CONFIG, CONFIG.get('users'))
 SESSIONS = DynamoDB(CONFIG, CONFIG.get('sessions'))
 RECIPE_MANAGER = RecipeManager(CONFIG)
 RECIPE_MANAGER.load_recipes('recipes.json')
 RECIPE_MANAGER.load_references('sauces.json')
+RECIPE_MANAGER.load_neighbors(CONFIG.get('neighbors', 'neighbors.json'))
 RECIPE_LIST = RECIPE_MANAGER.build_search_list()
 VAULT_MANAGER = VaultManager(CONFIG)
 EVENT_MANAGER = EventManager(CONFIG)
-#SNS = SNS('FrostyWeb')
-#SES = SES('Alan Frost <alan@cyberfrosty.com>')
+EMAILER = SES(CONFIG.get('email_sender')) if CONFIG.get('email_sender') else None
+TEXTER = None
+if CONFIG.get('sms_enabled'):
+    TEXTER = SNS(CONFIG.get('sms_topic'), CONFIG.get('sms_sender_id'))
+TEXT_THROTTLE = TextThrottle(CONFIG)
+OTP = OTPService(CONFIG)
+API_AUTH = SignedRequestAuth(CONFIG.get('api_clients', {}),
+                             max_rate=CONFIG.get('api_max_rate', 100))
+LOGIN_LIMITER = LoginLimiter(CONFIG)
+# The cost is fixed by config, from manage.py calibrate, so it is the same after every restart
+set_kdf(CONFIG.get('kdf', 'pbkdf2'), CONFIG.get('kdf_cost'))
+HASHER = PasswordHasher(CONFIG.get('kdf_workers'), CONFIG.get('kdf_queue'))
+OUTBOX = Outbox(CONFIG)
+EMAIL_RENDERER = EmailRenderer(CONFIG)
+SES_TEMPLATES = set()
 
 # Log exceptions and errors to /var/log/cyberfrosty.log
 # 2017-05-11 08:29:26,696 ERROR webapp:main [Errno 51] Network is unreachable
@@ -63,7 +92,13 @@ SERVER_VERSION = '0.1'
 SERVER_START = int((datetime.now(tz=pytz.utc) -
                     datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds())
 MAX_FAILURES = 3
+BUSY_MESSAGE = 'Too many requests, please try again in a moment'
+ATTEMPTS_MESSAGE = 'Too many failed attempts, please try again later'
 LOCK_TIME = 1800
+SESSION_TOKENS = CONFIG.get('session_tokens', False)
+SESSION_LIFETIME = CONFIG.get('session_lifetime', 86400)
+SESSION_CHECK = CONFIG.get('session_check', 300)
+TIMING_EVENTS = CONFIG.get('timing_events', False)
 LOGIN_MANAGER = LoginManager()
 APP = Flask(__name__, static_url_path="")
 
@@ -72,6 +107,7 @@ APP.config['SSL_DISABLE'] = False
 APP.config['SESSION_COOKIE_HTTPONLY'] = True
 APP.config['REMEMBER_COOKIE_HTTPONLY'] = True
 APP.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 # Limit uploads to 16MB
+APP.config['WTF_CSRF_CHECK_DEFAULT'] = False # CSRF is checked in authenticate_request
 
 LOGIN_MANAGER.init_app(APP)
 LOGIN_MANAGER.login_view = "login"
@@ -79,41 +115,113 @@ LOGIN_MANAGER.login_message = "Please login to access this page"
 LOGIN_MANAGER.session_protection = "strong"
 CSRF = CSRFProtect(APP)
 
-@async
+def warm_recipe_caches():
+    """ Pre-render the most viewed recipes of the last warm_hours from the events log, and
+        the galleries of their categories, so a freshly started worker does not serve its
+        first requests from a cold render cache
+    """
+    hours = CONFIG.get('warm_hours', 24)
+    if not CONFIG.get('events') or not hours:
+        return
+    start = time.time()
+    try:
+        query = EventQuery(group_by='recipe')
+        query.consume(select(scan(CONFIG.get('events'), start - hours * 3600), set(['recipes'])))
+    except (IOError, OSError, ValueError) as err:
+        LOGGER.error('Cache warming failed: %s', err)
+        return
+    titles = [row['recipe'] for row in query.results(CONFIG.get('warm_recipes', 50))
+              if row['recipe']]
+    count = RECIPE_MANAGER.warm_cache(titles, CONFIG.get('warm_categories', 10))
+    print('Warmed {} pages from {} events in {:.2f} seconds'.format(count, query.events,
+                                                                    time.time() - start))
+
+warm_recipe_caches()
+
 def send_email(recipient, subject, action, **kwargs):
-    """ Send an email from a new thread
+    """ Queue an email for delivery by the outbox dispatcher
     Args:
         recipient
         email subject line
         action template
         arguments for templating
     """
-    env = jinja2.Environment(loader=jinja2.FileSystemLoader('./templates'))
-    template = env.get_template('email/' + action + '.txt')
-    text = template.render(**kwargs)
-    template = env.get_template('email/' + action + '.html')
-    html = template.render(title=subject, **kwargs)
+    OUTBOX.put('email', {'recipient': recipient, 'subject': subject, 'action': action,
+                         'params': kwargs})
 
-    #with APP.app_context():
-    #    try:
-    #        SES.send_email(recipient, subject, html, text)
-    #    except ClientError as err:
-    #        print(err.response['Error']['Message'])
-    print(subject)
-
-@async
 def send_text(phone, msg):
-    """ Send a text message from a new thread
+    """ Queue a text message for delivery by the outbox dispatcher
     Args:
         number: phone number (e.g. '+17702233322')
         message: text
     """
-    #with APP.app_context():
-    #    try:
-    #        SNS.send_sms(phone, msg)
-    #    except ClientError as err:
-    #        print(err.response['Error']['Message'])
-    print(msg)
+    OUTBOX.put('sms', {'phone': phone, 'message': msg})
+
+def deliver_email(message):
+    """ Render and send a queued email, called from the outbox dispatcher
+    Args:
+        message: dict with recipient, subject, action and templating params
+    """
+    text, html = EMAIL_RENDERER.render(message['subject'], message['action'],
+                                       **message.get('params', {}))
+    if EMAILER is not None:
+        EMAILER.send_email(message['recipient'], message['subject'], html, text)
+    else:
+        print(message['subject'])
+
+def deliver_text(message):
+    """ Send a queued text message, called from the outbox dispatcher
+    Args:
+        message: dict with phone and message
+    """
+    if TEXTER is not None:
+        response = TEXTER.send_sms(message['phone'], message['message'])
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+    else:
+        print(message['message'])
+
+def deliver_bulk_email(message):
+    """ Send a queued bulk email, called from the outbox dispatcher. Uses an SES template when
+        'ses_templates' is enabled, otherwise personalizes and sends each copy locally. On
+        failure only the destinations not yet delivered are left in the message for the retry.
+    Args:
+        message: dict with subject, text, html and a list of destinations
+    """
+    subject = message['subject']
+    destinations = message['destinations']
+    if EMAILER is not None and CONFIG.get('ses_templates'):
+        name = template_name(subject, message['text'], message['html'])
+        if name not in SES_TEMPLATES:
+            EMAILER.put_template(name, subject, message['html'], message['text'])
+            SES_TEMPLATES.add(name)
+        statuses = EMAILER.send_bulk_templated_email(name, destinations)
+        failed = [(destination, status) for destination, status in zip(destinations, statuses)
+                  if status.get('Status') != 'Success']
+        if failed:
+            message['destinations'] = [destination for destination, _ in failed]
+            raise RuntimeError('Bulk email failed for ' + ', '.join(
+                '{} ({})'.format(destination['recipient'], status.get('Error') or
+                                 status.get('Status')) for destination, status in failed))
+        return
+    remaining = list(destinations)
+    try:
+        for destination in destinations:
+            data = destination.get('data', {})
+            text = personalize(message['text'], data)
+            html = personalize(message['html'], data)
+            if EMAILER is not None:
+                EMAILER.send_email(destination['recipient'], subject, html, text)
+            else:
+                print(subject, destination['recipient'])
+            remaining.remove(destination)
+    finally:
+        message['destinations'] = remaining
+
+OUTBOX.register('email', deliver_email, CONFIG.get('email_rate', 14), group='ses')
+OUTBOX.register('bulk_email', deliver_bulk_email, CONFIG.get('email_rate', 14),
+                lambda message: len(message['destinations']), group='ses')
+OUTBOX.register('sms', deliver_text, CONFIG.get('sms_rate', 20))
 
 class User(object):
     """ Class for the current user
@@ -178,12 +286,60 @@ class User(object):
     def get_user(self):
         return self._user
 
+def issue_session_token(session, expires=None):
+    """ Store an encrypted session token in the session cookie, so that subsequent requests
+        can be authenticated without a database lookup
+    Args:
+        session: session database entry with email, user and failures
+        expires: token expiration time, defaults to SESSION_LIFETIME from now
+    """
+    now = int(time.time())
+    claims = {'email': session.get('email'), 'user': session.get('user'),
+              'locked': session.get('failures', 0) >= MAX_FAILURES,
+              'exp': expires or now + SESSION_LIFETIME, 'chk': now}
+    cookie_session['auth'] = generate_session_token(APP.config['SECRET_KEY'], claims)
+
+def load_session_token(userid):
+    """ Load the user from the session token in the session cookie. The session database is
+        only checked for revocation (logout or lock) every SESSION_CHECK seconds.
+    Args:
+        userid
+    Return:
+        User or None if there is no valid token
+    """
+    token = cookie_session.get('auth')
+    if not token:
+        return None
+    claims = validate_session_token(APP.config['SECRET_KEY'], token)
+    now = int(time.time())
+    if not claims or claims.get('exp', 0) < now:
+        cookie_session.pop('auth', None)
+        return None
+    user = User(claims.get('email'), claims.get('user'))
+    if user.get_id() != userid:
+        return None
+    locked = claims.get('locked')
+    if claims.get('chk', 0) + SESSION_CHECK < now:
+        session = SESSIONS.get_item('id', userid)
+        if 'error' in session:
+            cookie_session.pop('auth', None)
+            return None
+        issue_session_token(session, claims['exp'])
+        locked = session.get('failures', 0) >= MAX_FAILURES
+    user.is_authenticated = not locked
+    user.is_active = True
+    return user
+
 @LOGIN_MANAGER.user_loader
 def load_user(userid):
-    """ Load user account details from database
+    """ Load user account details from the session token or database
     Args:
         userid
     """
+    if SESSION_TOKENS:
+        user = load_session_token(userid)
+        if user is not None:
+            return user
     session = SESSIONS.get_item('id', userid)
     if 'error' in session:
         account = USERS.get_item('id', userid)
@@ -202,8 +358,91 @@ def load_user(userid):
         user = User(session.get('email'), name)
         user.is_authenticated = session.get('failures', 0) < MAX_FAILURES
         user.is_active = True
+        if SESSION_TOKENS:
+            issue_session_token(session)
     return user
 
+def render_template(template, **kwargs):
+    """ Render a template, adding the time taken to the request timing
+    Args:
+        template: template name
+        kwargs: template context
+    Returns:
+        HTML
+    """
+    return REQUEST_TIMER.render(flask_render_template, template, **kwargs)
+
+@APP.before_request
+def start_request_timing():
+    """ Start timing the request, registered first so it covers the other request hooks
+    """
+    REQUEST_TIMER.start()
+
+@APP.after_request
+def note_response(response):
+    """ Note the response size and status for record_request_timing. The declared length is
+        used, so streamed and file responses are not buffered to measure them.
+    """
+    g.response_size = response.content_length
+    g.response_status = response.status_code
+    return response
+
+@APP.teardown_request
+def record_request_timing(error=None):
+    """ Record the request timing, database calls and response size for the endpoint, and
+        log them as a request event if timing_events is configured. This runs on teardown so
+        that requests which raise are recorded too, as status 500.
+    """
+    status = 500 if error is not None else g.get('response_status', 500)
+    timing = REQUEST_TIMER.finish(request.endpoint, g.get('response_size'))
+    if TIMING_EVENTS and timing:
+        timing.update({'endpoint': request.endpoint, 'status': status})
+        EVENT_MANAGER.log_event(dict(type='request', **timing))
+
+def begin_request_profile():
+    """ Profile the request if a cProfile session is running
+    """
+    if PROFILER.requests_left:
+        PROFILER.begin_request()
+
+def end_request_profile(_error=None):
+    """ Add the request to the cProfile session, on teardown so failed requests are included
+    """
+    PROFILER.end_request()
+
+def handle_profile_signal(signum, frame):
+    """ Start a sampling profile of this worker for profile_seconds on profile_signal. The
+        handler runs in the main thread, which may be holding the profiler lock while serving
+        a request, so the session is started from another thread.
+    """
+    if frame:
+        print(signum)
+    starter = Thread(target=PROFILER.start, args=('sample', CONFIG.get('profile_seconds', 30)),
+                     name='profiler-signal')
+    starter.daemon = True
+    starter.start()
+
+# Profiling is compiled in but costs nothing unless profile_dir is configured
+if PROFILER:
+    APP.before_request(begin_request_profile)
+    APP.teardown_request(end_request_profile)
+    if CONFIG.get('profile_signal'):
+        signal.signal(getattr(signal, CONFIG.get('profile_signal')), handle_profile_signal)
+
+@APP.before_request
+def authenticate_request():
+    """ Authenticate API calls from machine clients by their HMAC request signature, without
+        the session cookie or any database access. All other requests get CSRF protection.
+    """
+    g.api_client = None
+    authorization = request.headers.get('Authorization', '')
+    if request.path.startswith('/api/') and authorization.startswith('HMAC_SHA256 '):
+        g.api_client = API_AUTH.authenticate_request(request)
+        if g.api_client is None:
+            return make_response(jsonify({'error': 'Invalid request signature'}), 401)
+    elif request.method in APP.config['WTF_CSRF_METHODS']:
+        CSRF.protect()
+
 @LOGIN_MANAGER.unauthorized_handler
 def unauthorized_page():
     """ Called when @login_required decorator triggers, redirects to login page and after
@@ -211,6 +450,25 @@ def unauthorized_page():
     """
     return redirect(url_for('login', next=request.path))
 
+@async
+def rehash_password(userid, password, old_mcf):
+    """ Upgrade a stored password hash to the current scheme and cost after a successful login,
+        unless the password was changed in the meantime
+    Args:
+        userid: User account identifier
+        password: the verified password
+        old_mcf: the MCF value it was verified against
+    """
+    mcf = HASHER.derive(password)
+    if mcf:
+        response = USERS.conditional_update_item('id', userid, 'mcf', mcf, old_mcf)
+        if response.get('conflict'):
+            print('Password hash for {} changed, not upgraded'.format(userid))
+        elif 'error' in response:
+            print(response['error'])
+        else:
+            print('Upgraded password hash for {} from {}'.format(userid, old_mcf.split('$')[1]))
+
 def user_authenticated(userid, account, session, agent, action, remember=False):
     """ User has authenticated, reflect that in session and call login_user
     """
@@ -237,6 +495,8 @@ def user_authenticated(userid, account, session, agent, action, remember=False):
     user = User(account.get('email'), account.get('user'))
     user.is_authenticated = True
     user.is_active = True
+    if SESSION_TOKENS:
+        issue_session_token(session)
     login_user(user, remember=remember)
 
 def get_parameter(response, param, default=None):
@@ -361,15 +621,21 @@ def validate_credentials(form):
         form with 'errors' set as appropriate
     """
     errmsg = None
+    busy = False
     email = form.email.data
     token = form.token.data
     action = form.action.data
     code = form.code.data if 'code' in form else None
     agent = {"ip": get_ip_address(request), "from": get_user_agent(request)}
     userid = generate_user_id(CONFIG.get('user_id_hmac'), email) if email else 'Unknown'
+    if LOGIN_LIMITER.blocked(userid, agent['ip']):
+        form.errors[action.capitalize()] = [ATTEMPTS_MESSAGE]
+        form.password.data = ''
+        return form
     account = USERS.get_item('id', userid)
     if 'error' in account:
         errmsg = 'Unable to validate your credentials'
+        LOGIN_LIMITER.failed(userid, agent['ip'])
         EVENT_MANAGER.error_event(action, userid, 'Unregistered email', **agent)
         form.errors[action.capitalize()] = [errmsg]
         return form
@@ -401,21 +667,31 @@ def validate_credentials(form):
             if errmsg is None:
                 mcf = 'reset_mcf' if action == 'reset' else 'mcf'
                 old_mcf = account.get(mcf)
-                mcf = derive_key(form.oldpassword.data, old_mcf)
-                if mcf != old_mcf:
+                mcf = HASHER.derive(form.oldpassword.data, old_mcf)
+                if mcf is None:
+                    busy = True
+                    errmsg = BUSY_MESSAGE
+                elif mcf != old_mcf:
                     print('old password failed')
                     errmsg = failed_account_attempt(session, failures)
                 else:
-                    mcf = derive_key(form.password.data)
-                    response = USERS.update_item('id', userid, 'mcf', mcf)
+                    mcf = HASHER.derive(form.password.data)
+                    if mcf is None:
+                        busy = True
+                        errmsg = BUSY_MESSAGE
+                    else:
+                        response = USERS.update_item('id', userid, 'mcf', mcf)
         else:
             errmsg = 'The reset link is invalid or has expired'
     if errmsg:
-        errmsg = failed_account_attempt(session, failures, errmsg)
+        if not busy:
+            LOGIN_LIMITER.failed(userid, agent['ip'])
+            errmsg = failed_account_attempt(session, failures, errmsg)
         form.errors[action.capitalize()] = [errmsg]
         EVENT_MANAGER.error_event(action, userid, errmsg, **agent)
         form.password.data = ''
     else:
+        LOGIN_LIMITER.succeeded(userid)
         if action == 'invite':
             user = form.user.data if 'user' in form else None
             phone = form.phone.data if 'phone' in form else None
@@ -443,8 +719,38 @@ def validate_credentials(form):
 
     return form
 
+def throttle_text(account):
+    """ Check the text message throttle before generating and sending a code
+    Args:
+        account info
+    Returns:
+        'sent' to go ahead, 'duplicate' if a code was just sent, 'limited' if over a rate limit
+    """
+    outcome = TEXT_THROTTLE.check(account.get('phone'), account['id'])
+    if outcome != 'sent':
+        print('send_code {} for {}'.format(outcome, account['id']))
+    return outcome
+
+def queue_code(account, code):
+    """ Queue a text message with an authorization code
+    Args:
+        account info
+        code: HOTP code, None if it could not be generated
+    Returns:
+        True if queued
+    """
+    if code is None:
+        return False
+    try:
+        send_text(account.get('phone'), code + ' is your Frosty Web code')
+    except sqlite3.Error as err:
+        LOGGER.error('Unable to queue code for %s: %s', account['id'], err)
+        return False
+    return True
+
 def send_code(account, action):
-    """ Send an authorization code to the user
+    """ Send an authorization code to the user. A repeat request within the duplicate window
+        does not send a new code, the one already sent remains valid.
     Args:
         account info
         action
@@ -456,21 +762,33 @@ def send_code(account, action):
         #send_authy_token_request(user.authy_id)
         print('Sent Authy code')
     elif authentication == 'password:sms' and 'phone' in account:
+        outcome = throttle_text(account)
+        if outcome != 'sent':
+            return True if outcome == 'duplicate' else None
         secret, counter = account.get('otp').split(':')
         counter = int(counter) + 1
-        code = generate_hotp_code(secret, counter)
-        response = USERS.update_item('id', account['id'], 'otp', secret + ':' + str(counter))
-        send_text(account.get('phone'), code + ' is your Frosty Web code')
+        code = OTP.send_hotp(secret, counter)
+        response = USERS.conditional_update_item('id', account['id'], 'otp',
+                                                 secret + ':' + str(counter), account.get('otp'))
+        if 'error' in response or not queue_code(account, code):
+            TEXT_THROTTLE.release(account.get('phone'), account['id'])
+            return None
     elif authentication == 'password' and 'phone' in account and action in ['enable', 'invite', 'register', 'reset']:
+        outcome = throttle_text(account)
+        if outcome != 'sent':
+            return True if outcome == 'duplicate' else None
         if 'otp' not in account:
             secret = generate_otp_secret()
             counter = generate_random_int()
+            response = USERS.update_item('id', account['id'], 'otp', secret + ':' + str(counter))
         else:
             secret, counter = account.get('otp').split(':')
             counter = int(counter) + 1
-        code = generate_hotp_code(secret, counter)
-        response = USERS.update_item('id', account['id'], 'otp', secret + ':' + str(counter))
-        send_text(account.get('phone'), code + ' is your Frosty Web code')
+            response = USERS.conditional_update_item('id', account['id'], 'otp',
+                                                     secret + ':' + str(counter), account.get('otp'))
+        if 'error' in response or not queue_code(account, OTP.send_hotp(secret, counter)):
+            TEXT_THROTTLE.release(account.get('phone'), account['id'])
+            return None
     else:
         return None
     return True
@@ -490,13 +808,18 @@ def verify_code(account, code):
         else:
             secret, counter = account.get('otp').split(':')
             counter = int(counter)
-            verified = verify_hotp_code(secret, code, counter)
+            verified = OTP.verify_hotp(secret, code, counter)
             if verified is None:
                 print('verify_code failed({}, {}, {})'.format(secret, code, counter))
                 errmsg = 'The code is invalid or has expired'
             else:
+                # Advance the counter only if no other request has used this code meanwhile
                 print('verify_code update({}, {})'.format(counter, verified))
-                response = USERS.update_item('id', account['id'], 'otp', secret + ':' + str(verified + 1))
+                response = USERS.conditional_update_item('id', account['id'], 'otp',
+                                                         secret + ':' + str(verified + 1),
+                                                         account.get('otp'))
+                if 'error' in response:
+                    errmsg = 'The code is invalid or has expired'
     else:
         errmsg = 'The code is invalid or has expired'
 
@@ -607,7 +930,93 @@ def server_info():
     timestamp = int((datetime.now(tz=pytz.utc) -
                      datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds())
     uptime = time.strftime("%H:%M:%S", time.gmtime(timestamp - SERVER_START))
-    return jsonify({'server': url_fields.netloc, 'version': SERVER_VERSION, 'uptime': uptime})
+    return jsonify({'server': url_fields.netloc, 'version': SERVER_VERSION, 'uptime': uptime,
+                    'outbox': OUTBOX.stats(), 'sms': TEXT_THROTTLE.stats(),
+                    'kdf': HASHER.stats(), 'login': {'rejected': LOGIN_LIMITER.rejected},
+                    'api_auth': API_AUTH.stats()})
+
+@APP.route('/api/server.stats')
+def server_stats():
+    """ Return live per minute event counts and top recipes over sliding windows
+    """
+    try:
+        top = min(int(request.args.get('top', 10)), 100)
+    except ValueError:
+        top = 10
+    return jsonify(EVENT_MANAGER.stats.snapshot(top=top))
+
+@APP.route('/api/server.timing')
+def server_timing():
+    """ Return request wall time, database calls and time, render time and response size
+        percentiles per endpoint
+    """
+    return jsonify(REQUEST_TIMER.snapshot())
+
+def is_admin():
+    """ Check if the request is from an admin, an API client in admin_clients or a logged in
+        user in admins
+    Returns:
+        True or False
+    """
+    if g.api_client:
+        return g.api_client in CONFIG.get('admin_clients', [])
+    return current_user.is_authenticated and current_user.get_email() in CONFIG.get('admins', [])
+
+@APP.route('/api/server.profile', methods=['GET', 'POST'])
+def server_profile():
+    """ Return the profiler status, or start profiling this worker on POST with mode sample
+        or cprofile, seconds and for cprofile an optional number of requests
+    """
+    if not PROFILER:
+        abort(404)
+    if not is_admin():
+        abort(403, 'Admin access required')
+    if request.method == 'GET':
+        return jsonify(PROFILER.status())
+    try:
+        seconds = float(get_parameter(request, 'seconds') or CONFIG.get('profile_seconds', 30))
+        requests = int(get_parameter(request, 'requests') or 0)
+    except ValueError:
+        abort(400, 'Invalid input, seconds and requests must be numbers')
+    session = PROFILER.start(get_parameter(request, 'mode') or 'sample', seconds, requests)
+    if 'error' in session:
+        return make_response(jsonify(session), 409 if 'session' in session else 400)
+    return make_response(jsonify(session), 202)
+
+def recipe_email_params(recipe, title, inviter):
+    """ Get the templating arguments for a shared recipe email
+    Args:
+        recipe: dictionary
+        title: recipe title
+        inviter: name of the user sharing the recipe
+    Returns:
+        dict of templating arguments
+    """
+    image = recipe.get('image')
+    if image:
+        if image.endswith('_hd'):
+            image = image.replace('_hd', '_small')
+        else:
+            image = image.replace(".jpg", "_small.jpg")
+    link = url_for('recipes', recipe=title.replace(' ', '%20'), _external=True)
+    intro = u'{} has shared a recipe for {} with you.'.format(inviter, title)
+    return {'intro': intro, 'link': link, 'image': image,
+            'signature': 'Enjoy<br />,{}'.format(inviter)}
+
+def get_list_parameter(response, param):
+    """ Get a named list parameter, either a JSON list or a comma separated string
+    Args:
+        response: dictionary of HTTP response
+        param: key to look for
+    Returns:
+        list of values, empty if missing
+    """
+    value = get_parameter(response, param)
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        value = value.split(',')
+    return [item.strip() for item in value if item and item.strip()]
 
 @APP.route('/api/message.email')
 #@login_required
@@ -623,21 +1032,59 @@ def message_email():
     if account and 'error' not in account:
         recipe = RECIPE_MANAGER.get_recipe(title)
         if recipe is not None and 'error' not in recipe:
-            image = recipe.get('image')
-            if image:
-                if image.endswith('_hd'):
-                    image = image.replace('_hd', '_small')
-                else:
-                    image = image.replace(".jpg", "_small.jpg")
-            link = url_for('recipes', recipe=title.replace(' ', '%20'), _external=True)
             user = account.get('user') or email
             inviter = "Frosty" #current_user.get_user()
-            intro = u'{} has shared a recipe for {} with you.'.format(inviter, title)
-            send_email(email, title, 'recipe',
-                       user=user, intro=intro, link=link, image=image, signature='Enjoy<br />,{}'.format(inviter))
+            send_email(email, title, 'recipe', user=user,
+                       **recipe_email_params(recipe, title, inviter))
             return jsonify({'message.email': email, 'status': 'ok'})
     abort(404, 'Recipient or recipe not found')
 
+@APP.route('/api/message.bulk', methods=['POST'])
+def message_bulk():
+    """ Send one or more recipes to a list of recipients, for logged in users and signed API
+        clients. Accounts are read in batches, each recipe email is rendered once and
+        personalized per recipient at delivery.
+    """
+    if not g.api_client and not current_user.is_authenticated:
+        abort(401, 'Login required')
+    titles = get_list_parameter(request, 'recipes') or get_list_parameter(request, 'recipe')
+    emails = get_list_parameter(request, 'recipients') or get_list_parameter(request, 'email')
+    if not titles or not emails:
+        abort(400, 'Invalid input, recipes and recipients expected')
+    userids = dict((generate_user_id(CONFIG.get('user_id_hmac'), email), email)
+                   for email in set(emails))
+    accounts = USERS.batch_get_items('id', list(userids))
+    if 'error' in accounts:
+        abort(422, accounts['error'])
+    destinations = []
+    for userid, email in userids.items():
+        account = accounts.get(userid)
+        if account:
+            destinations.append({'recipient': email,
+                                 'data': {'user': account.get('user') or email}})
+    if not destinations:
+        abort(404, 'Recipients not found')
+
+    inviter = "Frosty" #current_user.get_user()
+    sent = []
+    missing = []
+    for title in titles:
+        recipe = RECIPE_MANAGER.get_recipe(title)
+        if recipe is None or 'error' in recipe:
+            missing.append(title)
+            continue
+        text, html = EMAIL_RENDERER.render_bulk(title, 'recipe', ['user'],
+                                                **recipe_email_params(recipe, title, inviter))
+        for start in range(0, len(destinations), SES_BULK_LIMIT):
+            OUTBOX.put('bulk_email', {'subject': title, 'text': text, 'html': html,
+                                      'destinations': destinations[start:start + SES_BULK_LIMIT]})
+        sent.append(title)
+    if not sent:
+        abort(404, 'Recipes not found')
+    return jsonify({'message.bulk': {'recipes': sent, 'recipients': len(destinations),
+                                     'missing': missing},
+                    'status': 'ok'})
+
 @APP.route('/api/recipe.post')
 #@login_required
 def recipe_post():
@@ -646,8 +1093,11 @@ def recipe_post():
     recipe = get_parameter(request, 'recipe')
     if recipe is None:
         abort(400, 'Invalid input, recipe expected')
-    userid = generate_user_id(CONFIG.get('user_id_hmac'), current_user.get_email())
-    account = USERS.get_item('id', userid)
+    if g.api_client:
+        account = {'id': g.api_client}
+    else:
+        userid = generate_user_id(CONFIG.get('user_id_hmac'), current_user.get_email())
+        account = USERS.get_item('id', userid)
     if account and 'error' not in account:
         RECIPE_MANAGER.load_recipes(recipe)
         return jsonify({'recipe.post': recipe, 'status': 'ok'})
@@ -936,12 +1386,22 @@ def login():
 
     # POST - validate form data
     elif form.validate_on_submit():
-        # Login and validate the user.
+        # Reject early when the password hashing pool is saturated
+        if HASHER.busy():
+            form.errors['Login'] = [BUSY_MESSAGE]
+            form.password.data = ''
+            return render_template('login.html', form=form)
+        # Login and validate the user, rejecting repeated failures before any database access
         email = form.email.data
         userid = generate_user_id(CONFIG.get('user_id_hmac'), email) if email else 'Unknown'
+        if LOGIN_LIMITER.blocked(userid, agent['ip']):
+            form.errors['Login'] = [ATTEMPTS_MESSAGE]
+            form.password.data = ''
+            return render_template('login.html', form=form)
         account = USERS.get_item('id', userid)
         if not account or 'error' in account:
             errmsg = 'Unable to validate your credentials'
+            LOGIN_LIMITER.failed(userid, agent['ip'])
             form.errors['Login'] = [errmsg]
             EVENT_MANAGER.error_event('login', email, errmsg, **agent)
             form.password.data = ''
@@ -962,13 +1422,21 @@ def login():
             return render_template('login.html', form=form)
 
         # Check password
-        mcf = derive_key(form.password.data, account['mcf'])
+        mcf = HASHER.derive(form.password.data, account['mcf'])
+        if mcf is None:
+            form.errors['Login'] = [BUSY_MESSAGE]
+            form.password.data = ''
+            return render_template('login.html', form=form)
         if mcf != account.get('mcf'):
+            LOGIN_LIMITER.failed(userid, agent['ip'])
             errmsg = failed_account_attempt(session, failures)
             form.errors['Login'] = [errmsg]
             form.password.data = ''
             EVENT_MANAGER.error_event('login', userid, errmsg, **agent)
             return render_template('login.html', form=form)
+        LOGIN_LIMITER.succeeded(userid)
+        if needs_rehash(mcf):
+            rehash_password(userid, form.password.data, mcf)
 
         if account.get('authentication') == 'password':
             user_authenticated(userid, account, session, agent, 'login', form.remember.data)
@@ -990,6 +1458,7 @@ def logout():
     """
     SESSIONS.delete_item('id', current_user.get_id())
     EVENT_MANAGER.web_event('logout', current_user.get_id())
+    cookie_session.pop('auth', None)
     logout_user()
     return redirect(url_for('index'))
 
@@ -1123,8 +1592,10 @@ def change():
         userid = generate_user_id(CONFIG.get('user_id_hmac'), email) if email else 'Unknown'
         account = USERS.get_item('id', userid)
         old_mcf = account.get('mcf')
-        mcf = derive_key(form.oldpassword.data, old_mcf)
-        if mcf != old_mcf:
+        mcf = HASHER.derive(form.oldpassword.data, old_mcf)
+        if mcf is None:
+            form.errors['Change'] = [BUSY_MESSAGE]
+        elif mcf != old_mcf:
             errmsg = 'Unable to validate your credentials'
             form.errors['Change'] = [errmsg]
             form.oldpassword.data = ''
@@ -1132,8 +1603,8 @@ def change():
             form.confirm.data = ''
             EVENT_MANAGER.error_event('change', userid, errmsg, **agent)
         else:
-            mcf = derive_key(form.password.data)
-            response = USERS.update_item('id', userid, 'mcf', mcf)
+            mcf = HASHER.derive(form.password.data)
+            response = USERS.update_item('id', userid, 'mcf', mcf) if mcf else {'error': BUSY_MESSAGE}
             if 'error' in response:
                 form.errors['Change'] = [response['error']]
                 EVENT_MANAGER.error_event('change', userid, response['error'], **agent)
@@ -1233,7 +1704,7 @@ def invite():
         link = url_for('accept', email=email, token=token, action=action, _external=True)
         inviter = current_user.get_user()
         if not phone:
-            code = generate_hotp_code(secret, counter)
+            code = OTP.send_hotp(secret, counter)
         else:
             code = None
         intro = u'{} has Invited you to join the Frosty Web community.'.format(inviter)
@@ -1371,6 +1842,12 @@ def register():
             form.token.data = ''
             EVENT_MANAGER.error_event('register', userid, errmsg, **agent)
             return redirect(url_for('resend', email=email, action='register'))
+        mcf = HASHER.derive(form.password.data)
+        if mcf is None:
+            form.errors['Register'] = [BUSY_MESSAGE]
+            form.password.data = ''
+            form.confirm.data = ''
+            return render_template('register.html', form=form)
         # Create json for new user
         if check_phone(phone):
             secret = generate_otp_secret()
@@ -1383,7 +1860,7 @@ def register():
                 'phone': phone,
                 'user': user,
                 'authentication': 'password',
-                'mcf': derive_key(form.password.data),
+                'mcf': mcf,
                 'otp': secret + ':' + str(counter),
                 'created': 'pending: ' + datetime.utcnow().strftime('%Y-%m-%d')
                }
@@ -1394,21 +1871,26 @@ def register():
         token = generate_timed_token(email, APP.config['SECRET_KEY'], 'confirm')
         link = url_for('confirm', email=email, token=token, action='register', _external=True)
         if phone:
-            code = generate_hotp_code(secret, counter)
+            code = OTP.send_hotp(secret, counter)
         else:
             code = None
         intro = 'You have registered for a new account and need to confirm that it was really you.'
         send_email(email, 'Confirm Account', 'confirm',
-                   user=user, intro=intro, link=link, code=code)
+                   user=user.get_user(), intro=intro, link=link, code=code)
         flash('A confirmation email has been sent to ' + form.email.data)
         EVENT_MANAGER.web_event('register', userid, **agent)
     return render_template('register.html', form=form)
 
 def handle_sigterm(signum, frame):
-    """ Catch SIGTERM and SIGINT and stop the server by raising an exception
+    """ Catch SIGTERM and SIGINT, drain pending async tasks and stop the server by raising
+        an exception
     """
     if frame:
         print(signum)
+    shutdown_pool()
+    OUTBOX.stop()
+    HASHER.shutdown(wait=False)
+    EVENT_MANAGER.stop()
     raise SystemExit('Killed')
 
 def main():